@@ -1,35 +1,69 @@
 # Assist.py
 
 import logging
-from botpy.errors import ServerError
 from botpy.message import Message
 
+from UserStats import get_stats, has_stats, rebuild_stats
+
 logger = logging.getLogger("Assist")
 
+RULES_URL = "https://dwgx.top/rules.html"  # 修改为实际的URL
+
 
 class Assist:
-    def __init__(self, user_data, game_history, save_data, boss_id, userid_to_internal):
+    def __init__(self, user_data, game_history, boss_id, userid_to_internal, data_manager):
         self.user_data = user_data
         self.game_history = game_history
-        self._save_data = save_data
+        self.data_manager = data_manager
         self.boss_id = boss_id
         self.userid_to_internal = userid_to_internal
         self.client = None
 
+    # 处理方法名 -> 命令别名，由 register_commands 注册到 CommandRouter
+    COMMANDS = {
+        'handle_show_boss_command': ('查看老板', 'boss'),
+        'handle_account_command': ('ye', '查看账户'),
+        'handle_repeat_command': ('复读',),
+        'handle_rules_command': ('规则',),
+    }
+
+    def register_commands(self, router):
+        router.register_all(self, self.COMMANDS)
+
+    async def handle_show_boss_command(self, message: Message, ctx):
+        await self.show_current_boss(message)
+
+    async def handle_account_command(self, message: Message, ctx):
+        logger.debug("用户 %s 请求查看账户余额。", ctx.internal_id)
+        await self.show_balance(message, ctx.internal_id)
+        await self.analyze_history(message, ctx.internal_id)
+
+    async def handle_repeat_command(self, message: Message, ctx):
+        repeat_message = ctx.content[len(ctx.parts[0]):].strip()
+        if not repeat_message:
+            await message.reply(content='❌ 请提供要复读的内容。例如：@机器人 复读 你好！')
+            return
+        await message.reply(content=repeat_message)
+
+    async def handle_rules_command(self, message: Message, ctx):
+        await self.show_rules(message)
+
+    async def show_rules(self, message: Message):
+        await message.reply(content=f"📜 **游戏指南**: [点击这里查看指南]({RULES_URL})")
+
     def get_internal_id(self, userid: str):
         return self.userid_to_internal.get(userid)
 
     async def show_current_boss(self, message: Message):
-        if self.boss_id and self.boss_id in self.user_data:
-            boss_info = self.user_data[self.boss_id]
-            boss_name = boss_info.get('username', '未知')
-            boss_balance = boss_info.get('points', 0)
-            await message.reply(content=f"👑 **当前负责人**: <@{boss_info['userid']}> **{boss_name}**\n💵 **负责人余额**: **{boss_balance}** 代币")
+        # 负责人可能已更换，也可能不在本进程的数据中（分片部署），统一向 Boss 查询
+        boss_info = self.client.Boss.profile()
+        if boss_info:
+            await message.reply(content=f"👑 **当前负责人**: <@{boss_info['userid']}> **{boss_info['username']}**\n"
+                                        f"💵 **负责人余额**: **{boss_info['points']}** 代币")
         else:
             await message.reply(content='⚠️ 当前没有负责人。')
 
-    async def show_balance(self, message: Message, userid: str):
-        internal_id = self.get_internal_id(userid)
+    async def show_balance(self, message: Message, internal_id: str):
         if not internal_id:
             await message.reply(content='⚠️ 未找到您的账户信息。')
             return
@@ -47,38 +81,36 @@ class Assist:
         else:
             await message.reply(content='⚠️ 未找到您的账户信息。')
 
-    async def analyze_history(self, message: Message):
-        internal_id = self.get_internal_id(str(message.author.id))
-
+    async def analyze_history(self, message: Message, internal_id: str):
         if not internal_id:
             await message.reply(content="⚠️ 未找到您的账户信息。")
             return
 
-        game_history = self.game_history.get(internal_id, [])
-
-        if not game_history:
-            await message.reply(content="您还没有任何游戏活动记录。")
+        user = self.user_data.get(internal_id)
+        if user is None:
+            await message.reply(content="⚠️ 未找到您的账户信息。")
             return
 
-        player_history = [record for record in game_history if
-                          record.get('role') == 'player' and '用于游戏' in record.get('description', '')]
-
-        if not player_history:
+        stats = get_stats(user)
+        if stats is None:
+            # 旧用户首次查看：从完整历史补齐统计，之后随每局游戏增量更新
+            async with self.data_manager.locks.acquire(internal_id):
+                if not has_stats(user):
+                    user.update(rebuild_stats(await self.data_manager.get_history(internal_id)))
+                    self.data_manager.mark_user(internal_id)
+                    logger.info("已为用户 %s 重建游戏统计。", internal_id)
+            stats = get_stats(user)
+
+        if stats['games'] <= 0:
             await message.reply(content="您还没有任何游戏活动记录。")
             return
 
-        total_games = len(set(record['period_number'] for record in player_history))
-        total_winnings = sum(
-            record.get('points_change', 0) for record in game_history if
-            record.get('role') == 'player' and record.get('points_change', 0) > 0
-        )
-        total_bet = sum(
-            record.get('bet_amount', 0) for record in player_history
-        )
-        total_profit = total_winnings - total_bet
+        total_games = stats['games']
+        total_winnings = stats['total_winnings']
+        total_bet = stats['total_bet']
+        total_profit = stats['profit']
 
-        win_count = len({record['period_number'] for record in game_history if
-                         record.get('role') == 'player' and record.get('points_change', 0) > 0})
+        win_count = stats['wins']
         lose_count = total_games - win_count
         win_rate = (win_count / total_games * 100) if total_games > 0 else 0
 
@@ -95,7 +127,4 @@ class Assist:
             f"--------------------------------"
         )
 
-        try:
-            await message.reply(content=summary_message)
-        except ServerError:
-            await message.reply(content='❌ 无法发送游戏历史汇总，请稍后再试。')
+        await message.reply(content=summary_message)
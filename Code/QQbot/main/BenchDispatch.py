@@ -0,0 +1,79 @@
+# BenchDispatch.py
+# 对比每条消息的命令分发开销：旧版（每条消息重建命令列表并线性查找、每次重新编译投入正则）
+# 与路由表（一次字典查询、模块级预编译正则）。
+# 用法：python BenchDispatch.py [每种消息的重复次数]
+
+import logging
+import re
+import sys
+import timeit
+
+from Assist import Assist
+from Boss import Boss
+from Commands import CommandRouter
+from Gambling import Gambling, parse_bets
+from RedEnvelope import RedEnvelope
+
+MESSAGES = ['sh3', 'ye', '领取 20241024214100ABCD', '大100 7y10', 's50 dan20 x30', '规则', '随便说点什么']
+
+LEGACY_COMMANDS = [
+    '🎲', 'sh', '查看老板', 'boss', '取消', 'qx',
+    '我当老板', '不当老板', 'ye', '查看账户', '复读',
+    'hb', '领取', '撤回', 'sh3', '🎲3', '规则'
+]
+
+
+def legacy_parse_bets(content):
+    bet_types = {'双': '双', '单': '单', 's': '双', 'dan': '单', 'da': '大', 'x': '小', '大': '大', '小': '小'}
+    pattern = re.compile(
+        r"(?P<type>双|单|大|小|s|dan|da|x|(?P<number>[3-9]|1[0-8]))(?:y)?(?P<amount>\d+)",
+        re.IGNORECASE
+    )
+    valid_bet_types = {'双', '单', '大', '小', '3', '4', '5', '6', '7', '8', '9', '10',
+                       '11', '12', '13', '14', '15', '16', '17', '18'}
+    bets = []
+    for bet_type_raw, number, amount in pattern.findall(content):
+        bet_type = number or bet_types.get(bet_type_raw.lower(), bet_type_raw)
+        if bet_type in valid_bet_types and int(amount) > 0:
+            bets.append({'type': bet_type, 'amount': int(amount)})
+    return bets
+
+
+def legacy_dispatch(content):
+    control_commands = list(LEGACY_COMMANDS)
+    parts = content.split()
+    if parts and parts[0].lower() in [cmd.lower() for cmd in control_commands]:
+        return parts[0].lower()
+    return legacy_parse_bets(content)
+
+
+def build_router():
+    router = CommandRouter()
+
+    async def handler(message, ctx):
+        pass
+
+    for module in (Gambling, RedEnvelope, Boss, Assist):
+        for aliases in module.COMMANDS.values():
+            router.register(aliases, handler)
+    return router
+
+
+def routed_dispatch(router, content):
+    parts = content.split()
+    handler = router.resolve(parts[0])
+    if handler is not None:
+        return handler
+    return parse_bets(content)
+
+
+if __name__ == "__main__":
+    # 投入解析会记录日志，基准测试时关闭
+    logging.disable(logging.CRITICAL)
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    router = build_router()
+    print(f"已注册命令别名 {len(router.aliases())} 个，每种消息重复 {number} 次")
+    for content in MESSAGES:
+        legacy = timeit.timeit(lambda: legacy_dispatch(content), number=number) / number * 1e6
+        routed = timeit.timeit(lambda: routed_dispatch(router, content), number=number) / number * 1e6
+        print(f"{content:<28} 旧版 {legacy:7.2f} µs   路由表 {routed:7.2f} µs   {legacy / routed:5.1f}x")
@@ -0,0 +1,53 @@
+# BenchHistoryMemory.py
+# 对比旧版字典格式与 HistoryRecord 在内存中的占用。
+# 用法：python BenchHistoryMemory.py [记录条数]
+
+import sys
+import time
+import tracemalloc
+
+from History import EventKind, HistoryRecord
+
+
+def make_dicts(count):
+    records = []
+    for i in range(count):
+        amount = 10 + i % 90
+        records.append({
+            'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(1700000000 + i)),
+            'description': f"大 {amount} 用于游戏",
+            'points_change': -amount,
+            'new_balance': 100000 - i,
+            'role': 'player',
+            'period_number': f"20240101{i // 3:06d}ABCD",
+            'bet_amount': amount,
+        })
+    return records
+
+
+def make_records(count):
+    records = []
+    for i in range(count):
+        amount = 10 + i % 90
+        records.append(HistoryRecord(1700000000 + i, EventKind.BET, -amount, 100000 - i, 'player',
+                                     f"20240101{i // 3:06d}ABCD", bet_amount=amount, bet_type='大'))
+    return records
+
+
+def measure(factory, count):
+    tracemalloc.start()
+    records = factory(count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return current
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    dict_bytes = measure(make_dicts, count)
+    record_bytes = measure(make_records, count)
+    print(f"记录条数：{count}")
+    print(f"字典格式：{dict_bytes / 1024 / 1024:.1f} MiB，每条 {dict_bytes / count:.0f} 字节")
+    print(f"HistoryRecord：{record_bytes / 1024 / 1024:.1f} MiB，每条 {record_bytes / count:.0f} 字节")
+    print(f"节省：{(1 - record_bytes / dict_bytes) * 100:.1f}%")
@@ -1,87 +1,126 @@
 # Boss.py
 
-import asyncio
 import logging
 import random
 import string
-import time
+
+from History import EventKind, HistoryRecord
 
 logger = logging.getLogger("Boss")
 
 
 class Boss:
-    def __init__(self, data, user_data, save_data, data_manager):
+    def __init__(self, data, user_data, data_manager):
         self.data = data
         self.user_data = user_data
-        self._save_data = save_data
         self.data_manager = data_manager
         self.boss_id = self.data.get("boss_id")
+        # 赔付预留账本：玩家 -> 其进行中游戏在最坏点数下的赔付。开局时预留、结算或取消时释放，
+        # 开局检查只需比较 可用 = 余额 - 已预留。预留随负责人职位转移，与结算时由当前负责人支付一致。
+        self.reservations = {}
+        self.reserved = 0
 
     async def create_boss_account(self):
         if not self.boss_id:
             internal_id = self.data_manager.generate_internal_id()
             self.user_data[internal_id] = {'userid': None, 'username': '默认负责人', 'points': 1000000}
             self.data["boss_id"] = internal_id
-            await self._save_data()  # 确保保存是等待的
+            self.data_manager.mark_user(internal_id)
+            self.data_manager.mark_boss()
             self.boss_id = internal_id
-            logger.info(f"创建默认负责人账户，ID: {internal_id}")
+            logger.info("创建默认负责人账户，ID: %s", internal_id)
 
-    async def handle_boss_command(self, userid, action):
-        if action == 'become':
+    # 处理方法名 -> 命令别名，由 register_commands 注册到 CommandRouter
+    COMMANDS = {
+        'handle_become_command': ('我当老板',),
+        'handle_leave_command': ('不当老板',),
+    }
+
+    def register_commands(self, router):
+        router.register_all(self, self.COMMANDS)
 
-            internal_id = await self.data_manager.get_or_create_user(userid, '负责人用户')
+    async def handle_become_command(self, message, ctx):
+        response = await self.handle_boss_command(ctx.internal_id, 'become')
+        await message.reply(content=response)
+
+    async def handle_leave_command(self, message, ctx):
+        response = await self.handle_boss_command(ctx.internal_id, 'leave')
+        await message.reply(content=response)
+
+    async def handle_boss_command(self, internal_id, action):
+        if action == 'become':
             previous_boss = self.boss_id
             self.boss_id = internal_id
             self.data["boss_id"] = internal_id
-            await self._save_data()
-            logger.info(f"用户 {userid} 成为新的负责人。")
+            self.data_manager.mark_boss()
+            logger.info("用户 %s 成为新的负责人。", internal_id)
             if previous_boss and previous_boss != internal_id:
                 return "✅ 您已成为新的负责人。"
             return "✅ 您已成功成为负责人。"
         elif action == 'leave':
-            if self.boss_id and self.data_manager.get_userid(self.boss_id) == userid:
+            if self.boss_id and self.boss_id == internal_id:
                 self.boss_id = None
                 self.data["boss_id"] = None
-                await self._save_data()
-                logger.info(f"用户 {userid} 离开了负责人职位。")
+                self.data_manager.mark_boss()
+                logger.info("用户 %s 离开了负责人职位。", internal_id)
                 return "✅ 您已成功离开负责人职位。"
             else:
                 return "❌ 您当前不是负责人。"
         else:
             return "❓ 无效的操作。"
 
+    def profile(self):
+        """当前负责人的展示信息 {'userid', 'username', 'points'}，没有负责人时返回 None。"""
+        boss = self.user_data.get(self.boss_id) if self.boss_id else None
+        if boss is None:
+            return None
+        return {'userid': boss.get('userid'), 'username': boss.get('username', '未知'), 'points': boss.get('points', 0)}
+
+    def available_points(self):
+        return self.user_data.get(self.boss_id, {}).get('points', 0) - self.reserved
+
+    def reserve(self, user_id, amount):
+        """为玩家的一局游戏预留最坏情况下的赔付，可用代币不足时抛出 ValueError。"""
+        if amount > self.available_points():
+            raise ValueError("负责人可用代币不足。")
+        self.reservations[user_id] = amount
+        self.reserved += amount
+        logger.debug("为用户 %s 预留 %s 代币，负责人已预留 %s 代币", user_id, amount, self.reserved)
+
+    def restore_reservation(self, user_id, amount):
+        """启动时恢复进行中游戏的预留；开局时已经检查过可用代币，这里不再检查。"""
+        self.release(user_id)
+        self.reservations[user_id] = amount
+        self.reserved += amount
+
+    def release(self, user_id):
+        amount = self.reservations.pop(user_id, 0)
+        self.reserved -= amount
+        return amount
+
     def deduct_boss_points(self, amount):
         if self.boss_id not in self.user_data:
             raise ValueError("负责人账户不存在。")
         if self.user_data[self.boss_id]['points'] < amount:
             raise ValueError("负责人的代币不足。")
-        self.user_data[self.boss_id]['points'] -= amount
-        self.log_history(self.boss_id, f"扣除 {amount} 代币用于支付奖励", -amount, "system", role='system')
-        asyncio.create_task(self._save_data())
-        logger.info(f"负责人 {self.boss_id} 扣除 {amount} 代币，当前余额：{self.user_data[self.boss_id]['points']}")
+        self.data_manager.add_points(self.boss_id, -amount)
+        self.log_history(self.boss_id, EventKind.BOSS_DEDUCT, -amount, "system", role='system')
+        logger.debug("负责人 %s 扣除 %s 代币，当前余额：%s",
+                     self.boss_id, amount, self.user_data[self.boss_id]['points'])
 
     def add_boss_points(self, amount):
         if self.boss_id not in self.user_data:
             raise ValueError("负责人账户不存在。")
-        self.user_data[self.boss_id]['points'] += amount
-        self.log_history(self.boss_id, f"增加 {amount} 代币作为负责人收益", amount, "system", role='system')
-        asyncio.create_task(self._save_data())
-        logger.info(f"负责人 {self.boss_id} 增加 {amount} 代币，当前余额：{self.user_data[self.boss_id]['points']}")
-
-    def log_history(self, user_id, description, points_change, period_number, bet_amount=None, role='system'):
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-        history_record = {
-            'time': timestamp,
-            'description': description,
-            'points_change': points_change,
-            'new_balance': self.user_data[user_id]['points'],
-            'role': role,
-            'period_number': period_number
-        }
-        if bet_amount is not None:
-            history_record['bet_amount'] = bet_amount
-        if user_id not in self.data["game_history"]:
-            self.data["game_history"][user_id] = []
-        self.data["game_history"][user_id].append(history_record)
-        asyncio.create_task(self._save_data())
-        logger.info(f"负责人游戏历史已更新，用户ID：{user_id}")
+        self.data_manager.add_points(self.boss_id, amount)
+        self.log_history(self.boss_id, EventKind.BOSS_ADD, amount, "system", role='system')
+        logger.debug("负责人 %s 增加 %s 代币，当前余额：%s",
+                     self.boss_id, amount, self.user_data[self.boss_id]['points'])
+
+    def log_history(self, user_id, kind, points_change, period_number, bet_amount=None, role='system',
+                    counterparty=None):
+        history_record = HistoryRecord.create(
+            kind, points_change, self.user_data[user_id]['points'], role, period_number,
+            bet_amount=bet_amount, counterparty=counterparty
+        )
+        self.data_manager.append_history(user_id, history_record)
+        logger.debug("负责人游戏历史已更新，用户ID：%s", user_id)
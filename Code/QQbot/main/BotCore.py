@@ -0,0 +1,310 @@
+# BotCore.py
+
+import asyncio
+import logging
+import time
+
+from botpy.message import Message
+
+from Commands import CommandContext, CommandRouter
+from DiceRng import DiceRng
+from History import EventKind
+from Ingress import Ingress
+from Metrics import Histogram, MetricsRegistry
+from MetricsServer import MetricsServer
+from Outbox import Outbox
+from UserStats import record_open
+from Assist import Assist
+from Boss import Boss
+from Gambling import Gambling, parse_bets
+from RedEnvelope import RedEnvelope
+
+logger = logging.getLogger("BotCore")
+
+
+def build_outbox(config):
+    outbox = config.get('outbox') or {}
+    return Outbox(
+        rate=float(outbox.get('rate', 5)),
+        burst=int(outbox.get('burst', 5)),
+        linger=float(outbox.get('linger', 0.05)),
+        max_retries=int(outbox.get('max_retries', 3)),
+        retry_delay=float(outbox.get('retry_delay', 0.5))
+    )
+
+
+def build_ingress(config, handler):
+    ingress = config.get('ingress') or {}
+    overflow = ingress.get('overflow', 'busy')
+    if overflow not in Ingress.OVERFLOW_ACTIONS:
+        logger.error("配置项 ingress.overflow 无效：%s，可选 %s。",
+                     overflow, '、'.join(Ingress.OVERFLOW_ACTIONS))
+        exit(1)
+    return Ingress(
+        handler,
+        workers=int(ingress.get('workers', 8)),
+        queue_size=int(ingress.get('queue_size', 1000)),
+        overflow=overflow
+    )
+
+
+def build_metrics_server(config, collect):
+    """按配置创建本地指标端点，未开启时返回 None。collect 为返回指标族列表的协程函数。"""
+    metrics = config.get('metrics') or {}
+    if not metrics.get('enabled', True):
+        return None
+    return MetricsServer(collect, host=metrics.get('host', '127.0.0.1'), port=int(metrics.get('port', 9108)))
+
+
+async def report_metrics(summary, interval):
+    """每 interval 秒输出一行指标摘要，替代逐条消息的 INFO 日志。"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            logger.info(summary())
+        except Exception:
+            logger.exception("生成指标摘要时发生错误。")
+
+
+class BotCore:
+    """
+    机器人的业务部分：按配置组装各模块、构建命令路由、分发已解析的命令。
+    不涉及网关连接与消息收发，单进程的 DwgxBot 与分片部署的 ShardWorker 共用。
+    """
+    # 分片部署时替换为跨分片协调的子类
+    boss_class = Boss
+    red_envelope_class = RedEnvelope
+
+    def __init__(self, config, data_manager, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config = config
+        self.data_manager = data_manager
+        self.data = self.data_manager.data
+        self.user_data = self.data['user_data']
+
+        # 多人同轮模式：开启后同一频道窗口期内的投入统一摇一次骰子
+        rounds = self.config.get('rounds') or {}
+        round_window = float(rounds.get('window', 30)) if rounds.get('enabled') else 0
+
+        # 骰子随机数：CSPRNG 缓冲池，可选承诺-揭示
+        dice = self.config.get('dice') or {}
+        rng = DiceRng(pool_size=int(dice.get('pool_size', 4096)), commit_reveal=bool(dice.get('commit_reveal', False)))
+
+        # 闲置游戏回收：超过 idle_ttl 秒无操作的游戏退还或自动开奖
+        games = self.config.get('games') or {}
+        idle_ttl = float(games.get('idle_ttl', 0))
+        idle_action = games.get('idle_action', 'refund')
+        if idle_action not in Gambling.IDLE_ACTIONS:
+            logger.error("配置项 games.idle_action 无效：%s，可选 %s。",
+                         idle_action, '、'.join(Gambling.IDLE_ACTIONS))
+            exit(1)
+
+        # 初始化各个模块
+        self.Boss = self.boss_class(
+            data=self.data,
+            user_data=self.user_data,
+            data_manager=self.data_manager
+        )
+
+        self.Gambling = Gambling(
+            user_data=self.user_data,
+            game_history=self.data['game_history'],
+            data_manager=self.data_manager,
+            boss=self.Boss,
+            round_window=round_window,
+            rng=rng,
+            idle_ttl=idle_ttl,
+            idle_action=idle_action
+        )
+
+        self.Boss.gambling = self.Gambling
+        # 恢复重启前进行中的游戏及负责人预留
+        self.Gambling.restore_games()
+
+        self.Assist = Assist(
+            user_data=self.user_data,
+            game_history=self.data['game_history'],
+            boss_id=self.Boss.boss_id,
+            userid_to_internal=self.data["userid_to_internal"],
+            data_manager=self.data_manager
+        )
+        self.Assist.client = self
+
+        self.RedEnvelope = self.red_envelope_class(
+            data=self.data,
+            user_data=self.user_data,
+            admins=self.config.get('admins', []),
+            data_manager=self.data_manager
+        )
+
+        # 命令路由表在启动时构建一次，各模块注册自己的命令
+        # 注意：'双' 和 '单' 不是命令，以便它们作为投入类型被解析
+        self.router = CommandRouter()
+        for module in (self.Gambling, self.RedEnvelope, self.Boss, self.Assist):
+            module.register_commands(self.router)
+
+        # 按命令（处理函数名，投入为 bet）统计分发耗时；入站、出站队列由子类创建后再登记
+        self.dispatch_seconds = {}
+        self.metrics = MetricsRegistry()
+        self.metrics.histograms('dispatch_seconds', "分发并处理一条命令的耗时（秒）", 'command',
+                                lambda: self.dispatch_seconds)
+        self.data_manager.register_metrics(self.metrics)
+        self.Gambling.register_metrics(self.metrics)
+
+        # 确保负责人账户存在
+        if self.Boss.boss_id:
+            if self.Boss.boss_id not in self.user_data:
+                asyncio.create_task(self.Boss.create_boss_account())
+
+    def _dispatch_histogram(self, command):
+        histogram = self.dispatch_seconds.get(command)
+        if histogram is None:
+            histogram = self.dispatch_seconds[command] = Histogram(f"dispatch_seconds_{command}")
+        return histogram
+
+    async def dispatch(self, message: Message, content: str, userid: str, internal_id: str):
+        """处理已去掉 @机器人 前缀的命令内容。"""
+        started = time.perf_counter()
+        command = 'show_rules'
+        try:
+            if not content:
+                await self.Assist.show_rules(message)
+                return
+
+            parts = content.split()
+            handler = self.router.resolve(parts[0])
+            if handler is not None:
+                command = handler.__name__
+                logger.debug("处理命令: %s", parts[0].lower())
+                await handler(message, CommandContext(content, parts, userid, internal_id))
+                return
+
+            # 解析投入命令，包括 '双' 和 '单' 以及数字参与格式
+            bets = parse_bets(content)
+            if not bets:
+                command = 'unknown'
+                await message.reply(content='❓ 未知指令。请输入 “规则” 查看游戏指南。')
+                return
+            command = 'bet'
+            await self.handle_start_game(message, bets, internal_id)
+        finally:
+            self._dispatch_histogram(command).observe(time.perf_counter() - started)
+
+    async def handle_start_game(self, message: Message, bets: list, internal_id: str):
+        logger.debug("用户 %s 开始游戏，投入: %s", internal_id, bets)
+        username = message.author.username
+        # 创建或获取用户账户
+        # internal_id 已在分发命令之前创建
+
+        MAX_BET_PER_USER = 1000000 # 设置一个合理的最大投入金额
+
+        total_bet_amount = sum(bet['amount'] for bet in bets)
+
+        if total_bet_amount > MAX_BET_PER_USER:
+            await message.reply(content=f'❌ 您的总投入金额超过了最大限制：**{MAX_BET_PER_USER}** 代币。')
+            return
+
+        if self.Gambling.has_game(internal_id):
+            await message.reply(content='⚠️ 您已经有一个进行中的游戏，请完成或取消当前游戏后再开始新游戏。')
+            return
+
+        if not self.Boss.boss_id:
+            await message.reply(content='❌ 当前没有负责人，无法进行游戏。请等待有人成为负责人后再试。')
+            return
+
+        # 同时锁住玩家和负责人；持锁期间只做内存操作，回复消息在释放锁之后发送
+        boss_id = self.Boss.boss_id
+        async with self.data_manager.locks.acquire(internal_id, boss_id, lock_class='player+boss'):
+            reply, game = self._open_game(bets, internal_id, username, total_bet_amount)
+            if game is not None and self.Gambling.round_window:
+                remaining = self.Gambling.join_round(message, internal_id, game)
+                reply += f"\n🕒 距本轮开奖还有 **{int(remaining)}** 秒。"
+                if game.get('commitment'):
+                    reply += f"\n🔐 本轮骰子承诺：`{game['commitment']}`"
+            elif game is not None:
+                self.Gambling.watch_game(internal_id)
+            if game is not None:
+                # 与扣款、投入历史在同一次刷新中落盘
+                self.Gambling.checkpoint_game(internal_id)
+        await message.reply(content=reply)
+
+    def _open_game(self, bets: list, internal_id: str, username: str, total_bet_amount: int):
+        """
+        扣除投入并登记进行中的游戏，返回 (要回复给用户的内容, 新登记的游戏或 None)。
+        调用方需持有玩家与负责人的锁。
+        """
+        if self.Gambling.has_game(internal_id):
+            return '⚠️ 您已经有一个进行中的游戏，请完成或取消当前游戏后再开始新游戏。', None
+
+        user_points = int(self.user_data[internal_id].get('points', 0))
+        if total_bet_amount > user_points:
+            return f'❌ 您的代币不足，当前代币：**{user_points}** 个。', None
+
+        try:
+            self.Gambling._deduct_user_points(internal_id, total_bet_amount)
+            logger.debug("扣除用户 %s 的 %s 代币，剩余代币：%s",
+                         internal_id, total_bet_amount, self.user_data[internal_id]['points'])
+        except ValueError as e:
+            return f'❌ {str(e)}', None
+
+        # 按最坏点数预留负责人需支付的奖励，已开局但未结算的游戏占用的额度不能重复使用
+        potential_winnings = self.Gambling.payouts.worst_case_liability(bets)
+        logger.debug("用户 %s 投入单最坏赔付：%s，"
+                     "庄家优势：%.2f%%",
+                     internal_id, potential_winnings, self.Gambling.payouts.house_edge(bets) * 100)
+        if self.Boss.boss_id != internal_id:
+            try:
+                self.Boss.reserve(internal_id, potential_winnings)
+            except ValueError:
+                self.Gambling._add_user_points(internal_id, total_bet_amount)
+                logger.debug("返还用户 %s 的 %s 代币，当前代币：%s，"
+                             "负责人可用代币：%s",
+                             internal_id, total_bet_amount, self.user_data[internal_id]['points'],
+                             self.Boss.available_points())
+                return '⚠️ 负责人代币不足以支付您的潜在奖励。请联系管理员。', None
+
+        period_number = self.Gambling.generate_unique_period_number()
+        for bet in bets:
+            self.Gambling.log_history(
+                internal_id,
+                EventKind.BET,
+                -bet['amount'],
+                period_number,
+                bet_amount=bet['amount'],
+                role='player',
+                bet_type=bet['type']
+            )
+        record_open(self.user_data[internal_id], total_bet_amount)
+        game = self.Gambling.active_games[internal_id] = {
+            'username': username,
+            'bets': bets,
+            'start_time': time.time(),
+            'period_number': period_number,
+            'boss': self.Boss,
+            'dice_rolls': []
+        }
+        commitment_line = ""
+        if self.Gambling.rng.commit_reveal and not self.Gambling.round_window:
+            # 同轮模式下由所在轮次统一生成种子
+            game['seed'], game['commitment'] = self.Gambling.rng.new_commitment()
+            commitment_line = f"🔐 骰子承诺：`{game['commitment']}`\n"
+        bet_details = "\n".join(
+            [f"• **{self.Gambling.map_bet_type_display(bet['type'])}**: 投入 **{bet['amount']}** 代币" for bet in
+             bets]
+        )
+        confirmation_message = (
+            f"🎲 **投入确认** 🎲\n"
+            f"--------------------------------\n"
+            f"{bet_details}\n"
+            f"--------------------------------\n"
+            f"💵 **剩余余额**: **{user_points - total_bet_amount}** 代币\n"
+            f"--------------------------------\n"
+            f"{commitment_line}"
+            + ("⏳ 本轮投入汇总中，到时统一开奖，无需摇骰子。" if self.Gambling.round_window else
+               "🎯 游戏开始！请发送 `sh` 来摇骰子。发送 `sh3` 来摇三次骰子。")
+        )
+        logger.debug("用户 %s 开始游戏，期号：%s，总投入：%s 代币。",
+                     internal_id, period_number, total_bet_amount)
+        if len(confirmation_message) > 2000:
+            return '❌ 确认消息过长，无法发送。请减少投入数量。', game
+        return confirmation_message, game
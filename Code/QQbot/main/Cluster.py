@@ -0,0 +1,725 @@
+# Cluster.py
+
+import asyncio
+import logging
+import multiprocessing
+import pickle
+import signal
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+import yaml
+import botpy
+from botpy.message import Message
+
+from BotCore import BotCore, build_ingress, build_outbox
+from Boss import Boss
+from DataManager import DataManager
+from History import EventKind, HistoryRecord
+from LogPipeline import setup_logging
+from Metrics import Histogram, MetricsRegistry, merge_families
+from RedEnvelope import RedEnvelope
+from Sharding import period_shard, shard_of, split_store
+
+logger = logging.getLogger("Cluster")
+
+FRAME_HEADER = struct.Struct('!I')
+
+
+class ShardLink:
+    """
+    协调进程与分片进程之间的双向链路：长度前缀 + pickle 帧，同一链路上的帧按发送顺序到达。
+    request 等待对端返回结果，notify 只发送不等待。
+    收到的请求调用 target.rpc_<方法名>，各自在独立任务中执行；通知按到达顺序同步调用 target.on_<方法名>。
+    """
+
+    def __init__(self, reader, writer, target, on_close=None):
+        self.reader = reader
+        self.writer = writer
+        self.target = target
+        self.on_close = on_close
+        self._next_id = 0
+        self._waiting = {}
+        self._serving = set()
+        self._task = None
+        # 同一轮事件循环内发出的帧合并为一次写入，减少系统调用
+        self._buffer = []
+
+    def start(self):
+        self._task = asyncio.create_task(self._read_loop())
+
+    def _send(self, frame):
+        payload = pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL)
+        if not self._buffer:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._buffer.append(FRAME_HEADER.pack(len(payload)))
+        self._buffer.append(payload)
+
+    def _flush(self):
+        if self._buffer and not self.writer.is_closing():
+            self.writer.write(b''.join(self._buffer))
+        self._buffer.clear()
+
+    def notify(self, method, *args):
+        self._send(('n', method, args))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def request(self, method, *args):
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[self._next_id] = future
+        self._send(('q', self._next_id, method, args))
+        await self.writer.drain()
+        return await future
+
+    async def _serve(self, request_id, method, args):
+        try:
+            frame = ('r', request_id, True, await getattr(self.target, f"rpc_{method}")(*args))
+        except Exception as e:
+            logger.exception("处理链路请求 %s 时发生错误：%s", method, e)
+            frame = ('r', request_id, False, f"{type(e).__name__}: {e}")
+        if not self.writer.is_closing():
+            self._send(frame)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                frame = pickle.loads(await self.reader.readexactly(FRAME_HEADER.unpack(header)[0]))
+                if frame[0] == 'q':
+                    task = asyncio.create_task(self._serve(*frame[1:]))
+                    self._serving.add(task)
+                    task.add_done_callback(self._serving.discard)
+                elif frame[0] == 'r':
+                    _, request_id, ok, value = frame
+                    future = self._waiting.pop(request_id, None)
+                    if future is not None and not future.done():
+                        if ok:
+                            future.set_result(value)
+                        else:
+                            future.set_exception(RuntimeError(value))
+                else:
+                    _, method, args = frame
+                    try:
+                        getattr(self.target, f"on_{method}")(*args)
+                    except Exception as e:
+                        logger.exception("处理链路通知 %s 时发生错误：%s", method, e)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("链路已断开。"))
+            self._waiting.clear()
+            if self.on_close is not None:
+                self.on_close()
+
+    async def close(self):
+        self._flush()
+        self.writer.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class ShardAuthor:
+    __slots__ = ('id', 'username')
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+
+class ShardMessage:
+    """
+    转发给分片进程的消息：只带处理命令需要的字段，content 已去掉 @机器人 前缀（不是发给机器人的消息为 None）。
+    reply 通过链路把回复交给协调进程，由它用原消息发送。
+    """
+    # 分片进程中由 ShardWorker 设置为通往协调进程的链路
+    link = None
+
+    def __init__(self, key, content, author, channel_id, mentions):
+        self.key = key
+        self.content = content
+        self.author = author
+        self.channel_id = channel_id
+        self.mentions = mentions
+
+    async def reply(self, content=None, **kwargs):
+        self.link.notify('reply', self.key, content, kwargs)
+
+
+class _ReplyCollector:
+    """在分片进程内代替消息对象，收集处理函数的回复后整体返回给请求方。"""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply(self, content=None, **kwargs):
+        self.replies.append(content)
+
+
+class ShardBoss(Boss):
+    """
+    分片进程中的负责人。负责人账户只在其 internal_id 所在的分片（主分片）中，
+    各分片在协调进程分配的额度内预留、结算：收付和负责人历史先记入本分片的待同步流水，
+    由协调进程定期取走、按序号应用到主分片的负责人账户，再按新余额重新分配额度。
+    流水和主分片已应用的序号都随分片数据持久化，崩溃后重放不会重复入账；
+    主分片应用的结果落盘之后协调进程才通知来源分片丢弃流水，不会丢失。
+    """
+
+    def __init__(self, data, user_data, data_manager):
+        super().__init__(data, user_data, data_manager)
+        self.link = None
+        state = self.data["shard"]
+        state.setdefault('boss_pending', [])
+        # 主分片：来源分片 -> 已应用的最大流水序号（JSON 的键只能是字符串）
+        self.applied = dict(state.get('boss_applied', {}))
+        self.seq = max([state.get('boss_seq', 0)] + [entry['s'] for entry in self.pending])
+        self.unsynced = sum(entry['a'] for entry in self.pending)
+        # 协调进程分配的额度，启动后第一次同步前为 0，不能开局
+        self.quota = 0
+        self.drained_reserved = 0
+        # 上次同步以来开局需要的预留（含因额度不足被拒的），协调进程按它分配可用额度
+        self.demand = 0
+        self.remote_profile = None
+
+    @property
+    def pending(self):
+        return self.data["shard"]['boss_pending']
+
+    def available_points(self):
+        return self.quota + self.unsynced - self.reserved
+
+    def profile(self):
+        if self.boss_id in self.user_data:
+            return super().profile()
+        return self.remote_profile
+
+    def reserve(self, user_id, amount):
+        self.demand += amount
+        super().reserve(user_id, amount)
+
+    def _queue(self, amount, history=None):
+        self.seq += 1
+        self.unsynced += amount
+        self.data_manager.append_shard_state('boss_pending', {'s': self.seq, 'b': self.boss_id, 'a': amount, 'h': history})
+
+    def deduct_boss_points(self, amount):
+        if not self.boss_id:
+            raise ValueError("负责人账户不存在。")
+        if amount > self.quota + self.unsynced:
+            raise ValueError("负责人的代币不足。")
+        self._queue(-amount)
+        self.log_history(self.boss_id, EventKind.BOSS_DEDUCT, -amount, "system", role='system')
+        logger.debug("负责人 %s 扣除 %s 代币，待同步：%s 代币", self.boss_id, amount, self.unsynced)
+
+    def add_boss_points(self, amount):
+        if not self.boss_id:
+            raise ValueError("负责人账户不存在。")
+        self._queue(amount)
+        self.log_history(self.boss_id, EventKind.BOSS_ADD, amount, "system", role='system')
+        logger.debug("负责人 %s 增加 %s 代币，待同步：%s 代币", self.boss_id, amount, self.unsynced)
+
+    def log_history(self, user_id, kind, points_change, period_number, bet_amount=None, role='system',
+                    counterparty=None):
+        # 余额在主分片应用时才知道，时间戳按发生时记录
+        self._queue(0, [int(time.time()), int(kind), points_change, period_number, role, bet_amount, counterparty])
+
+    async def handle_boss_command(self, internal_id, action):
+        # 负责人变更要先结清各分片的流水，由协调进程统一处理并广播
+        return await self.link.request('boss_command', internal_id, action)
+
+    def set_boss(self, boss_id):
+        self.boss_id = boss_id
+        self.data["boss_id"] = boss_id
+        self.data_manager.mark_boss()
+        self.quota = 0
+        logger.info("负责人变更为 %s。", boss_id)
+
+    def drain(self):
+        """取出待同步流水，并记下此刻的预留总额与期间的预留需求，额度按它们重新计算。"""
+        self.drained_reserved = self.reserved
+        demand, self.demand = self.demand, 0
+        return list(self.pending), self.reserved, demand
+
+    def ack(self, upto, free, profile):
+        """丢弃已应用到主分片的流水（序号不超过 upto），额度 = 取出时的预留 + 新分到的可用额度。"""
+        remaining = [entry for entry in self.pending if entry['s'] > upto]
+        self.data_manager.set_shard_state('boss_pending', remaining)
+        self.data_manager.set_shard_state('boss_seq', self.seq)
+        self.unsynced = sum(entry['a'] for entry in remaining)
+        self.quota = self.drained_reserved + free
+        self.remote_profile = profile
+
+    async def apply(self, source, entries):
+        """在主分片上按序应用来源分片的流水，跳过已应用过的序号。返回前等待应用结果与已应用序号落盘。"""
+        key = str(source)
+        last = self.applied.get(key, 0)
+        boss_ids = {entry['b'] for entry in entries}
+        async with self.data_manager.locks.acquire(*boss_ids, lock_class='boss-sync'):
+            for entry in entries:
+                if entry['s'] <= last:
+                    continue
+                boss_id = entry['b']
+                if boss_id not in self.user_data:
+                    logger.error("负责人 %s 不在本分片，丢弃来自分片 %s 的流水 %s。",
+                                 boss_id, source, entry['s'])
+                elif entry['h'] is not None:
+                    ts, kind, points_change, period_number, role, bet_amount, counterparty = entry['h']
+                    self.data_manager.append_history(boss_id, HistoryRecord(
+                        ts, EventKind(kind), points_change, self.user_data[boss_id]['points'], role, period_number,
+                        bet_amount=bet_amount, counterparty=counterparty
+                    ))
+                elif entry['a']:
+                    self.data_manager.add_points(boss_id, entry['a'])
+                last = entry['s']
+        self.applied[key] = last
+        self.data_manager.set_shard_state('boss_applied', dict(self.applied))
+        await self.data_manager.sync()
+
+
+class ShardRedEnvelope(RedEnvelope):
+    """
+    分片进程中的红包：红包保存在发送者所在的分片，期号末位即该分片序号（拆分前的旧红包由协调进程记录路由）。
+    领取或撤回其他分片的红包时经协调进程转给红包所在的分片，领取的代币在领取人所在的分片入账。
+    """
+    link = None
+
+    async def take_share(self, internal_id, period_number, mentions, credit=True):
+        if period_number in self.red_envelopes or not credit:
+            return await super().take_share(internal_id, period_number, mentions, credit)
+        # 先在红包所在分片取出一份再入账：两步之间进程崩溃时这一份不会入账，但不会重复领取
+        amount, error = await self.link.request('grab', period_number, internal_id, list(mentions))
+        if amount is not None:
+            async with self.data_manager.locks.acquire(internal_id, lock_class='envelope'):
+                self.data_manager.add_points(internal_id, amount)
+        return amount, error
+
+    async def withdraw_red_envelope(self, message, userid, period_number):
+        if period_number in self.red_envelopes or userid not in self.admins:
+            await super().withdraw_red_envelope(message, userid, period_number)
+            return
+        for content in await self.link.request('withdraw', userid, period_number):
+            await message.reply(content=content)
+
+
+class ShardWorker(BotCore):
+    """分片进程：只加载本分片的数据，处理协调进程转来的消息与跨分片请求。"""
+    boss_class = ShardBoss
+    red_envelope_class = ShardRedEnvelope
+
+    def __init__(self, config, data_manager, index, count):
+        super().__init__(config, data_manager)
+        self.index = index
+        self.count = count
+        self.link = None
+        self.ingress = build_ingress(self.config, self.process_message)
+        self.ingress.register_metrics(self.metrics)
+        self.closed = asyncio.Event()
+        self.finished = False
+
+    def attach(self, link):
+        self.link = link
+        ShardMessage.link = link
+        self.Boss.link = link
+        self.RedEnvelope.link = link
+
+    async def process_message(self, message):
+        try:
+            userid = str(message.author.id)
+            internal_id = await self.data_manager.get_or_create_user(userid, message.author.username)
+            if message.content is not None:
+                await self.dispatch(message, message.content, userid, internal_id)
+        finally:
+            self.link.notify('done', message.key)
+
+    def on_message(self, key, content, userid, username, channel_id, mentions):
+        # 入站队列已满时 submit 会直接回复繁忙，同样需要通知协调进程这条消息已处理完
+        message = ShardMessage(key, content, ShardAuthor(userid, username), channel_id, mentions)
+        asyncio.create_task(self._submit(message))
+
+    async def _submit(self, message):
+        if not await self.ingress.submit(message):
+            self.link.notify('done', message.key)
+
+    async def rpc_hello(self):
+        # 按 userid 散列不到本分片的用户、期号对应不到本分片的红包（拆分前的旧数据）需要协调进程记录路由
+        userids = [userid for userid in self.data["userid_to_internal"] if shard_of(userid, self.count) != self.index]
+        envelopes = [period_number for period_number in self.data["red_envelopes"]
+                     if period_shard(period_number, self.count) != self.index]
+        return {'boss_id': self.Boss.boss_id, 'userids': userids, 'envelopes': envelopes,
+                'users': len(self.user_data)}
+
+    async def rpc_boss_drain(self):
+        return self.Boss.drain()
+
+    async def rpc_boss_apply(self, source, entries):
+        await self.Boss.apply(source, entries)
+
+    async def rpc_boss_profile(self):
+        return self.Boss.profile()
+
+    async def rpc_boss_ack(self, upto, free, profile):
+        self.Boss.ack(upto, free, profile)
+
+    async def rpc_boss_set(self, boss_id):
+        self.Boss.set_boss(boss_id)
+
+    async def rpc_take_share(self, internal_id, period_number, mentions):
+        amount, error = await self.RedEnvelope.take_share(internal_id, period_number, mentions, credit=False)
+        if amount is not None:
+            # 取出的这一份落盘后才交给领取人所在的分片入账
+            await self.data_manager.sync()
+        return amount, error
+
+    async def rpc_withdraw(self, userid, period_number):
+        collector = _ReplyCollector()
+        await RedEnvelope.withdraw_red_envelope(self.RedEnvelope, collector, userid, period_number)
+        return collector.replies
+
+    async def rpc_stats(self):
+        # 赢局的投入不归负责人（奖励按含本金的倍数由负责人支付），核对代币总量时需要扣除
+        win_stakes = None
+        if self.data_manager.storage.history_in_memory:
+            win_stakes = 0
+            for records in self.data["game_history"].values():
+                for record in records:
+                    if record.kind == EventKind.WIN:
+                        win_stakes += record.bet_amount or 0
+                    elif record.kind == EventKind.REFUND:
+                        win_stakes -= record.points_change
+        return {
+            'users': len(self.user_data),
+            'points': sum(user.get('points', 0) for user in self.user_data.values()),
+            'envelope_remaining': sum(sum(e.get('remaining', [])) for e in self.data["red_envelopes"].values()),
+            'active_games': len(self.Gambling.active_games) + len(self.Gambling.settling),
+            'win_stakes': win_stakes,
+            'boss_pending': len(self.Boss.pending),
+            'boss_reserved': self.Boss.reserved,
+            'ingress': dict(self.ingress.stats),
+        }
+
+    async def rpc_metrics(self):
+        return self.metrics.collect()
+
+    async def rpc_stop(self):
+        """停止接收消息：处理完已入队的消息并停止闲置回收，之后的负责人流水由协调进程最后同步一次。"""
+        await self.ingress.close()
+        await self.Gambling.close()
+
+    async def rpc_close(self):
+        await self.data_manager.close()
+        self.finished = True
+        self.closed.set()
+
+
+async def _serve_shard(index, count, sock, config, config_file, data_file):
+    data_manager = DataManager(config_file, data_file, shard=(index, count))
+    data_manager.start()
+    worker = ShardWorker(config, data_manager, index, count)
+    reader, writer = await asyncio.open_connection(sock=sock)
+    # 协调进程意外退出时同样落盘后退出
+    link = ShardLink(reader, writer, worker, on_close=worker.closed.set)
+    worker.attach(link)
+    link.start()
+    worker.ingress.start()
+    worker.Gambling.start()
+    await worker.closed.wait()
+    if not worker.finished:
+        logger.error("与协调进程的链路已断开，保存数据后退出。")
+        await worker.rpc_stop()
+        await data_manager.close()
+    await link.close()
+
+
+def run_shard(index, count, sock, config_file='config.yaml', data_file='data.json'):
+    """分片进程入口。中断信号由协调进程处理，分片进程等待协调进程通知后再关闭。"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    # 分片进程只写自己的日志文件，每条记录带上分片序号
+    log_pipeline = setup_logging(config.get('logging'), f"dwgxbot.shard{index}.log", console=False,
+                                 fields={'shard': index})
+    try:
+        asyncio.run(_serve_shard(index, count, sock, config, config_file, data_file))
+    finally:
+        log_pipeline.close()
+
+
+class Coordinator:
+    """
+    协调进程：按发送者把消息转给所在的分片进程，把分片的回复交给出站队列发送，
+    并处理跨分片的操作——红包领取与撤回、负责人收付同步与额度分配、负责人变更。
+    """
+
+    def __init__(self, config, outbox, config_file='config.yaml', data_file='data.json'):
+        self.config = config
+        self.outbox = outbox
+        self.config_file = config_file
+        self.data_file = data_file
+        shards = self.config.get('shards') or {}
+        self.count = int(shards.get('count', 1))
+        self.sync_interval = float(shards.get('sync_interval', 1.0))
+        # 分片回复时按 key 找回原消息及收到的时间；同轮模式的结果在处理完成后才回复，因此按数量而不是按完成淘汰
+        self.max_messages = int(shards.get('max_messages', 10000))
+        self.messages = OrderedDict()
+        self._next_key = 0
+        self.links = []
+        self.processes = []
+        # 拆分前的旧用户：userid -> 分片序号；其余用户按 userid 散列
+        self.directory = {}
+        # 拆分前的旧红包：期号 -> 分片序号；其余红包按期号末位的节点编号
+        self.envelope_directory = {}
+        self.boss_id = None
+        self.bot_id = None
+        self._sync_lock = asyncio.Lock()
+        # 分配负责人可用额度的比例，初始平分
+        self._weights = [1] * self.count
+        self._sync_task = None
+        self.stats = {
+            'routed': 0,
+            'handled': 0,
+            'replies': 0,
+            'grabs': 0,
+            'boss_syncs': 0,
+            'boss_entries': 0,
+        }
+        # 消息转给分片到分片处理完成的耗时，含链路传输与分片内排队
+        self.shard_seconds = Histogram("shard_seconds")
+        self.metrics = MetricsRegistry()
+        self.metrics.stats('coordinator', "协调进程计数", self.stats)
+        self.metrics.gauge('coordinator_in_flight', "已转给分片但尚未处理完的消息数",
+                           lambda: self.stats['routed'] - self.stats['handled'])
+        self.metrics.histogram('shard_seconds', "消息转给分片到处理完成的耗时（秒）", self.shard_seconds)
+        self.outbox.register_metrics(self.metrics)
+
+    def route(self, userid):
+        return self.directory.get(userid, shard_of(userid, self.count))
+
+    def envelope_route(self, period_number):
+        return self.envelope_directory.get(period_number, period_shard(period_number, self.count))
+
+    async def start(self):
+        persistence = self.config.get('persistence') or {}
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, split_store, persistence, self.data_file, self.count):
+            logger.info("已把现有数据拆分到 %s 个分片。", self.count)
+
+        context = multiprocessing.get_context('spawn')
+        for index in range(self.count):
+            parent, child = socket.socketpair()
+            process = context.Process(target=run_shard, name=f"shard{index}",
+                                      args=(index, self.count, child, self.config_file, self.data_file))
+            process.start()
+            child.close()
+            reader, writer = await asyncio.open_connection(sock=parent)
+            link = ShardLink(reader, writer, self)
+            link.start()
+            self.processes.append(process)
+            self.links.append(link)
+
+        hellos = await asyncio.gather(*(link.request('hello') for link in self.links))
+        for index, hello in enumerate(hellos):
+            for userid in hello['userids']:
+                self.directory[userid] = index
+            for period_number in hello['envelopes']:
+                self.envelope_directory[period_number] = index
+        self.boss_id = hellos[0]['boss_id']
+        if any(hello['boss_id'] != self.boss_id for hello in hellos):
+            # 上次广播负责人变更时中断，以 0 号分片为准
+            logger.warning("各分片记录的负责人不一致，以 0 号分片为准。")
+            await self._broadcast_boss()
+        await self.sync_boss()
+        self._sync_task = asyncio.create_task(self._sync_loop())
+        logger.info("%s 个分片进程已启动，用户 %s 个，"
+                    "旧用户路由 %s 条，旧红包路由 %s 条。",
+                    self.count, sum(hello['users'] for hello in hellos), len(self.directory),
+                    len(self.envelope_directory))
+
+    async def submit(self, message: Message):
+        content = message.content.strip()
+        bot_mention = f"<@!{self.bot_id}>"
+        content = content[len(bot_mention):].strip() if content.startswith(bot_mention) else None
+        userid = str(message.author.id)
+        self._next_key += 1
+        key = self._next_key
+        self.messages[key] = (message, time.perf_counter())
+        if len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+        # 私密红包以 @用户名 指定领取人
+        mentions = [f"@{getattr(user, 'username', user)}" for user in (getattr(message, 'mentions', None) or [])]
+        link = self.links[self.route(userid)]
+        # 只传基本类型，序列化比传对象快得多；分片进程据此重建 ShardMessage
+        link.notify('message', key, content, userid, message.author.username,
+                    getattr(message, 'channel_id', None), mentions)
+        self.stats['routed'] += 1
+        await link.drain()
+
+    def on_reply(self, key, content, kwargs):
+        entry = self.messages.get(key)
+        if entry is None:
+            logger.warning("消息 %s 已过期，丢弃回复：%s", key, content)
+            return
+        message, received = entry
+        self.stats['replies'] += 1
+        self.outbox.send(message, content, received=received, **kwargs)
+
+    def on_done(self, key):
+        self.stats['handled'] += 1
+        entry = self.messages.get(key)
+        if entry is not None:
+            self.shard_seconds.observe(time.perf_counter() - entry[1])
+
+    async def rpc_grab(self, period_number, internal_id, mentions):
+        self.stats['grabs'] += 1
+        return await self.links[self.envelope_route(period_number)].request(
+            'take_share', internal_id, period_number, mentions)
+
+    async def rpc_withdraw(self, userid, period_number):
+        return await self.links[self.envelope_route(period_number)].request('withdraw', userid, period_number)
+
+    async def rpc_boss_command(self, internal_id, action):
+        async with self._sync_lock:
+            # 变更前把各分片的流水结清到原负责人
+            await self._sync()
+            if action == 'become':
+                previous_boss = self.boss_id
+                self.boss_id = internal_id
+                await self._broadcast_boss()
+                await self._sync()
+                logger.info("用户 %s 成为新的负责人。", internal_id)
+                if previous_boss and previous_boss != internal_id:
+                    return "✅ 您已成为新的负责人。"
+                return "✅ 您已成功成为负责人。"
+            elif action == 'leave':
+                if self.boss_id and self.boss_id == internal_id:
+                    self.boss_id = None
+                    await self._broadcast_boss()
+                    await self._sync()
+                    logger.info("用户 %s 离开了负责人职位。", internal_id)
+                    return "✅ 您已成功离开负责人职位。"
+                return "❌ 您当前不是负责人。"
+            return "❓ 无效的操作。"
+
+    async def _broadcast_boss(self):
+        await asyncio.gather(*(link.request('boss_set', self.boss_id) for link in self.links))
+
+    async def sync_boss(self):
+        async with self._sync_lock:
+            await self._sync()
+
+    async def _sync(self):
+        """
+        取走各分片的负责人流水并应用到负责人所在的主分片，然后按新余额分配额度：
+        每个分片的额度 = 它的预留 + 按需求分到的剩余可用代币，各分片额度之和不超过负责人余额。
+        """
+        drains = await asyncio.gather(*(link.request('boss_drain') for link in self.links))
+        for source, (entries, _, _) in enumerate(drains):
+            batches = {}
+            for entry in entries:
+                batches.setdefault(shard_of(entry['b'], self.count), []).append(entry)
+            for home, batch in batches.items():
+                await self.links[home].request('boss_apply', source, batch)
+            self.stats['boss_entries'] += len(entries)
+
+        profile = None
+        home = 0
+        if self.boss_id:
+            home = shard_of(self.boss_id, self.count)
+            profile = await self.links[home].request('boss_profile')
+        balance = profile['points'] if profile else 0
+        free = max(0, balance - sum(reserved for _, reserved, _ in drains))
+        # 按上个周期各分片的预留需求分配；这个周期都没有开局时沿用上次的比例，取整余下的部分给主分片
+        demands = [demand for _, _, demand in drains]
+        if sum(demands):
+            self._weights = demands
+        total_weight = sum(self._weights)
+        shares = [free * weight // total_weight for weight in self._weights]
+        shares[home] += free - sum(shares)
+        await asyncio.gather(*(
+            link.request('boss_ack', entries[-1]['s'] if entries else 0, shares[index], profile)
+            for index, (link, (entries, _, _)) in enumerate(zip(self.links, drains))
+        ))
+        self.stats['boss_syncs'] += 1
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync_boss()
+            except Exception:
+                logger.exception("同步负责人流水时发生错误。")
+
+    async def collect_metrics(self):
+        """本进程的指标加上各分片的指标，分片的指标附加 shard 标签。"""
+        shards = await asyncio.gather(*(link.request('metrics') for link in self.links))
+        groups = [((), self.metrics.collect())]
+        groups.extend(((('shard', index),), families) for index, families in enumerate(shards))
+        return merge_families(groups)
+
+    def metrics_summary(self):
+        return (f"指标摘要：转发消息 {self.stats['routed']} 条，在途 {self.stats['routed'] - self.stats['handled']} 条，"
+                f"分片处理 P99 {self.shard_seconds.quantile(0.99)} 秒，"
+                f"回复往返 P99 {self.outbox.reply_seconds.quantile(0.99)} 秒，"
+                f"跨分片领取红包 {self.stats['grabs']} 次，负责人同步 {self.stats['boss_syncs']} 次。")
+
+    async def shard_stats(self):
+        return await asyncio.gather(*(link.request('stats') for link in self.links))
+
+    async def close(self):
+        """各分片处理完已入队的消息后最后同步一次负责人流水，再落盘退出。"""
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+        await asyncio.gather(*(link.request('stop') for link in self.links))
+        try:
+            await self.sync_boss()
+        except Exception:
+            logger.exception("关闭前同步负责人流水失败，流水已持久化，下次启动时同步。")
+        await asyncio.gather(*(link.request('close') for link in self.links))
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, 30)
+        for link in self.links:
+            await link.close()
+        logger.info("协调进程已关闭，转发 %s 条消息，跨分片领取红包 %s 次，"
+                    "同步负责人流水 %s 条。",
+                    self.stats['routed'], self.stats['grabs'], self.stats['boss_entries'])
+
+
+class ShardedBot(botpy.Client):
+    """分片部署的网关进程：只收发消息，命令由 Coordinator 转给各分片进程处理。"""
+
+    def __init__(self, config, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config = config
+        self.outbox = build_outbox(self.config)
+        self.coordinator = Coordinator(self.config, self.outbox)
+
+    async def on_ready(self):
+        try:
+            bot_user = await self.api.me()
+            self.coordinator.bot_id = bot_user['id']
+            logger.info("机器人 ID: %s", bot_user['id'])
+        except Exception as e:
+            logger.exception("获取机器人信息时出错: %s", e)
+
+    async def on_at_message_create(self, message: Message):
+        if self.coordinator.bot_id is None:
+            await self.on_ready()
+            if self.coordinator.bot_id is None:
+                await self.outbox.wrap(message).reply(content='❌ 无法获取机器人的信息，请稍后再试。')
+                return
+        await self.coordinator.submit(message)
@@ -0,0 +1,44 @@
+# Commands.py
+
+import logging
+
+logger = logging.getLogger("Commands")
+
+
+class CommandContext:
+    """一条命令消息解析后的上下文，在各处理函数间传递。"""
+    __slots__ = ('content', 'parts', 'userid', 'internal_id')
+
+    def __init__(self, content, parts, userid, internal_id):
+        self.content = content
+        self.parts = parts
+        self.userid = userid
+        self.internal_id = internal_id
+
+
+class CommandRouter:
+    """
+    命令路由表：别名（小写）-> 处理函数，启动时构建一次，每条消息只做一次字典查询。
+    处理函数签名为 async def handler(message, ctx)。
+    """
+
+    def __init__(self):
+        self._handlers = {}
+
+    def register(self, aliases, handler):
+        for alias in aliases:
+            key = alias.lower()
+            if key in self._handlers:
+                raise ValueError(f"命令 {alias} 重复注册。")
+            self._handlers[key] = handler
+
+    def register_all(self, owner, table):
+        """按 {处理方法名: 别名元组} 表注册 owner 上的处理方法。"""
+        for method_name, aliases in table.items():
+            self.register(aliases, getattr(owner, method_name))
+
+    def resolve(self, command):
+        return self._handlers.get(command.lower())
+
+    def aliases(self):
+        return list(self._handlers)
@@ -1,117 +1,455 @@
 # DataManager.py
 
-import json
+import copy
 import os
+import time
 import yaml
 import asyncio
 import logging
 import string
 import random
 
-logger = logging.getLogger("DataManager")
-
+from IdService import IdService
+from Locks import LockManager
+from Metrics import Histogram
+from Sharding import shard_file, shard_of, shard_persistence
+from Storage import create_storage, replace_sets
+from UserStats import init_stats
 
-def replace_sets(obj):
-    if isinstance(obj, set):
-        return list(obj)
-    elif isinstance(obj, dict):
-        return {k: replace_sets(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [replace_sets(item) for item in obj]
-    else:
-        return obj
+logger = logging.getLogger("DataManager")
 
 
 class DataManager:
-    def __init__(self, config_file='config.yaml', data_file='data.json'):
+    def __init__(self, config_file='config.yaml', data_file='data.json', shard=None):
         self.config_file = config_file
         self.data_file = data_file
+        # 分片部署时为 (分片序号, 分片数)：只加载本分片的数据，新用户的 internal_id 落在本分片
+        self.shard = shard
         self.data = None
-        self.data_lock = asyncio.Lock()
+        # 按用户分段的锁，替代原来的全局 data_lock
+        self.locks = LockManager()
+
+        # 写回（write-behind）状态：保存请求只标记脏数据，由后台任务合并落盘
+        self.dirty_count = 0
+        self.flush_interval = 2.0
+        self.flush_threshold = 100
+        self.stats = {
+            'save_requested': 0,
+            'save_performed': 0,
+            'journal_records': 0,
+            'compactions': 0,
+            'user_lookup_fast': 0,
+            'user_created': 0,
+            'archived_records': 0,
+            # 保存时事件循环被阻塞的时间（只包含生成快照/收集记录，序列化与写盘在工作线程中）
+            'loop_blocked_ms_last': 0.0,
+            'loop_blocked_ms_max': 0.0,
+            'loop_blocked_ms_total': 0.0,
+        }
+        # 写入 journal（含工作线程中的序列化与写盘）与生成快照的耗时
+        self.save_seconds = Histogram("data_save_seconds")
+        self.compact_seconds = Histogram("data_compact_seconds")
+        self._flush_event = asyncio.Event()
+        self._flusher_task = None
+        # 保证变更记录按序号顺序写入后端；不影响其他协程读写内存数据
+        self._write_lock = asyncio.Lock()
+
+        # 变更记录：每次变更只向存储后端追加一条紧凑记录，完整快照由后台定期压缩生成
+        self.persistence = {}
+        self.storage = None
+        self.journal_seq = 0
+        self.compact_threshold = 5000
+        self.compact_interval = 600.0
+        # 每个用户常驻内存的最近历史条数，更早的记录在压缩时移入磁盘归档段
+        self.history_window = 200
+        self._last_compact = time.monotonic()
+        self._compacting = False
+        self._compact_task = None
+        self._snapshot_requested = False
+        self._dirty_users = set()
+        self._dirty_envelopes = set()
+        self._boss_dirty = False
+        self._watermark_dirty = False
+        self._dirty_games = set()
+        self._dirty_shard_keys = set()
+        self._pending_records = []
+
+        # 期号生成器的节点编号，多个进程共用同一份数据时各自配置不同的值
+        self.node_id = 0
+
         self.load_config()
         self.load_data()
+        try:
+            self.ids = IdService(node=self.node_id, watermark=self.data["id_watermark"])
+        except ValueError as e:
+            logger.error("配置项 ids.node 无效：%s", e)
+            exit(1)
 
     def load_config(self):
         if not os.path.exists(self.config_file):
-            logger.error(f"配置文件 {self.config_file} 不存在。请创建并填写 appid 和 secret。")
+            logger.error("配置文件 %s 不存在。请创建并填写 appid 和 secret。", self.config_file)
             exit(1)
         with open(self.config_file, 'r', encoding='utf-8') as f:
             config = yaml.safe_load(f)
         self.appid = config.get('appid')
         self.secret = config.get('secret')
         if not self.appid or not self.secret:
-            logger.error(f"配置文件 {self.config_file} 缺少 appid 或 secret。请填写完整。")
+            logger.error("配置文件 %s 缺少 appid 或 secret。请填写完整。", self.config_file)
+            exit(1)
+
+        self.persistence = config.get('persistence') or {}
+        self.flush_interval = float(self.persistence.get('flush_interval', self.flush_interval))
+        self.flush_threshold = int(self.persistence.get('flush_threshold', self.flush_threshold))
+        self.compact_threshold = int(self.persistence.get('compact_threshold', self.compact_threshold))
+        self.compact_interval = float(self.persistence.get('compact_interval', self.compact_interval))
+        self.history_window = int(self.persistence.get('history_window', self.history_window))
+        if self.history_window < 1:
+            logger.error("配置项 persistence.history_window 无效：%s，至少为 1。", self.history_window)
             exit(1)
+        self.node_id = int((config.get('ids') or {}).get('node', self.node_id))
+        if self.shard is not None:
+            # 分片序号即期号的节点编号，协调进程据此把红包期号路由到所在分片
+            index, _ = self.shard
+            self.node_id = index
+            self.data_file = shard_file(self.data_file, index)
+            self.persistence = shard_persistence(self.persistence, index)
 
     def load_data(self):
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
-                self.data.setdefault("boss_id", None)
-                self.data.setdefault("user_data", {})
-                self.data.setdefault("game_history", {})
-                self.data.setdefault("red_envelopes", {})
-                self.data["game_history"].setdefault("period_numbers", set())
-                self.data.setdefault("internal_to_userid", {})
-                self.data.setdefault("userid_to_internal", {})
-
-                if isinstance(self.data["game_history"].get("period_numbers"), list):
-                    self.data["game_history"]["period_numbers"] = set(self.data["game_history"]["period_numbers"])
-                logger.info("数据文件加载成功。")
-            except json.JSONDecodeError:
-                logger.error(f"{self.data_file} 格式错误，重新初始化。")
-                self.data = {
-                    "boss_id": None,
-                    "user_data": {},
-                    "game_history": {
-                        "period_numbers": set()
-                    },
-                    "red_envelopes": {},
-                    "internal_to_userid": {},
-                    "userid_to_internal": {}
-                }
-                # 同步保存初始化数据
-                self._sync_save_data()
+        self.storage = create_storage(self.persistence, self.data_file)
+        try:
+            self.data, self.journal_seq = self.storage.load()
+        except ValueError as e:
+            # 数据损坏时拒绝启动，避免用空数据覆盖所有人的余额
+            logger.error("加载数据失败：%s", e)
+            exit(1)
+
+    def _snapshot_copy(self):
+        """
+        在事件循环上生成不可变快照。只复制会被原地修改的容器（用户、红包、映射），
+        历史记录写入后不再修改，列表浅拷贝即可；序列化留给工作线程。
+        """
+        data = self.data
+        game_history = {k: list(v) for k, v in data["game_history"].items()}
+        red_envelopes = {}
+        for period_number, envelope in data["red_envelopes"].items():
+            envelope = dict(envelope)
+            envelope['remaining'] = list(envelope.get('remaining', []))
+            envelope['received'] = dict(envelope.get('received', {}))
+            red_envelopes[period_number] = envelope
+        return {
+            "boss_id": data["boss_id"],
+            "user_data": {k: dict(v) for k, v in data["user_data"].items()},
+            "game_history": game_history,
+            "red_envelopes": red_envelopes,
+            "internal_to_userid": dict(data["internal_to_userid"]),
+            "userid_to_internal": dict(data["userid_to_internal"]),
+            "history_archive": {k: list(v) for k, v in data["history_archive"].items()},
+            # 游戏状态每次检查点都整体替换，不会原地修改
+            "active_games": dict(data["active_games"]),
+            "id_watermark": data["id_watermark"],
+            "shard": {k: copy.copy(v) for k, v in data["shard"].items()},
+            "_journal_seq": self.journal_seq,
+        }
+
+    def _record_blocked(self, started):
+        blocked_ms = (time.perf_counter() - started) * 1000
+        self.stats['loop_blocked_ms_last'] = blocked_ms
+        self.stats['loop_blocked_ms_total'] += blocked_ms
+        if blocked_ms > self.stats['loop_blocked_ms_max']:
+            self.stats['loop_blocked_ms_max'] = blocked_ms
+
+    def _note_change(self):
+        self.stats['save_requested'] += 1
+        self.dirty_count += 1
+        if self.dirty_count >= self.flush_threshold:
+            self._flush_event.set()
+
+    def flush_soon(self):
+        """让后台任务尽快刷新，用于一次完成多项修改（如批量结算）之后。"""
+        self._flush_event.set()
+
+    def mark_user(self, internal_id):
+        self._dirty_users.add(internal_id)
+        self._note_change()
+
+    def mark_envelope(self, period_number):
+        self._dirty_envelopes.add(period_number)
+        self._note_change()
+
+    def mark_boss(self):
+        self._boss_dirty = True
+        self._note_change()
+
+    def set_game(self, internal_id, state):
+        """登记进行中游戏的检查点，state 为 None 表示游戏已结束。同一次刷新内多次修改只写最后一次。"""
+        if state is None:
+            self.data["active_games"].pop(internal_id, None)
         else:
-            self.data = {
-                "boss_id": None,
-                "user_data": {},
-                "game_history": {
-                    "period_numbers": set()
-                },
-                "red_envelopes": {},
-                "internal_to_userid": {},
-                "userid_to_internal": {}
-            }
-            self._sync_save_data()
-            logger.info("未找到数据文件，初始化为空。")
-
-    def _sync_save_data(self):
-        data_copy = replace_sets(self.data.copy())
-        with open(self.data_file, 'w', encoding='utf-8') as f:
-            json.dump(data_copy, f, ensure_ascii=False, indent=4)
-        logger.info("数据文件同步保存成功。")
-
-    async def save_data(self):
-        async with self.data_lock:
+            self.data["active_games"][internal_id] = state
+        self._dirty_games.add(internal_id)
+        self._note_change()
+
+    def set_shard_state(self, key, value):
+        """整体替换一项分片状态，刷新时写入当时的值。"""
+        self.data["shard"][key] = value
+        self._dirty_shard_keys.add(key)
+        self._note_change()
+
+    def append_shard_state(self, key, item):
+        """向列表型分片状态追加一个元素，只写入这个元素。"""
+        self.data["shard"].setdefault(key, []).append(item)
+        self._pending_records.append({'o': 'q', 'i': key, 'v': item})
+        self._note_change()
+
+    def add_points(self, internal_id, amount):
+        user = self.data["user_data"][internal_id]
+        user['points'] += amount
+        self.mark_user(internal_id)
+        return user['points']
+
+    def append_history(self, internal_id, record):
+        if self.storage.history_in_memory:
+            self.data["game_history"].setdefault(internal_id, []).append(record)
+        self._pending_records.append({'o': 'h', 'i': internal_id, 'v': record})
+        self._note_change()
+
+    async def get_history(self, internal_id, include_archive=True):
+        """
+        返回用户的历史记录（由旧到新）。内存中只有最近的记录，
+        include_archive 为 True 时再从磁盘归档段读取更早的部分。
+        """
+        if self.storage.history_in_memory:
+            recent = list(self.data["game_history"].get(internal_id, []))
+            segments = list(self.data["history_archive"].get(internal_id, []))
+            if not include_archive or not segments:
+                return recent
+            # 归档段只在持有写锁时生成，持锁读取可避免读到尚未落盘的段
+            async with self._write_lock:
+                loop = asyncio.get_running_loop()
+                archived = await loop.run_in_executor(None, self.storage.read_archive, internal_id, segments)
+            return archived + recent
+        # 持有写锁时后端中不会有正在写入的记录，查询在工作线程中执行
+        async with self._write_lock:
+            loop = asyncio.get_running_loop()
+            history = await loop.run_in_executor(None, self.storage.load_history, internal_id)
+        # 尚未刷新到后端的记录
+        history.extend(r['v'] for r in self._pending_records if r['o'] == 'h' and r['i'] == internal_id)
+        return history
+
+    def next_period_number(self):
+        """签发一个新期号。只持久化水位线，同一次刷新内签发多个期号只写最后一个。"""
+        period_number = self.ids.next_id()
+        self.data["id_watermark"] = period_number
+        self._watermark_dirty = True
+        self._note_change()
+        return period_number
+
+    def _collect_records(self):
+        records = self._pending_records
+        self._pending_records = []
+        user_data = self.data["user_data"]
+        for internal_id in self._dirty_users:
+            if internal_id in user_data:
+                records.append({'o': 'u', 'i': internal_id, 'v': dict(user_data[internal_id])})
+        self._dirty_users.clear()
+        red_envelopes = self.data["red_envelopes"]
+        for period_number in self._dirty_envelopes:
+            envelope = red_envelopes.get(period_number)
+            records.append({'o': 'e', 'i': period_number, 'v': replace_sets(envelope)})
+        self._dirty_envelopes.clear()
+        if self._boss_dirty:
+            records.append({'o': 'b', 'v': self.data["boss_id"]})
+            self._boss_dirty = False
+        if self._watermark_dirty:
+            records.append({'o': 'p', 'v': self.data["id_watermark"]})
+            self._watermark_dirty = False
+        active_games = self.data["active_games"]
+        for internal_id in self._dirty_games:
+            records.append({'o': 'g', 'i': internal_id, 'v': active_games.get(internal_id)})
+        self._dirty_games.clear()
+        # 在追加记录之后写入：同一次刷新内先追加后替换时以替换后的值为准
+        shard_state = self.data["shard"]
+        for key in self._dirty_shard_keys:
+            records.append({'o': 'k', 'i': key, 'v': copy.copy(shard_state.get(key))})
+        self._dirty_shard_keys.clear()
+        for record in records:
+            # 上次写入失败后放回的记录保留原序号，重试时即使上次其实已经落盘也不会被重放两次
+            if 's' not in record:
+                self.journal_seq += 1
+                record['s'] = self.journal_seq
+        return records
+
+    async def _write_journal(self):
+        """把待写记录追加到存储后端，调用方需持有 _write_lock。写入失败时返回 False。"""
+        if not self.dirty_count:
+            return True
+        started = time.perf_counter()
+        merged = self.dirty_count
+        self.dirty_count = 0
+        records = self._collect_records()
+        self._record_blocked(started)
+        try:
+            if records:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.storage.append, records)
+                self.stats['journal_records'] += len(records)
+            self.stats['save_performed'] += 1
+            self.save_seconds.observe(time.perf_counter() - started)
+            logger.debug("journal 追加 %s 条记录，合并了 %s 次保存请求。", len(records), merged)
+            return True
+        except Exception:
+            # 记录放回待写队列的最前面，下一次刷新时重试；SQLite 的历史记录不在快照中，不能丢弃。
+            # journal 末尾可能留下半行，之后追加的内容重放时读不到，因此同时请求一次快照
+            self._pending_records[:0] = records
+            self.dirty_count += merged
+            self._snapshot_requested = True
+            logger.exception("写入 journal 时发生错误。")
+            return False
+
+    async def flush(self):
+        if self.dirty_count:
+            async with self._write_lock:
+                await self._write_journal()
+
+        due = self.storage.has_pending() and time.monotonic() - self._last_compact >= self.compact_interval
+        if self._snapshot_requested or self.storage.needs_compaction(self.compact_threshold) or due:
+            if not self._compacting:
+                self._compact_task = asyncio.create_task(self.compact())
+
+    async def sync(self):
+        """
+        等到此前的全部修改都写入存储后端后返回，写入失败时抛出 RuntimeError。
+        与 flush 不同，后台任务正在写入时也会等它完成；跨分片操作在通知对方之前调用。
+        """
+        async with self._write_lock:
+            if not await self._write_journal():
+                raise RuntimeError("写入 journal 失败。")
+
+    async def compact(self):
+        """
+        生成完整快照并丢弃快照已包含的 journal。写快照时不阻塞新的 journal 追加。
+        后端不需要快照时（SQLite）只把待写记录落盘并整理存储。
+        """
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            loop = asyncio.get_running_loop()
+            async with self._write_lock:
+                # 先把内存中的待写记录落入 journal，保证快照序号之后不会重复重放；
+                # 写入失败时这些记录仍在待写队列中，快照序号会越过它们，因此放弃本次压缩
+                if not await self._write_journal():
+                    raise RuntimeError("写入 journal 失败，本次不生成快照。")
+                if self.storage.history_in_memory:
+                    await self._archive_history()
+                started = time.perf_counter()
+                self._snapshot_requested = False
+                journal_seq = self.journal_seq
+                data_copy = None
+                if self.storage.snapshot_on_compaction:
+                    data_copy = self._snapshot_copy()
+                    self._record_blocked(started)
+                    await loop.run_in_executor(None, self.storage.begin_compaction)
+            if data_copy is not None:
+                await loop.run_in_executor(None, self.storage.write_snapshot, data_copy)
+            await loop.run_in_executor(None, self.storage.end_compaction)
+            self.stats['compactions'] += 1
+            self.compact_seconds.observe(time.perf_counter() - started)
+            logger.info("快照压缩完成，journal 序号：%s", journal_seq)
+        except Exception:
+            self._snapshot_requested = True
+            logger.exception("生成数据快照时发生错误。")
+        finally:
+            self._last_compact = time.monotonic()
+            self._compacting = False
+
+    async def _archive_history(self):
+        """
+        把超出内存窗口的旧历史写入归档段，成功后才从内存移除并登记到 history_archive。
+        调用方需持有 _write_lock。之后的快照不再包含这些记录，但会引用对应的段文件。
+        段文件名带上该用户已有的段数：两次压缩之间没有新的 journal 记录时也不会覆盖已登记的段。
+        """
+        batches = []
+        history_archive = self.data["history_archive"]
+        for internal_id, records in self.data["game_history"].items():
+            count = len(records) - self.history_window
+            if count <= 0 or len(records) < 2 * self.history_window:
+                continue
+            segment = f"{self.journal_seq:012d}-{len(history_archive.get(internal_id, [])):06d}.jsonl.gz"
+            batches.append((internal_id, segment, records[:count]))
+        if not batches:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.storage.write_archive, batches)
+        # 写入期间新记录只会追加在列表末尾，按条数从头部移除是安全的
+        for internal_id, segment, records in batches:
+            del self.data["game_history"][internal_id][:len(records)]
+            history_archive.setdefault(internal_id, []).append(segment)
+            self.stats['archived_records'] += len(records)
+        logger.info("已归档 %s 个用户的早期历史记录。", len(batches))
+
+    async def _flush_loop(self):
+        while True:
             try:
-                data_copy = replace_sets(self.data.copy())
-                with open(self.data_file, 'w', encoding='utf-8') as f:
-                    json.dump(data_copy, f, ensure_ascii=False, indent=4)
-                logger.info("数据文件保存成功。")
-            except Exception:
-                logger.exception("保存数据文件时发生错误。")
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    def start(self):
+        if self._flusher_task is None:
+            self._flusher_task = asyncio.create_task(self._flush_loop())
+            logger.info("后台保存任务已启动，间隔 %s 秒，阈值 %s 次。",
+                        self.flush_interval, self.flush_threshold)
+
+    async def close(self):
+        if self._flusher_task is not None:
+            self._flusher_task.cancel()
+            try:
+                await self._flusher_task
+            except asyncio.CancelledError:
+                pass
+            self._flusher_task = None
+        await self.flush()
+        if self._compact_task is not None:
+            await self._compact_task
+        # 关闭前压缩一次，下次启动无需重放 journal
+        await self.compact()
+        self.storage.close()
+        logger.info("数据管理器已关闭，保存请求 %s 次，"
+                    "实际写盘 %s 次。",
+                    self.stats['save_requested'], self.stats['save_performed'])
+
+    def register_metrics(self, registry):
+        registry.stats('data_manager', "数据管理器计数", self.stats)
+        registry.histogram('data_save_seconds', "写入一批 journal 记录的耗时（秒）", self.save_seconds)
+        registry.histogram('data_compact_seconds', "生成一次完整快照的耗时（秒）", self.compact_seconds)
+        registry.histograms('lock_wait_seconds', "等待用户锁的耗时（秒）", 'lock_class', self.locks.wait_histograms)
+        registry.gauge('users', "用户数", lambda: len(self.data["user_data"]))
+        registry.gauge('save_pending', "尚未落盘的保存请求数", lambda: self.dirty_count)
+
+    def resolve_user(self, userid):
+        """已知用户的无锁快速查询，未注册时返回 None。"""
+        return self.data["userid_to_internal"].get(userid)
 
     async def get_or_create_user(self, userid, username):
-        async with self.data_lock:
+        # 快速路径：已有用户只做一次字典查询，不获取任何锁
+        internal_id = self.data["userid_to_internal"].get(userid)
+        if internal_id is not None:
+            self.stats['user_lookup_fast'] += 1
+            return internal_id
+        async with self.locks.acquire(f"userid:{userid}", lock_class='registry'):
             if userid not in self.data.get("userid_to_internal", {}):
                 internal_id = self.generate_internal_id()
                 self.data["user_data"][internal_id] = {'userid': userid, 'username': username, 'points': 1000}
+                init_stats(self.data["user_data"][internal_id])
                 self.data["internal_to_userid"][internal_id] = userid
                 self.data["userid_to_internal"][userid] = internal_id
-                await self.save_data()
-                logger.info(f"创建新用户 {internal_id} - {username} (User ID: {userid})，初始代币：1000")
+                self.mark_user(internal_id)
+                self.stats['user_created'] += 1
+                logger.info("创建新用户 %s - %s (User ID: %s)，初始代币：1000",
+                            internal_id, username, userid)
             return self.data["userid_to_internal"][userid]
 
     def get_username(self, internal_id):
@@ -123,5 +461,7 @@ class DataManager:
     def generate_internal_id(self):
         while True:
             internal_id = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
+            if self.shard is not None and shard_of(internal_id, self.shard[1]) != self.shard[0]:
+                continue
             if internal_id not in self.data.get("user_data", {}):
                 return internal_id
@@ -0,0 +1,84 @@
+# DiceRng.py
+# 骰子随机数服务：从操作系统 CSPRNG 批量取字节放入缓冲池，按拒绝采样映射为 1~6，避免取模偏差。
+# 承诺-揭示（commit-reveal）模式下，每期开局时生成种子并公布其 SHA-256，结算时公布种子，
+# 任何人都可以验证种子与承诺一致、骰子由种子确定：
+#   python DiceRng.py <种子> <承诺> [骰子数]
+
+import hashlib
+import os
+import secrets
+import sys
+
+# 256 以内最大的 6 的倍数；不小于它的字节直接丢弃，使六个点数等概率
+REJECT_LIMIT = 252
+SEED_BYTES = 32
+
+
+def commitment_of(seed_hex):
+    return hashlib.sha256(bytes.fromhex(seed_hex)).hexdigest()
+
+
+def dice_from_seed(seed_hex, count=3):
+    """由种子确定性地导出骰子：依次取 SHA-256(种子 || 计数器) 的字节做拒绝采样。"""
+    seed = bytes.fromhex(seed_hex)
+    dice = []
+    counter = 0
+    while len(dice) < count:
+        block = hashlib.sha256(seed + counter.to_bytes(4, 'big')).digest()
+        counter += 1
+        for byte in block:
+            if byte < REJECT_LIMIT:
+                dice.append(byte % 6 + 1)
+                if len(dice) == count:
+                    break
+    return dice
+
+
+class DiceRng:
+    def __init__(self, pool_size=4096, commit_reveal=False):
+        self.pool_size = pool_size
+        self.commit_reveal = commit_reveal
+        self.refills = 0
+        self._buffer = b''
+        self._pos = 0
+        self._refill()
+
+    def _refill(self):
+        self._buffer = os.urandom(self.pool_size)
+        self._pos = 0
+        self.refills += 1
+
+    def roll(self, count=1):
+        dice = []
+        while len(dice) < count:
+            if self._pos >= len(self._buffer):
+                self._refill()
+            byte = self._buffer[self._pos]
+            self._pos += 1
+            if byte < REJECT_LIMIT:
+                dice.append(byte % 6 + 1)
+        return dice
+
+    def new_commitment(self):
+        """生成一期的种子，返回 (种子, 承诺)。种子在结算前保密。"""
+        seed_hex = secrets.token_hex(SEED_BYTES)
+        return seed_hex, commitment_of(seed_hex)
+
+    def roll_for_game(self, game, count):
+        """为一局游戏摇接下来的 count 颗骰子；带种子的游戏由种子决定，否则从缓冲池抽取。"""
+        seed_hex = game.get('seed')
+        if not seed_hex:
+            return self.roll(count)
+        start = len(game['dice_rolls'])
+        return dice_from_seed(seed_hex, start + count)[start:]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("用法：python DiceRng.py <种子> <承诺> [骰子数]")
+        sys.exit(2)
+    seed_arg, commitment_arg = sys.argv[1], sys.argv[2]
+    count_arg = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    matches = commitment_of(seed_arg) == commitment_arg
+    print(f"承诺{'一致' if matches else '不一致'}，骰子：{dice_from_seed(seed_arg, count_arg)}")
+    sys.exit(0 if matches else 1)
@@ -2,22 +2,103 @@
 
 import asyncio
 import logging
-import random
 import re
 import time
-from datetime import datetime
 from botpy.message import Message
-from botpy.errors import ServerError
+
+from DiceRng import DiceRng, dice_from_seed
+from History import EventKind, HistoryRecord
+from Metrics import Histogram
+from Payouts import PayoutTable, bet_wins
+from TimerWheel import TimerWheel
+from UserStats import record_cancel, record_settle
 
 logger = logging.getLogger("Gambling")
 
+# 投入语法：'双', '单', '大', '小' 及其简写，或 '数字y金额'，如 "双100"、"单200"、"7y300"
+BET_PATTERN = re.compile(
+    r"(?P<type>双|单|大|小|s|dan|da|x|(?P<number>[3-9]|1[0-8]))(?:y)?(?P<amount>\d+)",
+    re.IGNORECASE
+)
+BET_TYPE_ALIASES = {
+    '双': '双',
+    '单': '单',
+    's': '双',
+    'dan': '单',
+    'da': '大',
+    'x': '小',
+    '大': '大',
+    '小': '小',
+}
+VALID_BET_TYPES = frozenset(['双', '单', '大', '小', '3', '4', '5', '6', '7', '8', '9', '10',
+                             '11', '12', '13', '14', '15', '16', '17', '18'])
+
+BET_MULTIPLIERS = {
+    '双': 2.9,
+    '单': 2.9,
+    '大': 1.97,
+    '小': 1.97,
+    '3': 6.9,
+    '4': 6.9,
+    '5': 6.9,
+    '6': 6.9,
+    '7': 6.9,
+    '8': 6.9,
+    '9': 6.9,
+    '10': 6.9,
+    '11': 6.9,
+    '12': 6.9,
+    '13': 6.9,
+    '14': 6.9,
+    '15': 6.9,
+    '16': 6.9,
+    '17': 6.9,
+    '18': 6.9
+}
+
+
+def parse_bets(content: str):
+    matches = BET_PATTERN.findall(content)
+    bets = []
+
+    for match in matches:
+        bet_type_raw, number, bet_amount_str = match
+        if number:
+            # 处理数字投入
+            bet_type = number
+        else:
+            bet_type = BET_TYPE_ALIASES.get(bet_type_raw.lower(), bet_type_raw)
+
+        if bet_type not in VALID_BET_TYPES:
+            logger.warning("无效的投入类型：%s", bet_type)
+            continue  # 跳过无效的投入类型
+
+        try:
+            bet_amount = int(bet_amount_str)
+            if bet_amount <= 0:
+                logger.warning("无效的投入金额：%s", bet_amount)
+                continue
+            bets.append({'type': bet_type, 'amount': bet_amount})
+        except ValueError:
+            logger.warning("无法解析的投入金额：%s", bet_amount_str)
+            continue
+    logger.debug("解析投入: %s", bets)
+    return bets
+
 
 class Gambling:
-    def __init__(self, user_data, game_history, save_data, boss=None):
+    # 闲置游戏的处理方式
+    IDLE_ACTIONS = ('refund', 'roll')
+
+    def __init__(self, user_data, game_history, data_manager, boss=None, round_window=0, rng=None,
+                 idle_ttl=0, idle_action='refund'):
         self.user_data = user_data
         self.game_history = game_history
-        self._save_data = save_data
+        self.data_manager = data_manager
         self.active_games = {}
+        # 骰子已摇完、等待结算的游戏：已移出 active_games，避免并发的命令重复结算；
+        # 检查点保留到结算时，与余额、历史在同一次刷新中删除
+        self.settling = {}
         self.boss = boss
         self.DICE_EMOJI = {
             1: '🎲1️⃣',
@@ -28,130 +109,160 @@ class Gambling:
             6: '🎲6️⃣'
         }
 
-        self.bet_multipliers = {
-            '双': 2.9,
-            '单': 2.9,
-            '大': 1.97,
-            '小': 1.97,
-            '3': 6.9,
-            '4': 6.9,
-            '5': 6.9,
-            '6': 6.9,
-            '7': 6.9,
-            '8': 6.9,
-            '9': 6.9,
-            '10': 6.9,
-            '11': 6.9,
-            '12': 6.9,
-            '13': 6.9,
-            '14': 6.9,
-            '15': 6.9,
-            '16': 6.9,
-            '17': 6.9,
-            '18': 6.9
-        }
+        self.bet_multipliers = BET_MULTIPLIERS
+        # 每种投入类型在各点数下的倍数预先算好，结算只需查表
+        self.payouts = PayoutTable(self.bet_multipliers)
 
-    def log_history(self, user_id, description, points_change, period_number, bet_amount=None, role='player'):
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-        history_record = {
-            'time': timestamp,
-            'description': description,
-            'points_change': points_change,
-            'new_balance': self.user_data[user_id]['points'],
-            'role': role,
-            'period_number': period_number
-        }
-        if bet_amount is not None:
-            history_record['bet_amount'] = bet_amount
-        if user_id not in self.game_history:
-            self.game_history[user_id] = []
-        self.game_history[user_id].append(history_record)
-        asyncio.create_task(self._save_data())
-        logger.info(f"游戏历史已更新，用户ID：{user_id}")
+        # 骰子来自 CSPRNG 缓冲池；开启承诺-揭示时每期的骰子由开局时承诺的种子决定
+        self.rng = rng or DiceRng()
 
-    def generate_unique_period_number(self):
-        while True:
-            date_time = datetime.now().strftime("%Y%m%d%H%M%S")
-            random_str = ''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=4))
-            unique_id = f"{date_time}{random_str}"
-            if unique_id not in self.game_history.get("period_numbers", set()):
-                break
-        self.game_history.setdefault("period_numbers", set()).add(unique_id)
-        logger.debug(f"生成唯一期号：{unique_id}")
-        return unique_id
+        # 多人同轮模式：频道 -> 当前轮次；round_window 为每轮收集投入的秒数，0 表示关闭
+        self.round_window = round_window
+        self.rounds = {}
 
-    async def roll_dice_for_game(self, message: Message, user_id, num_dice=1):
-        game = self.active_games.get(user_id)
+        # 闲置游戏回收：最后一次操作后 idle_ttl 秒仍未结算的游戏由后台任务统一处理，0 表示关闭
+        if idle_action not in self.IDLE_ACTIONS:
+            raise ValueError(f"未知的闲置游戏处理方式：{idle_action}")
+        self.idle_ttl = idle_ttl
+        self.idle_action = idle_action
+        self.idle_wheel = TimerWheel(now=time.monotonic())
+        self.reaped_games = 0
+        self._reaper_task = None
+        # 持锁结算一局游戏（余额、负责人收付、历史）的耗时
+        self.settle_seconds = Histogram("gambling_settle_seconds")
+
+    # 处理方法名 -> 命令别名，由 register_commands 注册到 CommandRouter
+    COMMANDS = {
+        'handle_dice_command': ('🎲', 'sh', 'sh3', '🎲3'),
+        'handle_cancel_command': ('取消', 'qx'),
+    }
+
+    def register_commands(self, router):
+        router.register_all(self, self.COMMANDS)
+
+    def register_metrics(self, registry):
+        registry.gauge('active_games', "进行中的游戏局数", lambda: len(self.active_games))
+        registry.gauge('reaped_games', "累计回收的闲置游戏局数", lambda: self.reaped_games)
+        registry.histogram('settle_seconds', "持锁结算一局游戏的耗时（秒）", self.settle_seconds)
+
+    async def handle_dice_command(self, message: Message, ctx):
+        internal_id = ctx.internal_id
+        parts = ctx.parts
+        logger.debug("用户 %s 发起摇骰子命令: %s", internal_id, parts)
+
+        command = parts[0].lower()
+        num_dice = 1
+
+        if command in ['sh3', '🎲3']:
+            num_dice = 3
+        elif len(parts) > 1 and parts[1].isdigit():
+            num_dice = int(parts[1])
+        elif command in ['sh', '🎲']:
+            num_dice = 1
+
+        if num_dice <= 0:
+            await message.reply(content='❌ 摇骰子次数必须大于0。')
+            return
+        if num_dice > 3:
+            await message.reply(content='❌ 最多只能摇3次骰子。')
+            return
+
+        game = self.active_games.get(internal_id)
         if not game:
             await message.reply(content='❌ 未找到进行中的游戏。')
-            logger.warning(f"未找到用户 {user_id} 的进行中游戏。")
             return
+        if game.get('round') is not None:
+            current = self.rounds.get(game['round'])
+            remaining = int(max(0, current['deadline'] - time.monotonic())) if current else 0
+            await message.reply(content=f'⏳ 本轮统一开奖，无需摇骰子，距开奖还有 **{remaining}** 秒。')
+            return
+
         remaining_dice = 3 - len(game['dice_rolls'])
-        if remaining_dice <= 0:
-            await message.reply(content='❌ 您已经摇过所有的骰子了。')
-            logger.warning(f"用户 {user_id} 尝试多次摇骰子。")
+        if num_dice > remaining_dice:
+            await message.reply(content=f'❌ 您只能摇 {remaining_dice} 次骰子。')
             return
-        num_dice = min(num_dice, remaining_dice)
-        numbers = self.roll_dice(num_dice)
-        for number in numbers:
-            game['dice_rolls'].append(number)
-            dice_emoji = self.DICE_EMOJI[number]
-            try:
-                await message.reply(content=f"🎲 第{len(game['dice_rolls'])}个骰子结果：【{dice_emoji}】")
-            except ServerError:
-                await message.reply(content='❌ 发送骰子结果时发生错误，请稍后再试。')
-                return
-            logger.info(f"用户 {user_id} 摇骰子第{len(game['dice_rolls'])}个结果：{number}")
-        asyncio.create_task(self._save_data())
-        if len(game['dice_rolls']) == 3:
+
+        await self.roll_dice_for_game(message, internal_id, num_dice=num_dice)
+
+    async def handle_cancel_command(self, message: Message, ctx):
+        cancel_status = self.cancel_game(ctx.internal_id)
+        if cancel_status == 'started':
+            await message.reply(content='❌ 游戏已经开始，无法取消。')
+        elif cancel_status == 'success':
+            await message.reply(content='✅ 您的游戏已成功取消，代币已退还。')
+        elif cancel_status == 'not_started':
+            await message.reply(content='⚠️ 您目前没有进行中的游戏可以取消。')
+
+    def has_game(self, user_id):
+        """用户是否有进行中或等待结算的游戏。"""
+        return user_id in self.active_games or user_id in self.settling
+
+    def _begin_settle(self, user_id, game):
+        """把骰子已摇完的游戏移出 active_games 转入待结算，检查点更新为完整的骰子结果。调用方需持有玩家的锁。"""
+        self.active_games.pop(user_id, None)
+        self.idle_wheel.cancel(user_id)
+        self.settling[user_id] = game
+        self.checkpoint_game(user_id)
+
+    def log_history(self, user_id, kind, points_change, period_number, bet_amount=None, role='player',
+                    bet_type=None, counterparty=None):
+        history_record = HistoryRecord.create(
+            kind, points_change, self.user_data[user_id]['points'], role, period_number,
+            bet_amount=bet_amount, bet_type=bet_type, counterparty=counterparty
+        )
+        self.data_manager.append_history(user_id, history_record)
+        logger.debug("游戏历史已更新，用户ID：%s", user_id)
+
+    def generate_unique_period_number(self):
+        unique_id = self.data_manager.next_period_number()
+        logger.debug("生成唯一期号：%s", unique_id)
+        return unique_id
+
+    async def roll_dice_for_game(self, message: Message, user_id, num_dice=1):
+        # 持锁期间只修改内存中的游戏状态，骰子结果在释放锁之后再逐个回复
+        async with self.data_manager.locks.acquire(user_id, lock_class='user'):
+            game = self.active_games.get(user_id)
+            if not game:
+                logger.warning("未找到用户 %s 的进行中游戏。", user_id)
+                error = '❌ 未找到进行中的游戏。'
+            elif len(game['dice_rolls']) >= 3:
+                logger.warning("用户 %s 尝试多次摇骰子。", user_id)
+                error = '❌ 您已经摇过所有的骰子了。'
+            else:
+                error = None
+                first_index = len(game['dice_rolls']) + 1
+                numbers = self.rng.roll_for_game(game, min(num_dice, 3 - len(game['dice_rolls'])))
+                game['dice_rolls'].extend(numbers)
+                finished = len(game['dice_rolls']) == 3
+                if finished:
+                    # 由本次调用负责结算，避免并发的摇骰子命令重复结算
+                    self._begin_settle(user_id, game)
+                else:
+                    self.watch_game(user_id)
+                    self.checkpoint_game(user_id)
+        if error:
+            await message.reply(content=error)
+            return
+
+        for index, number in enumerate(numbers, start=first_index):
+            logger.debug("用户 %s 摇骰子第%s个结果：%s", user_id, index, number)
+            # 发送队列会把连续的骰子结果与最终结果合并为一条消息
+            await message.reply(content=f"🎲 第{index}个骰子结果：【{self.DICE_EMOJI[number]}】")
+        if finished:
             await self.process_game_result(message, user_id, game)
 
     async def process_game_result(self, message: Message, user_id, game):
         try:
-            numbers = game['dice_rolls']
-            total = sum(numbers)
-            bets = game['bets']
-            total_winnings = 0
-            details = []
             boss = game.get('boss')
-            logger.info(f"处理游戏结果，用户ID：{user_id}, 骰子总和：{total}")
-
-            for bet in bets:
-                bet_type = bet['type']
-                bet_amount = bet['amount']
-                multiplier = self.get_multiplier(bet_type, total)
-
-                logger.info(f"用户 {user_id} 投入类型：{bet_type}, 投入金额：{bet_amount}, 倍数：{multiplier}")
-
-                if multiplier > 0:
-                    winnings = int(bet_amount * multiplier)
-                    self.user_data[user_id]['points'] += winnings
-                    self.log_history(user_id, f"{bet_type} 🎉 收获游戏，奖励 {winnings} 代币", winnings, game['period_number'],
-                                     bet_amount=bet_amount, role='player')
-                    details.append(
-                        f"✅ **{self.map_bet_type_display(bet['type'])}**: 投入 **{bet['amount']}** 代币，收获 **{winnings}** 💰代币")
-
-                    if boss and boss.boss_id != user_id:
-                        try:
-                            boss.deduct_boss_points(winnings)
-                            self.log_history(boss.boss_id, f'玩家 {user_id} 🎉 收获游戏，扣除负责人 {winnings} 代币', -winnings,
-                                             game['period_number'], role='boss')
-                            details.append(f"🔻 **负责人**: 扣除 **{winnings}** 💰代币")
-                        except ValueError as e:
-                            logger.error(f"扣除负责人 {boss.boss_id} 代币失败：{e}")
-                            await message.reply(content='⚠️ 负责人的代币不足以支付您的奖励。')
-                            self.user_data[user_id]['points'] -= winnings
-                            self.user_data[user_id]['points'] += bet_amount
-                            self.log_history(user_id, f'因负责人余额不足，返还 {bet_amount} 代币', bet_amount,
-                                             game['period_number'], role='player')
-                            details.append(f"🔄 **返还**: {bet_amount} 💰代币")
-                else:
-                    details.append(f"❌ **{self.map_bet_type_display(bet_type)}**: 投入 **{bet_amount}** 代币，未收获")
-                    if boss and boss.boss_id != user_id:
-                        boss.add_boss_points(bet_amount)
-                        self.log_history(boss.boss_id, f'玩家 {user_id} ❌ 失去游戏，负责人获得 {bet_amount} 代币', bet_amount,
-                                         game['period_number'], role='boss')
-                        details.append(f"💹 **负责人**: 获得 **{bet_amount}** 💰代币")
+            boss_id = boss.boss_id if boss else None
+            try:
+                async with self.data_manager.locks.acquire(user_id, boss_id, lock_class='player+boss'):
+                    numbers, total, details, notices = self._settle_game(user_id, game)
+            finally:
+                # 结算出错时保留检查点供重启后恢复，但不能让玩家一直无法开始新游戏
+                self.settling.pop(user_id, None)
+            for notice in notices:
+                await message.reply(content=notice)
 
             emoji_numbers = [self.DICE_EMOJI[n] for n in numbers]
             # 开始构建游戏结果信息
@@ -175,29 +286,201 @@ class Gambling:
                 analysis_message += detail + '\n'
 
             # 添加期号信息
-            analysis_message += (
-                f"期号： **{game['period_number']}**\n"
-                f"--------------------------------\n"
-            )
+            analysis_message += f"期号： **{game['period_number']}**\n"
+            if game.get('seed'):
+                analysis_message += f"🔓 种子：`{game['seed']}`\n"
+            analysis_message += "--------------------------------\n"
 
             # 控制消息长度，避免超出限制
             if len(analysis_message) > 2000:
                 analysis_message = analysis_message[:1997] + '...'
 
-            try:
-                await message.reply(content=analysis_message)
-                logger.info(f"已发送游戏结果给用户 {user_id}")
-            except ServerError as e:
-                logger.error(f"发送游戏结果失败：{e}")
-                await message.reply(content='⚠️ 无法发送结果，请稍后重试。')
-
-            self.active_games.pop(user_id, None)
-            asyncio.create_task(self._save_data())
+            await message.reply(content=analysis_message)
+            logger.debug("已发送游戏结果给用户 %s", user_id)
 
         except Exception as e:
-            logger.exception(f"处理游戏结果时发生错误：{e}")
+            logger.exception("处理游戏结果时发生错误：%s", e)
             await message.reply(content='⚠️ 处理游戏结果时发生错误，请联系管理员。')
-            self.active_games.pop(user_id, None)
+
+    def join_round(self, message: Message, user_id, game):
+        """把刚登记的游戏加入所在频道的当前轮次，没有轮次时新开一轮。返回距开奖的秒数。"""
+        channel_id = message.channel_id
+        game['round'] = channel_id
+        current = self._current_round(channel_id)
+        current['games'].append((user_id, game))
+        if current['seed']:
+            # 同一轮共用一个种子，各局都引用本轮的承诺
+            game['seed'], game['commitment'] = current['seed'], current['commitment']
+        # 被动回复有时效，开奖结果回复给本轮最新的一条投入消息
+        current['message'] = message
+        return max(0, current['deadline'] - time.monotonic())
+
+    def _current_round(self, channel_id, seed=None, commitment=None):
+        """返回频道的当前轮次，没有时新开一轮；seed 用于恢复重启前已公布承诺的轮次。"""
+        current = self.rounds.get(channel_id)
+        if current is None:
+            current = self.rounds[channel_id] = {
+                'games': [],
+                'message': None,
+                'deadline': time.monotonic() + self.round_window,
+                'seed': seed,
+                'commitment': commitment,
+            }
+            if seed is None and self.rng.commit_reveal:
+                current['seed'], current['commitment'] = self.rng.new_commitment()
+            current['task'] = asyncio.create_task(self._run_round(channel_id, current))
+            logger.info("频道 %s 开始新一轮，%s 秒后开奖。", channel_id, self.round_window)
+        return current
+
+    async def _run_round(self, channel_id, current):
+        await asyncio.sleep(self.round_window)
+        self.rounds.pop(channel_id, None)
+        numbers = dice_from_seed(current['seed'], 3) if current['seed'] else self.rng.roll(3)
+        # 窗口期内已取消的游戏不在 active_games 中，跳过
+        games = []
+        for user_id, game in current['games']:
+            if self.active_games.get(user_id) is game:
+                game['dice_rolls'] = list(numbers)
+                self._begin_settle(user_id, game)
+                games.append((user_id, game))
+        if not games:
+            logger.info("频道 %s 本轮没有需要结算的游戏。", channel_id)
+            return
+
+        logger.info("频道 %s 本轮开奖：%s，参与 %s 人。", channel_id, numbers, len(games))
+        try:
+            results = await self.settle_games(games)
+            if current['message'] is None:
+                # 重启后恢复的轮次在开奖前没有新的投入消息，无处回复，结果只记入历史
+                logger.info("频道 %s 本轮结果没有可回复的消息，仅记录历史。", channel_id)
+                return
+            await current['message'].reply(content=self.format_round_result(numbers, games, results))
+        except Exception as e:
+            logger.exception("结算本轮游戏时发生错误：%s", e)
+
+    def format_round_result(self, numbers, games, results):
+        total = sum(numbers)
+        lines = [
+            "🎲 **本轮结果** 🎲",
+            "--------------------------------",
+            f"结果：**{'、'.join(self.DICE_EMOJI[n] for n in numbers)}**",
+            f"总和：**{self.number_to_emoji(total)}**",
+            f"参与人数：**{len(games)}**",
+            "--------------------------------",
+        ]
+        for (user_id, game), (_, _, details, notices) in zip(games, results):
+            lines.append(f"👤 **{game['username']}**（期号 {game['period_number']}）")
+            lines.extend(details)
+            lines.extend(notices)
+        if games and games[0][1].get('seed'):
+            lines.append(f"🔓 种子：`{games[0][1]['seed']}`")
+        lines.append("--------------------------------")
+        content = "\n".join(lines)
+        # 控制消息长度，避免超出限制
+        if len(content) > 2000:
+            content = content[:1997] + '...'
+        return content
+
+    async def settle_games(self, games):
+        """
+        批量结算多局已摇完骰子的游戏，例如同一轮共用骰子的多名玩家。
+        games 为 [(user_id, game)]；所有投入的奖励按赔付表一次算出，
+        余额与历史在同一次持锁期间写入，并作为一次刷新落盘。返回与 games 对应的结算结果列表。
+        """
+        bet_types, amounts, totals = [], [], []
+        keys = set()
+        for user_id, game in games:
+            total = sum(game['dice_rolls'])
+            for bet in game['bets']:
+                bet_types.append(bet['type'])
+                amounts.append(bet['amount'])
+                totals.append(total)
+            keys.add(user_id)
+            boss = game.get('boss')
+            if boss:
+                keys.add(boss.boss_id)
+        results = []
+        try:
+            winnings = self.payouts.batch_winnings(bet_types, amounts, totals)
+            async with self.data_manager.locks.acquire(*keys, lock_class='batch'):
+                offset = 0
+                for user_id, game in games:
+                    count = len(game['bets'])
+                    results.append(self._settle_game(user_id, game, winnings[offset:offset + count]))
+                    offset += count
+        finally:
+            # 同 process_game_result：出错时未结算的游戏保留检查点，但不再占用玩家的游戏位置
+            for user_id, _ in games:
+                self.settling.pop(user_id, None)
+        self.data_manager.flush_soon()
+        logger.info("批量结算 %s 局游戏，共 %s 注。", len(games), len(bet_types))
+        return results
+
+    def _settle_game(self, user_id, game, winnings_list=None):
+        """
+        结算一局游戏的余额与历史，调用方需持有玩家与负责人的锁。返回 (骰子, 总和, 详情, 需另行回复的提示)。
+        winnings_list 为各注已算好的奖励（批量结算时传入），否则按赔付表逐注查出。
+        游戏的检查点在这里删除，与奖励、负责人收付和历史进入同一次刷新。
+        """
+        started = time.perf_counter()
+        numbers = game['dice_rolls']
+        total = sum(numbers)
+        bets = game['bets']
+        if winnings_list is None:
+            winnings_list = [int(bet['amount'] * self.get_multiplier(bet['type'], total)) for bet in bets]
+        details = []
+        notices = []
+        boss = game.get('boss')
+        if boss:
+            # 结算后不再占用负责人的预留额度
+            boss.release(user_id)
+        payout = 0
+        won = False
+        logger.debug("处理游戏结果，用户ID：%s, 骰子总和：%s", user_id, total)
+
+        for bet, winnings in zip(bets, winnings_list):
+            bet_type = bet['type']
+            bet_amount = bet['amount']
+
+            logger.debug("用户 %s 投入类型：%s, 投入金额：%s, 奖励：%s",
+                         user_id, bet_type, bet_amount, winnings)
+
+            if winnings > 0:
+                self.data_manager.add_points(user_id, winnings)
+                payout += winnings
+                paid = True
+                self.log_history(user_id, EventKind.WIN, winnings, game['period_number'],
+                                 bet_amount=bet_amount, role='player', bet_type=bet_type)
+                details.append(
+                    f"✅ **{self.map_bet_type_display(bet['type'])}**: 投入 **{bet['amount']}** 代币，收获 **{winnings}** 💰代币")
+
+                if boss and boss.boss_id != user_id:
+                    try:
+                        boss.deduct_boss_points(winnings)
+                        boss.log_history(boss.boss_id, EventKind.BOSS_PAY, -winnings,
+                                         game['period_number'], role='boss', counterparty=user_id)
+                        details.append(f"🔻 **负责人**: 扣除 **{winnings}** 💰代币")
+                    except ValueError as e:
+                        logger.error("扣除负责人 %s 代币失败：%s", boss.boss_id, e)
+                        notices.append('⚠️ 负责人的代币不足以支付您的奖励。')
+                        self.data_manager.add_points(user_id, bet_amount - winnings)
+                        payout += bet_amount - winnings
+                        paid = False
+                        self.log_history(user_id, EventKind.REFUND, bet_amount,
+                                         game['period_number'], role='player')
+                        details.append(f"🔄 **返还**: {bet_amount} 💰代币")
+                won = won or paid
+            else:
+                details.append(f"❌ **{self.map_bet_type_display(bet_type)}**: 投入 **{bet_amount}** 代币，未收获")
+                if boss and boss.boss_id != user_id:
+                    boss.add_boss_points(bet_amount)
+                    boss.log_history(boss.boss_id, EventKind.BOSS_GAIN, bet_amount,
+                                     game['period_number'], role='boss', counterparty=user_id)
+                    details.append(f"💹 **负责人**: 获得 **{bet_amount}** 💰代币")
+        record_settle(self.user_data[user_id], payout, won)
+        self.data_manager.set_game(user_id, None)
+        self.settle_seconds.observe(time.perf_counter() - started)
+        return numbers, total, details, notices
 
     def map_bet_type_display(self, bet_type):
         mapping = {
@@ -246,92 +529,187 @@ class Gambling:
         return number_emojis.get(number, str(number))
 
     def roll_dice(self, num_dice=1):
-        return [random.randint(1, 6) for _ in range(num_dice)]
+        return self.rng.roll(num_dice)
 
     def get_multiplier(self, bet_type, total):
-        bet_type_map = {
-            '双': '双',
-            '单': '单',
-            '大': '大',
-            '小': '小',
-            '3': '3',
-            '4': '4',
-            '5': '5',
-            '6': '6',
-            '7': '7',
-            '8': '8',
-            '9': '9',
-            '10': '10',
-            '11': '11',
-            '12': '12',
-            '13': '13',
-            '14': '14',
-            '15': '15',
-            '16': '16',
-            '17': '17',
-            '18': '18',
-        }
-        mapped_bet_type = bet_type_map.get(bet_type, bet_type)
-
-        if mapped_bet_type in ['大', '小', '双', '单']:
-            if self.is_bet_success(mapped_bet_type, total):
-                return self.bet_multipliers.get(mapped_bet_type, 0)
-            else:
-                return 0
-        else:
-            try:
-                bet_sum = int(mapped_bet_type)
-                if total == bet_sum:
-                    return self.bet_multipliers.get(mapped_bet_type, 0)
-                else:
-                    return 0
-            except ValueError:
-                return 0
+        return self.payouts.multiplier(bet_type, total)
 
     def is_bet_success(self, bet_type, total):
-        if bet_type == '大':  # 大
-            return 11 <= total <= 18
-        elif bet_type == '小':  # 小
-            return 3 <= total <= 10
-        elif bet_type == '双':  # 双
-            return 3 <= total <= 18 and total % 2 == 0
-        elif bet_type == '单':  # 单
-            return 3 <= total <= 18 and total % 2 != 0
-        return False
+        return bet_wins(bet_type, total)
 
     def cancel_game(self, user_id):
         if user_id in self.active_games:
             game = self.active_games[user_id]
             if len(game['dice_rolls']) > 0:
-                logger.info(f"用户 {user_id} 尝试取消已开始的游戏。")
+                logger.info("用户 %s 尝试取消已开始的游戏。", user_id)
                 return 'started'
 
-            total_refund = sum(bet['amount'] for bet in game['bets'])
-            self.user_data[user_id]['points'] += total_refund
-            for bet in game['bets']:
-                self.log_history(user_id, f'取消游戏，返还 {bet["amount"]} 代币', bet['amount'], game['period_number'],
-                                 bet_amount=bet['amount'], role='player')
-                logger.info(f"用户 {user_id} 成功取消游戏，返还 {bet['amount']} 代币")
-            asyncio.create_task(self._save_data())
-            self.active_games.pop(user_id, None)
+            self._refund_game(user_id, game)
             return 'success'
-        logger.info(f"用户 {user_id} 尝试取消不存在的游戏")
+        logger.info("用户 %s 尝试取消不存在的游戏", user_id)
         return 'not_started'
 
+    def _refund_game(self, user_id, game):
+        """退还一局尚未摇骰子的游戏的全部投入并移出 active_games。"""
+        total_refund = sum(bet['amount'] for bet in game['bets'])
+        self.data_manager.add_points(user_id, total_refund)
+        if game.get('boss'):
+            game['boss'].release(user_id)
+        record_cancel(self.user_data[user_id], total_refund)
+        for bet in game['bets']:
+            self.log_history(user_id, EventKind.CANCEL, bet['amount'], game['period_number'],
+                             bet_amount=bet['amount'], role='player')
+            logger.info("用户 %s 成功取消游戏，返还 %s 代币", user_id, bet['amount'])
+        self.active_games.pop(user_id, None)
+        self.idle_wheel.cancel(user_id)
+        self.checkpoint_game(user_id)
+
+    def checkpoint_game(self, user_id):
+        """把进行中或等待结算的游戏的当前状态交给持久化层，两者都没有时删除检查点。"""
+        game = self.active_games.get(user_id) or self.settling.get(user_id)
+        if game is None:
+            self.data_manager.set_game(user_id, None)
+            return
+        state = {
+            'username': game['username'],
+            'bets': [dict(bet) for bet in game['bets']],
+            'start_time': game['start_time'],
+            'period_number': game['period_number'],
+            'dice_rolls': list(game['dice_rolls']),
+            # 负责人对象不可序列化，恢复时重新绑定到当前的 Boss 实例
+            'boss': game.get('boss') is not None,
+            'reserved': self.boss.reservations.get(user_id, 0) if self.boss else 0,
+        }
+        for key in ('seed', 'commitment', 'round'):
+            if game.get(key) is not None:
+                state[key] = game[key]
+        self.data_manager.set_game(user_id, state)
+
+    def restore_games(self):
+        """
+        启动时按检查点恢复进行中的游戏：已摇的骰子、种子与承诺原样保留，
+        重新绑定负责人并恢复其预留。同轮模式的游戏重新加入所在频道的轮次，关闭同轮模式后改为单独摇骰子。
+        骰子已摇完但重启前未结算的游戏在启动后立即结算。
+        """
+        states = self.data_manager.data["active_games"]
+        finished = []
+        for user_id, state in list(states.items()):
+            if user_id not in self.user_data:
+                logger.warning("进行中游戏的用户 %s 不存在，丢弃检查点。", user_id)
+                self.data_manager.set_game(user_id, None)
+                continue
+            game = {key: value for key, value in state.items() if key not in ('boss', 'reserved', 'round')}
+            game['bets'] = [dict(bet) for bet in state['bets']]
+            game['dice_rolls'] = list(state['dice_rolls'])
+            game['boss'] = self.boss if state.get('boss') else None
+            if game['boss'] is not None and state.get('reserved'):
+                self.boss.restore_reservation(user_id, state['reserved'])
+            if len(game['dice_rolls']) >= 3:
+                self.settling[user_id] = game
+                finished.append((user_id, game))
+                continue
+            self.active_games[user_id] = game
+            channel_id = state.get('round')
+            if channel_id is not None and self.round_window:
+                game['round'] = channel_id
+                current = self._current_round(channel_id, game.get('seed'), game.get('commitment'))
+                current['games'].append((user_id, game))
+            else:
+                self.watch_game(user_id)
+                if channel_id is not None:
+                    self.checkpoint_game(user_id)
+        if states:
+            logger.info("已恢复 %s 局进行中的游戏，%s 局待结算，负责人预留 "
+                        "%s 代币。",
+                        len(self.active_games), len(finished), self.boss.reserved if self.boss else 0)
+        if finished:
+            asyncio.create_task(self.settle_games(finished))
+
+    def watch_game(self, user_id):
+        """登记或刷新一局游戏的闲置计时；同轮模式的游戏由所在轮次开奖，不需要计时。"""
+        game = self.active_games.get(user_id)
+        if self.idle_ttl and game is not None and game.get('round') is None:
+            self.idle_wheel.schedule(user_id, self.idle_ttl, time.monotonic())
+
+    def start(self):
+        if self.idle_ttl and self._reaper_task is None:
+            self._reaper_task = asyncio.create_task(self._reap_loop())
+            logger.info("闲置游戏回收已启动，闲置 %s 秒后%s。",
+                        self.idle_ttl, '退还投入' if self.idle_action == 'refund' else '自动开奖')
+
+    async def close(self):
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            try:
+                await self._reaper_task
+            except asyncio.CancelledError:
+                pass
+            self._reaper_task = None
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.idle_wheel.tick)
+            expired = self.idle_wheel.advance(time.monotonic())
+            if not expired:
+                continue
+            try:
+                await self.reap_games(expired)
+            except Exception as e:
+                logger.exception("回收闲置游戏时发生错误：%s", e)
+
+    async def reap_games(self, user_ids):
+        """
+        处理一批到期的闲置游戏：未摇骰子的按 idle_action 退还或自动开奖，
+        已摇过骰子的总是摇完剩余骰子并结算，避免看到部分点数后放弃换取退款。
+        整批在一次持锁期间处理，只触发一次落盘。
+        """
+        keys = set(user_ids)
+        for user_id in user_ids:
+            game = self.active_games.get(user_id)
+            if game and game.get('boss'):
+                keys.add(game['boss'].boss_id)
+        refunded = 0
+        to_settle = []
+        now = time.time()
+        async with self.data_manager.locks.acquire(*keys, lock_class='reaper'):
+            for user_id in user_ids:
+                game = self.active_games.get(user_id)
+                # 到期前已结算、取消或加入同轮的游戏跳过
+                if game is None or game.get('round') is not None:
+                    continue
+                logger.info("用户 %s 的游戏（期号 %s）"
+                            "闲置超时，开局于 %s 秒前。",
+                            user_id, game['period_number'], int(now - game['start_time']))
+                if self.idle_action == 'refund' and not game['dice_rolls']:
+                    self._refund_game(user_id, game)
+                    refunded += 1
+                    continue
+                game['dice_rolls'].extend(self.rng.roll_for_game(game, 3 - len(game['dice_rolls'])))
+                self._begin_settle(user_id, game)
+                to_settle.append((user_id, game))
+        if to_settle:
+            # settle_games 同样在一次持锁期间写入并请求落盘
+            await self.settle_games(to_settle)
+        elif refunded:
+            self.data_manager.flush_soon()
+        self.reaped_games += refunded + len(to_settle)
+        if refunded or to_settle:
+            logger.info("已回收闲置游戏：退还 %s 局，自动开奖 %s 局。", refunded, len(to_settle))
+
     def _deduct_user_points(self, user_id, amount):
         if user_id not in self.user_data:
             raise ValueError("用户不存在。")
         if self.user_data[user_id]['points'] < amount:
             raise ValueError("您的代币不足以进行投入。")
-        self.user_data[user_id]['points'] -= amount
-        self.log_history(user_id, f"扣除 {amount} 代币用于游戏", -amount, "system", role='system')
-        asyncio.create_task(self._save_data())
-        logger.info(f"用户 {user_id} 扣除 {amount} 代币，当前余额：{self.user_data[user_id]['points']}")
+        self.data_manager.add_points(user_id, -amount)
+        self.log_history(user_id, EventKind.DEDUCT, -amount, "system", role='system')
+        logger.debug("用户 %s 扣除 %s 代币，当前余额：%s",
+                     user_id, amount, self.user_data[user_id]['points'])
 
     def _add_user_points(self, user_id, amount):
         if user_id not in self.user_data:
             raise ValueError("用户不存在。")
-        self.user_data[user_id]['points'] += amount
-        self.log_history(user_id, f"增加 {amount} 代币", amount, "system", role='system')
-        asyncio.create_task(self._save_data())
-        logger.info(f"用户 {user_id} 增加 {amount} 代币，当前余额：{self.user_data[user_id]['points']}")
+        self.data_manager.add_points(user_id, amount)
+        self.log_history(user_id, EventKind.ADD, amount, "system", role='system')
+        logger.debug("用户 %s 增加 %s 代币，当前余额：%s",
+                     user_id, amount, self.user_data[user_id]['points'])
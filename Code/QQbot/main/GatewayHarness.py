@@ -0,0 +1,171 @@
+# GatewayHarness.py
+# 在本地模拟 QQ 网关事件压测分片部署：在临时目录中生成配置与初始数据，启动协调进程逻辑和各分片进程，
+# 由模拟用户并发开户、发红包、下注摇骰子、跨分片领取红包，统计每秒处理的消息数，并核对各分片数据是否一致
+# （负责人流水已全部同步、没有残留的预留和进行中游戏、代币总量守恒）。
+# 用法：python GatewayHarness.py [--shards 1,2,4] [--users 400] [--rounds 20] [--envelopes 20] [--window 2000]
+# 不连接网关，也不读取或修改当前目录的 config.yaml 与数据文件。
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+from Cluster import Coordinator
+from Outbox import Outbox
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("GatewayHarness")
+
+BOT_ID = 'harness'
+BOSS_ID = 'HARNESS0'
+BOSS_POINTS = 10 ** 9
+# 新用户的初始代币，见 DataManager.get_or_create_user
+USER_POINTS = 1000
+
+
+class FakeAuthor:
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+
+class FakeMessage:
+    def __init__(self, userid, content, channel_id):
+        self.content = f"<@!{BOT_ID}> {content}"
+        self.author = FakeAuthor(userid, userid)
+        self.channel_id = channel_id
+        self.mentions = []
+        self.replies = []
+
+    async def reply(self, content=None, **kwargs):
+        self.replies.append(content)
+
+
+def prepare(workdir, shards, window):
+    config = {
+        'appid': 'harness',
+        'secret': 'harness',
+        'admins': [],
+        # 保留全部历史在内存中，核对代币总量时需要
+        'persistence': {'backend': 'json', 'history_window': 10 ** 9},
+        'shards': {'count': shards, 'sync_interval': 0.5},
+        'ingress': {'workers': 8, 'queue_size': window * 4},
+    }
+    data = {
+        'boss_id': BOSS_ID,
+        'user_data': {BOSS_ID: {'userid': None, 'username': '压测负责人', 'points': BOSS_POINTS}},
+    }
+    with open(os.path.join(workdir, 'config.yaml'), 'w', encoding='utf-8') as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+    with open(os.path.join(workdir, 'data.json'), 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    return config
+
+
+async def run_once(shards, args):
+    workdir = tempfile.mkdtemp(prefix=f'harness{shards}-', dir=args.workdir)
+    os.chdir(workdir)
+    config = prepare(workdir, shards, args.window)
+    outbox = Outbox(rate=1e9, burst=10 ** 9, linger=0)
+    coordinator = Coordinator(config, outbox)
+    coordinator.bot_id = BOT_ID
+    await coordinator.start()
+
+    users = [f"user{i}" for i in range(args.users)]
+    rng = random.Random(args.seed)
+
+    async def send(userid, content):
+        # 在途消息达到窗口上限时等待，模拟网关按处理速度推送
+        while coordinator.stats['routed'] - coordinator.stats['handled'] >= args.window:
+            await asyncio.sleep(0.001)
+        message = FakeMessage(userid, content, f"channel{hash(userid) % args.channels}")
+        await coordinator.submit(message)
+        return message
+
+    async def wait_idle():
+        while coordinator.stats['handled'] < coordinator.stats['routed'] or outbox.depth():
+            await asyncio.sleep(0.005)
+
+    started = time.perf_counter()
+    for userid in users:
+        await send(userid, 'ye')
+    sent = [await send(userid, 'hb 500 10') for userid in users[:args.envelopes]]
+    await wait_idle()
+    periods = []
+    for message in sent:
+        match = re.search(r'期号：\*\*(\w+)\*\*', ''.join(message.replies))
+        if match:
+            periods.append(match.group(1))
+
+    for round_index in range(args.rounds):
+        for userid in users:
+            await send(userid, '大10')
+            await send(userid, 'sh3')
+            if round_index == 0 and periods:
+                await send(userid, f'领取 {rng.choice(periods)}')
+    await wait_idle()
+    elapsed = time.perf_counter() - started
+
+    await coordinator.sync_boss()
+    stats = await coordinator.shard_stats()
+    await coordinator.close()
+    await outbox.close()
+
+    created = sum(s['users'] for s in stats) - 1
+    expected = BOSS_POINTS + created * USER_POINTS
+    actual = sum(s['points'] + s['envelope_remaining'] + s['win_stakes'] for s in stats)
+    problems = []
+    if actual != expected:
+        problems.append(f"代币总量 {actual} != {expected}")
+    for index, s in enumerate(stats):
+        if s['boss_pending'] or s['boss_reserved'] or s['active_games']:
+            problems.append(f"分片 {index} 残留：流水 {s['boss_pending']} 条，预留 {s['boss_reserved']}，"
+                            f"进行中游戏 {s['active_games']} 局")
+        if s['ingress']['rejected'] or s['ingress']['failed']:
+            problems.append(f"分片 {index} 拒绝 {s['ingress']['rejected']} 条、失败 {s['ingress']['failed']} 条消息")
+
+    messages = coordinator.stats['routed']
+    print(f"分片 {shards}：消息 {messages} 条，耗时 {elapsed:.2f} 秒，{messages / elapsed:.0f} 条/秒，"
+          f"回复 {coordinator.stats['replies']} 条，跨分片领取 {coordinator.stats['grabs']} 次，"
+          f"负责人流水 {coordinator.stats['boss_entries']} 条 / 同步 {coordinator.stats['boss_syncs']} 次")
+    print(f"  各分片用户数：{[s['users'] for s in stats]}")
+    print(f"  一致性检查：{'通过' if not problems else '失败'}")
+    for problem in problems:
+        print(f"  - {problem}")
+    if not args.keep:
+        os.chdir(args.workdir)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return not problems
+
+
+async def main(args):
+    ok = True
+    for shards in args.shards:
+        ok = await run_once(shards, args) and ok
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟网关压测分片部署")
+    parser.add_argument('--shards', default='1,2,4', help="逗号分隔的分片数，依次各运行一遍")
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--envelopes', type=int, default=20, help="发红包的用户数，其他用户跨分片随机领取")
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--window', type=int, default=2000, help="最多同时在途的消息数")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=tempfile.gettempdir())
+    parser.add_argument('--keep', action='store_true', help="保留生成的数据目录")
+    args = parser.parse_args()
+    args.shards = [int(n) for n in args.shards.split(',')]
+    args.workdir = os.path.abspath(args.workdir)
+    sys.exit(0 if asyncio.run(main(args)) else 1)
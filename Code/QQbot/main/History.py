@@ -0,0 +1,170 @@
+# History.py
+
+import re
+import sys
+import time
+from enum import IntEnum
+
+
+class EventKind(IntEnum):
+    TEXT = 0  # 旧数据中无法识别的自由文本，原文保存在 text 中
+    DEDUCT = 1
+    ADD = 2
+    BET = 3
+    WIN = 4
+    REFUND = 5
+    CANCEL = 6
+    BOSS_PAY = 7
+    BOSS_GAIN = 8
+    BOSS_DEDUCT = 9
+    BOSS_ADD = 10
+
+
+# 描述文本只在需要展示时按模板生成；amount 恒为 points_change 的绝对值
+DESCRIPTION_TEMPLATES = {
+    EventKind.DEDUCT: "扣除 {amount} 代币用于游戏",
+    EventKind.ADD: "增加 {amount} 代币",
+    EventKind.BET: "{bet_type} {amount} 用于游戏",
+    EventKind.WIN: "{bet_type} 🎉 收获游戏，奖励 {amount} 代币",
+    EventKind.REFUND: "因负责人余额不足，返还 {amount} 代币",
+    EventKind.CANCEL: "取消游戏，返还 {amount} 代币",
+    EventKind.BOSS_PAY: "玩家 {counterparty} 🎉 收获游戏，扣除负责人 {amount} 代币",
+    EventKind.BOSS_GAIN: "玩家 {counterparty} ❌ 失去游戏，负责人获得 {amount} 代币",
+    EventKind.BOSS_DEDUCT: "扣除 {amount} 代币用于支付奖励",
+    EventKind.BOSS_ADD: "增加 {amount} 代币作为负责人收益",
+}
+
+# 旧格式描述 -> (类型, 捕获组对应的字段)
+_LEGACY_PATTERNS = [
+    (re.compile(r'^扣除 (\d+) 代币用于游戏$'), EventKind.DEDUCT, ('amount',)),
+    (re.compile(r'^扣除 (\d+) 代币用于支付奖励$'), EventKind.BOSS_DEDUCT, ('amount',)),
+    (re.compile(r'^增加 (\d+) 代币作为负责人收益$'), EventKind.BOSS_ADD, ('amount',)),
+    (re.compile(r'^增加 (\d+) 代币$'), EventKind.ADD, ('amount',)),
+    (re.compile(r'^(\S+) (\d+) 用于游戏$'), EventKind.BET, ('bet_type', 'amount')),
+    (re.compile(r'^(\S+) 🎉 收获游戏，奖励 (\d+) 代币$'), EventKind.WIN, ('bet_type', 'amount')),
+    (re.compile(r'^因负责人余额不足，返还 (\d+) 代币$'), EventKind.REFUND, ('amount',)),
+    (re.compile(r'^取消游戏，返还 (\d+) 代币$'), EventKind.CANCEL, ('amount',)),
+    (re.compile(r'^玩家 (\S+) 🎉 收获游戏，扣除负责人 (\d+) 代币$'), EventKind.BOSS_PAY, ('counterparty', 'amount')),
+    (re.compile(r'^玩家 (\S+) ❌ 失去游戏，负责人获得 (\d+) 代币$'), EventKind.BOSS_GAIN, ('counterparty', 'amount')),
+    # 更早版本的描述不带表情，识别类型但保留原文
+    (re.compile(r'^(\S+) 收获游戏，奖励 (\d+) 代币$'), EventKind.WIN, ('bet_type', 'amount')),
+    (re.compile(r'^玩家 (\S+) 收获游戏，扣除负责人 (\d+) 代币$'), EventKind.BOSS_PAY, ('counterparty', 'amount')),
+    (re.compile(r'^玩家 (\S+) 失去游戏，负责人获得 (\d+) 代币$'), EventKind.BOSS_GAIN, ('counterparty', 'amount')),
+]
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class HistoryRecord:
+    """
+    一条历史记录。用 __slots__ 和整数时间戳代替原来的七键字典，描述文本按需生成。
+    记录创建后不再修改，快照可以直接共享同一个对象。
+    """
+    __slots__ = ('ts', 'kind', 'points_change', 'new_balance', 'role', 'period_number',
+                 'bet_amount', 'bet_type', 'counterparty', 'text')
+
+    def __init__(self, ts, kind, points_change, new_balance, role, period_number,
+                 bet_amount=None, bet_type=None, counterparty=None, text=None):
+        self.ts = ts
+        self.kind = kind
+        self.points_change = points_change
+        self.new_balance = new_balance
+        # 角色和期号大量重复，驻留后多条记录共享同一个字符串
+        self.role = sys.intern(role) if role else role
+        self.period_number = sys.intern(period_number) if isinstance(period_number, str) else period_number
+        self.bet_amount = bet_amount
+        self.bet_type = bet_type
+        self.counterparty = counterparty
+        self.text = text
+
+    @classmethod
+    def create(cls, kind, points_change, new_balance, role, period_number,
+               bet_amount=None, bet_type=None, counterparty=None):
+        return cls(int(time.time()), kind, points_change, new_balance, role, period_number,
+                   bet_amount, bet_type, counterparty)
+
+    @property
+    def time(self):
+        return time.strftime(TIME_FORMAT, time.localtime(self.ts))
+
+    @property
+    def description(self):
+        if self.text is not None:
+            return self.text
+        return DESCRIPTION_TEMPLATES[self.kind].format(
+            amount=abs(self.points_change), bet_type=self.bet_type, counterparty=self.counterparty
+        )
+
+    def to_dict(self):
+        """旧格式字典，用于展示或导出。"""
+        record = {
+            'time': self.time,
+            'description': self.description,
+            'points_change': self.points_change,
+            'new_balance': self.new_balance,
+            'role': self.role,
+            'period_number': self.period_number,
+        }
+        if self.bet_amount is not None:
+            record['bet_amount'] = self.bet_amount
+        return record
+
+    def to_json(self):
+        """落盘用的紧凑格式，省略空字段。"""
+        obj = {'t': self.ts, 'k': int(self.kind), 'c': self.points_change, 'b': self.new_balance,
+               'r': self.role, 'p': self.period_number}
+        if self.bet_amount is not None:
+            obj['a'] = self.bet_amount
+        if self.bet_type is not None:
+            obj['y'] = self.bet_type
+        if self.counterparty is not None:
+            obj['u'] = self.counterparty
+        if self.text is not None:
+            obj['x'] = self.text
+        return obj
+
+    @classmethod
+    def from_json(cls, obj):
+        """读取紧凑格式；也接受旧版 data.json 中的字典格式。"""
+        if isinstance(obj, cls):
+            return obj
+        if 'k' in obj:
+            return cls(obj['t'], EventKind(obj['k']), obj['c'], obj['b'], obj['r'], obj['p'],
+                       obj.get('a'), obj.get('y'), obj.get('u'), obj.get('x'))
+        return cls._from_legacy(obj)
+
+    @classmethod
+    def _from_legacy(cls, obj):
+        try:
+            ts = int(time.mktime(time.strptime(obj['time'], TIME_FORMAT)))
+        except (KeyError, ValueError):
+            ts = 0
+        points_change = obj.get('points_change', 0)
+        record = cls(ts, EventKind.TEXT, points_change, obj.get('new_balance'), obj.get('role'),
+                     obj.get('period_number'), obj.get('bet_amount'), text=obj.get('description', ''))
+        for pattern, kind, fields in _LEGACY_PATTERNS:
+            match = pattern.match(record.text)
+            if not match:
+                continue
+            values = dict(zip(fields, match.groups()))
+            if int(values['amount']) != abs(points_change):
+                break
+            record.kind = kind
+            record.bet_type = values.get('bet_type')
+            record.counterparty = values.get('counterparty')
+            text, record.text = record.text, None
+            if record.description != text:
+                # 模板与原文不一致时保留原文，展示结果不变
+                record.text = text
+            break
+        return record
+
+    def __repr__(self):
+        return f"HistoryRecord({self.time}, {self.kind.name}, {self.points_change}, {self.description!r})"
+
+
+def json_default(obj):
+    """json.dumps 的 default 钩子，使历史记录可以直接出现在快照、journal 与归档中。"""
+    if isinstance(obj, HistoryRecord):
+        return obj.to_json()
+    raise TypeError(f"无法序列化的类型：{type(obj).__name__}")
@@ -0,0 +1,60 @@
+# IdService.py
+
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("IdService")
+
+# 按 ASCII 升序排列，定长编码后字符串比较与数值比较一致
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+TIME_FORMAT = "%Y%m%d%H%M%S"
+SEQ_WIDTH = 3
+MAX_SEQ = len(ALPHABET) ** SEQ_WIDTH - 1
+
+
+def encode_seq(seq):
+    chars = []
+    for _ in range(SEQ_WIDTH):
+        seq, digit = divmod(seq, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+class IdService:
+    """
+    期号生成器：14 位本地时间（秒）+ 3 位秒内序号 + 1 位节点编号，共 18 位，与旧期号等长。
+    同一进程内严格递增，字符串顺序即签发顺序；不同节点的期号由节点位区分，不需要保存已签发的集合。
+    时钟回拨或一秒内序号用尽时沿用（借用）上一秒继续递增。
+    重启后从持久化的水位线（最后签发的期号）之后的一秒开始，不会与重启前的期号重复。
+    """
+
+    def __init__(self, node=0, watermark=None, clock=datetime.now):
+        if not 0 <= node < len(ALPHABET):
+            raise ValueError(f"节点编号必须在 0~{len(ALPHABET) - 1} 之间。")
+        self.node = ALPHABET[node]
+        self.clock = clock
+        self.second = datetime.min
+        self.seq = MAX_SEQ
+        self._stamp = None
+        if watermark:
+            try:
+                # 水位线所在的秒视为已用尽；旧期号的随机后缀无法比较，同样跳过这一秒
+                self.second = datetime.strptime(watermark[:14], TIME_FORMAT)
+            except ValueError:
+                logger.warning("无法解析期号水位线：%s，忽略。", watermark)
+
+    def next_id(self):
+        now = self.clock().replace(microsecond=0)
+        if now > self.second:
+            self.second = now
+            self.seq = 0
+            self._stamp = None
+        elif self.seq < MAX_SEQ:
+            self.seq += 1
+        else:
+            self.second += timedelta(seconds=1)
+            self.seq = 0
+            self._stamp = None
+        if self._stamp is None:
+            self._stamp = self.second.strftime(TIME_FORMAT)
+        return f"{self._stamp}{encode_seq(self.seq)}{self.node}"
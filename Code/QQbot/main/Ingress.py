@@ -0,0 +1,105 @@
+# Ingress.py
+
+import asyncio
+import logging
+import time
+
+from Metrics import Histogram
+
+logger = logging.getLogger("Ingress")
+
+BUSY_REPLY = '⏳ 当前消息较多，请稍后再试。'
+
+
+class Ingress:
+    """
+    入站处理阶段：N 个工作协程，每个有自己的有界队列，消息按发送者分片。
+    同一用户的命令始终进入同一个队列、按到达顺序处理，不同用户并行处理。
+    队列已满时按 overflow 立即回复繁忙（'busy'）或直接丢弃（'drop'），不阻塞事件分发。
+    """
+    OVERFLOW_ACTIONS = ('busy', 'drop')
+
+    def __init__(self, handler, workers=8, queue_size=1000, overflow='busy'):
+        if overflow not in self.OVERFLOW_ACTIONS:
+            raise ValueError(f"未知的队列溢出处理方式：{overflow}")
+        self.handler = handler
+        self.workers = workers
+        self.overflow = overflow
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self._tasks = []
+        self.stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'failed': 0,
+            'depth_max': 0,
+        }
+        # 各阶段耗时：排队等待、处理（含持锁与数据操作，不含网络发送）
+        self.wait_seconds = Histogram("ingress_wait_seconds")
+        self.handle_seconds = Histogram("ingress_handle_seconds")
+
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def _shard(self, message):
+        return hash(str(message.author.id)) % self.workers
+
+    async def submit(self, message):
+        queue = self.queues[self._shard(message)]
+        try:
+            queue.put_nowait((message, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            logger.warning("入站队列已满，%s"
+                           "用户 %s 的消息。",
+                           '回复繁忙' if self.overflow == 'busy' else '丢弃', message.author.id)
+            if self.overflow == 'busy':
+                await message.reply(content=BUSY_REPLY)
+            return False
+        self.stats['accepted'] += 1
+        depth = self.depth()
+        if depth > self.stats['depth_max']:
+            self.stats['depth_max'] = depth
+        return True
+
+    async def _work(self, queue):
+        while True:
+            message, enqueued = await queue.get()
+            started = time.perf_counter()
+            self.wait_seconds.observe(started - enqueued)
+            try:
+                await self.handler(message)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.exception("处理消息时发生错误：%s", e)
+            finally:
+                self.handle_seconds.observe(time.perf_counter() - started)
+                queue.task_done()
+
+    def register_metrics(self, registry):
+        registry.stats('ingress', "入站处理计数", self.stats)
+        registry.gauge('ingress_depth', "入站队列中等待处理的消息数", self.depth)
+        registry.histogram('ingress_wait_seconds', "消息在入站队列中等待的耗时（秒）", self.wait_seconds)
+        registry.histogram('ingress_handle_seconds', "处理一条消息的耗时（秒），不含网络发送", self.handle_seconds)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work(queue)) for queue in self.queues]
+            logger.info("入站处理已启动，%s 个工作协程，每个队列容量 %s。",
+                        self.workers, self.queues[0].maxsize)
+
+    async def close(self, timeout=10.0):
+        """处理完已入队的消息后停止工作协程，超时后放弃剩余的消息。"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("入站队列未能在 %s 秒内处理完，放弃 %s 条消息。", timeout, self.depth())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("入站处理已关闭，接收 %s 条，拒绝 %s 条，"
+                    "排队 P99 %s 秒，处理 P99 %s 秒。",
+                    self.stats['accepted'], self.stats['rejected'],
+                    self.wait_seconds.quantile(0.99), self.handle_seconds.quantile(0.99))
@@ -0,0 +1,85 @@
+# Locks.py
+
+import asyncio
+import logging
+import time
+
+from Metrics import Histogram
+
+logger = logging.getLogger("Locks")
+
+
+class _HeldLocks:
+    def __init__(self, manager, keys, lock_class):
+        self.manager = manager
+        self.keys = keys
+        self.lock_class = lock_class
+        self.acquired = []
+
+    async def __aenter__(self):
+        manager = self.manager
+        started = time.perf_counter()
+        try:
+            for key in self.keys:
+                lock = manager._checkout(key)
+                self.acquired.append(key)
+                await lock.acquire()
+        except BaseException:
+            # 等待期间被取消：只释放已经拿到的锁
+            self._release(owned=len(self.acquired) - 1)
+            raise
+        manager.wait_seconds(self.lock_class).observe(time.perf_counter() - started)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release(owned=len(self.acquired))
+        return False
+
+    def _release(self, owned):
+        for index in range(len(self.acquired) - 1, -1, -1):
+            key = self.acquired[index]
+            if index < owned:
+                self.manager._locks[key].release()
+            self.manager._checkin(key)
+        self.acquired = []
+
+
+class LockManager:
+    """
+    按 key（通常是 internal_id）分段的锁，替代全局 data_lock。
+    acquire 可以一次锁多个 key，统一按排序后的顺序获取，玩家与负责人同时加锁时不会死锁。
+    锁对象只在有人持有或等待时存在，数量不随用户总数增长。
+    持锁期间不应等待网络 I/O。
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._refs = {}
+        self._wait_seconds = {}
+
+    def acquire(self, *keys, lock_class='user'):
+        keys = sorted({str(key) for key in keys if key is not None})
+        return _HeldLocks(self, keys, lock_class)
+
+    def wait_seconds(self, lock_class):
+        histogram = self._wait_seconds.get(lock_class)
+        if histogram is None:
+            histogram = self._wait_seconds[lock_class] = Histogram(f"lock_wait_seconds_{lock_class}")
+        return histogram
+
+    def wait_histograms(self):
+        return dict(self._wait_seconds)
+
+    def _checkout(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+            self._refs[key] = 0
+        self._refs[key] += 1
+        return lock
+
+    def _checkin(self, key):
+        self._refs[key] -= 1
+        if not self._refs[key]:
+            del self._refs[key]
+            del self._locks[key]
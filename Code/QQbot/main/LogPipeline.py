@@ -0,0 +1,164 @@
+# LogPipeline.py
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+logger = logging.getLogger("LogPipeline")
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# 参数都是这些类型时可以安全地留到后台线程再格式化
+_SCALARS = (str, int, float, bool, type(None))
+# LogRecord 自带的属性，其余属性来自 extra，作为结构化字段输出
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出一行 JSON：时间、级别、logger、消息、通过 extra 传入的字段，以及 fields 中的固定字段。"""
+
+    def __init__(self, fields=None):
+        super().__init__()
+        self.fields = dict(fields or {})
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(self.fields)
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    按 logger 名称限速的令牌桶：每个 logger 每秒最多 rate 条、最多突发 burst 条，超出的 WARNING 以下记录直接丢弃，
+    丢弃的条数记在该 logger 下一条放行记录的 dropped 字段中。limits 为 {logger 名称: 每秒条数}，单独覆盖 rate。
+    """
+
+    def __init__(self, rate=50.0, burst=200, limits=None, level=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.limits = dict(limits or {})
+        self.level = level
+        # logger 名称 -> [令牌, 上次补充时间, 未报告的丢弃条数]
+        self._buckets = {}
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        rate = self.limits.get(record.name, self.rate)
+        if not rate:
+            return True
+        bucket = self._buckets.get(record.name)
+        if bucket is None:
+            bucket = self._buckets[record.name] = [self.burst, record.created, 0]
+        tokens = min(self.burst, bucket[0] + (record.created - bucket[1]) * rate)
+        bucket[1] = record.created
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            self.dropped += 1
+            return False
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            record.dropped = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    只把记录放入内存队列，格式化与写盘都在监听线程中完成。
+    参数含有列表、字典等之后可能被修改的对象时在入队前格式化消息，基本类型的参数留给监听线程。
+    """
+
+    def prepare(self, record):
+        args = record.args
+        if args:
+            values = args.values() if isinstance(args, dict) else args
+            if not all(isinstance(value, _SCALARS) for value in values):
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+
+class LogPipeline:
+    """
+    非阻塞日志：根 logger 只挂一个 QueueHandler，由 QueueListener 的后台线程把记录写入按大小轮转的 JSON 日志文件
+    和（可选的）控制台。close 等待队列写完，之后的日志直接写入同样的处理器。
+    """
+
+    def __init__(self, filename, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=5, console=True,
+                 rate=50.0, burst=200, rate_limits=None, fields=None):
+        self.handlers = []
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter(fields))
+        self.handlers.append(file_handler)
+        if console:
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+            self.handlers.append(console_handler)
+
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = _LazyQueueHandler(self.queue)
+        self.rate_limit = RateLimitFilter(rate=rate, burst=burst, limits=rate_limits)
+        self.queue_handler.addFilter(self.rate_limit)
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+        root.setLevel(level)
+        root.addHandler(self.queue_handler)
+        self.listener.start()
+        # 异常退出时也把队列中剩余的日志写完
+        atexit.register(self.close)
+
+    def close(self):
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+        root = logging.getLogger()
+        root.removeHandler(self.queue_handler)
+        for handler in self.handlers:
+            root.addHandler(handler)
+
+
+def setup_logging(options, filename, console=True, fields=None):
+    """按配置中的 logging 部分启动日志管道，返回 LogPipeline，退出前调用 close。"""
+    options = options or {}
+    level = str(options.get('level', 'INFO')).upper()
+    if not isinstance(logging.getLevelName(level), int):
+        logger.error("配置项 logging.level 无效：%s，可选 DEBUG、INFO、WARNING、ERROR。", level)
+        exit(1)
+    return LogPipeline(
+        filename,
+        level=level,
+        max_bytes=int(options.get('max_bytes', 10 * 1024 * 1024)),
+        backup_count=int(options.get('backup_count', 5)),
+        console=console and bool(options.get('console', True)),
+        rate=float(options.get('rate', 50)),
+        burst=int(options.get('burst', 200)),
+        rate_limits=options.get('rate_limits') or {},
+        fields=fields
+    )
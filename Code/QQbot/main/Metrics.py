@@ -0,0 +1,138 @@
+# Metrics.py
+
+import bisect
+
+# 默认桶（秒），覆盖从亚毫秒的锁等待到数秒的网络往返
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        # 最后一格是 +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """返回 [(上界, 累计次数)]，最后一项上界为 inf。"""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """按桶上界估算分位数。"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        for bound, total in self.cumulative():
+            if total >= target:
+                return bound
+        return float('inf')
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        if isinstance(value, float):
+            value = _format_value(value)
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def histogram_samples(histogram, labels=()):
+    """把直方图转成 Prometheus 的 _bucket / _sum / _count 样本。"""
+    samples = [('_bucket', labels + (('le', bound),), total) for bound, total in histogram.cumulative()]
+    samples.append(('_sum', labels, histogram.sum))
+    samples.append(('_count', labels, histogram.count))
+    return samples
+
+
+class MetricsRegistry:
+    """
+    指标注册表：各模块在启动时登记自己的直方图和取值函数，抓取时才读取当前值，热路径上没有额外开销。
+    collect 返回 [(名称, 类型, 说明, [(后缀, 标签, 值)])]，只含基本类型，分片进程可以直接交给协调进程合并。
+    """
+
+    def __init__(self, prefix='dwgx_'):
+        self.prefix = prefix
+        self._families = {}
+
+    def _add(self, name, kind, help, source):
+        name = self.prefix + name
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help, [])
+        elif family[0] != kind:
+            raise ValueError(f"指标 {name} 已登记为 {family[0]}，不能再登记为 {kind}")
+        family[2].append(source)
+
+    def histogram(self, name, help, histogram, **labels):
+        labels = tuple(labels.items())
+        self._add(name, 'histogram', help, lambda: histogram_samples(histogram, labels))
+
+    def histograms(self, name, help, label, getter):
+        """getter 返回 {标签值: Histogram}，用于运行中才出现的分类，例如锁类别、命令。"""
+        def source():
+            samples = []
+            for value, histogram in sorted(getter().items()):
+                samples.extend(histogram_samples(histogram, ((label, value),)))
+            return samples
+        self._add(name, 'histogram', help, source)
+
+    def gauge(self, name, help, getter, **labels):
+        labels = tuple(labels.items())
+        self._add(name, 'gauge', help, lambda: [('', labels, getter())])
+
+    def stats(self, name, help, stats):
+        """把模块的 stats 字典整体导出为一个按 stat 标签区分的 gauge，其中的累计次数只增不减。"""
+        self._add(name, 'gauge', help, lambda: [('', (('stat', key),), value) for key, value in stats.items()])
+
+    def collect(self):
+        return [(name, kind, help, [sample for source in sources for sample in source()])
+                for name, (kind, help, sources) in self._families.items()]
+
+
+def merge_families(groups):
+    """合并多组 collect 的结果，groups 为 [(附加标签, 指标族列表)]，例如各分片附加 shard 标签。"""
+    merged = {}
+    for extra, families in groups:
+        extra = tuple(extra)
+        for name, kind, help, samples in families:
+            family = merged.setdefault(name, (kind, help, []))
+            family[2].extend((suffix, extra + tuple(labels), value) for suffix, labels, value in samples)
+    return [(name, kind, help, samples) for name, (kind, help, samples) in merged.items()]
+
+
+def render(families):
+    """按 Prometheus 文本格式（0.0.4）输出。"""
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+    lines.append('')
+    return '\n'.join(lines)
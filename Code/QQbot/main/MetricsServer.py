@@ -0,0 +1,42 @@
+# MetricsServer.py
+
+import logging
+
+from aiohttp import web
+
+from Metrics import render
+
+logger = logging.getLogger("MetricsServer")
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsServer:
+    """
+    本地 HTTP 指标端点：GET /metrics 返回 Prometheus 文本格式。
+    collect 为协程函数，返回 MetricsRegistry.collect 格式的指标族列表；分片部署时由它向各分片收集。
+    """
+
+    def __init__(self, collect, host='127.0.0.1', port=9108):
+        self.collect = collect
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request):
+        families = await self.collect()
+        return web.Response(body=render(families).encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        # 不记录每次抓取的访问日志
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("指标端点已启动：http://%s:%s/metrics", self.host, self.port)
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,47 @@
+# MigrateToSqlite.py
+# 一次性把现有的 data.json（连同未压缩的 journal）导入 SQLite 数据库。
+# 用法：python MigrateToSqlite.py [data.json] [data.db]
+# 导入完成后在 config.yaml 中设置 persistence.backend: sqlite 即可切换。
+
+import logging
+import sys
+
+from Storage import JsonStorage, SqliteStorage, replace_sets
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("MigrateToSqlite")
+
+
+def migrate(data_file, db_file):
+    json_storage = JsonStorage(data_file)
+    if not json_storage.has_data():
+        logger.error("数据文件 %s 不存在。", data_file)
+        return False
+
+    data, seq = json_storage.load()
+    # 合并磁盘归档段中的早期历史
+    for internal_id, segments in data.pop("history_archive", {}).items():
+        archived = json_storage.read_archive(internal_id, segments)
+        data["game_history"][internal_id] = archived + data["game_history"].get(internal_id, [])
+    storage = SqliteStorage(db_file)
+    try:
+        if not storage.is_empty():
+            logger.error("数据库 %s 中已有数据，为避免重复导入已中止。", db_file)
+            return False
+        data_copy = replace_sets(data)
+        data_copy["_journal_seq"] = seq
+        storage.write_snapshot(data_copy)
+    finally:
+        storage.close()
+
+    history_count = sum(len(v) for v in data["game_history"].values())
+    logger.info("导入完成：用户 %s 个，历史记录 %s 条，"
+                "期号水位线 %s，红包 %s 个。",
+                len(data['user_data']), history_count, data['id_watermark'], len(data['red_envelopes']))
+    return True
+
+
+if __name__ == "__main__":
+    data_file = sys.argv[1] if len(sys.argv) > 1 else 'data.json'
+    db_file = sys.argv[2] if len(sys.argv) > 2 else 'data.db'
+    sys.exit(0 if migrate(data_file, db_file) else 1)
@@ -0,0 +1,176 @@
+# Outbox.py
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+from botpy.errors import ServerError
+
+from Metrics import Histogram
+
+logger = logging.getLogger("Outbox")
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 capacity 个，每次发送消耗一个。"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _Outgoing:
+    __slots__ = ('message', 'content', 'kwargs', 'enqueued', 'received')
+
+    def __init__(self, message, content, kwargs, received):
+        self.message = message
+        self.content = content
+        self.kwargs = kwargs
+        self.enqueued = time.perf_counter()
+        self.received = received
+
+
+class OutboundMessage:
+    """
+    收到的消息的代理：reply 只把回复放入发送队列后立即返回，其余属性转给原消息。
+    处理函数照常 await message.reply(...)，不再等待 HTTP 往返。
+    """
+
+    def __init__(self, outbox, message):
+        self._outbox = outbox
+        self._message = message
+        # 收到消息的时间，用于统计从收到到回复发出的往返耗时
+        self._received = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    async def reply(self, content=None, **kwargs):
+        self._outbox.send(self._message, content, received=self._received, **kwargs)
+
+
+class Outbox:
+    """
+    出站发送队列：每个频道一个队列和一个令牌桶，由该频道的后台任务按速率依次发送。
+    回复同一条消息的连续纯文本在等待令牌期间合并为一条（不超过 max_length），
+    服务端错误按指数退避重试，其余错误记录后丢弃。
+    """
+
+    def __init__(self, rate=5.0, burst=5, linger=0.0, max_retries=3, retry_delay=0.5, max_length=2000):
+        self.rate = rate
+        self.burst = burst
+        # 频道队列开始发送前的等待秒数，让同一处理函数接连发出的回复先合并
+        self.linger = linger
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_length = max_length
+        self._queues = {}
+        self._workers = {}
+        self._buckets = {}
+        self.stats = {
+            'enqueued': 0,
+            'merged': 0,
+            'sent': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+        # 从入队到发送成功的耗时，包括限速等待与重试
+        self.delay_seconds = Histogram("outbox_delay_seconds")
+        # 单次发送请求的 HTTP 往返耗时
+        self.send_seconds = Histogram("outbox_send_seconds")
+        # 从收到消息到回复发送成功的耗时，只统计调用方给出收到时间的回复
+        self.reply_seconds = Histogram("reply_seconds")
+
+    def depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def wrap(self, message):
+        return OutboundMessage(self, message)
+
+    def register_metrics(self, registry):
+        registry.stats('outbox', "出站发送计数", self.stats)
+        registry.gauge('outbox_depth', "出站队列中等待发送的消息数", self.depth)
+        registry.histogram('outbox_delay_seconds', "回复从入队到发送成功的耗时（秒），含限速等待与重试", self.delay_seconds)
+        registry.histogram('outbox_send_seconds', "单次发送请求的耗时（秒）", self.send_seconds)
+        registry.histogram('reply_seconds', "从收到消息到回复发送成功的耗时（秒）", self.reply_seconds)
+
+    def send(self, message, content=None, received=None, **kwargs):
+        channel_id = getattr(message, 'channel_id', None)
+        queue = self._queues.setdefault(channel_id, deque())
+        self.stats['enqueued'] += 1
+        if content is not None and not kwargs and queue:
+            last = queue[-1]
+            if (last.message is message and not last.kwargs and last.content is not None
+                    and len(last.content) + 1 + len(content) <= self.max_length):
+                last.content = f"{last.content}\n{content}"
+                self.stats['merged'] += 1
+                return
+        queue.append(_Outgoing(message, content, kwargs, received))
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._drain(channel_id, queue))
+
+    async def _drain(self, channel_id, queue):
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = self._buckets[channel_id] = TokenBucket(self.rate, self.burst)
+        try:
+            if self.linger:
+                await asyncio.sleep(self.linger)
+            while queue:
+                # 等待令牌期间队首仍可合并新的回复，取出后才不再修改
+                await bucket.take()
+                await self._deliver(queue.popleft())
+        finally:
+            self._workers.pop(channel_id, None)
+            if not queue:
+                self._queues.pop(channel_id, None)
+
+    async def _deliver(self, item):
+        for attempt in range(self.max_retries + 1):
+            try:
+                started = time.perf_counter()
+                await item.message.reply(content=item.content, **item.kwargs)
+                now = time.perf_counter()
+                self.stats['sent'] += 1
+                self.send_seconds.observe(now - started)
+                self.delay_seconds.observe(now - item.enqueued)
+                if item.received is not None:
+                    self.reply_seconds.observe(now - item.received)
+                return
+            except ServerError as e:
+                if attempt == self.max_retries:
+                    logger.error("发送消息失败，已重试 %s 次：%s", attempt, e)
+                    break
+                delay = self.retry_delay * 2 ** attempt
+                self.stats['retried'] += 1
+                logger.warning("发送消息失败：%s，%s 秒后重试。", e, delay)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logger.exception("发送消息时发生错误：%s", e)
+                break
+        self.stats['failed'] += 1
+
+    async def close(self, timeout=10.0):
+        """等待队列中的消息发送完毕，超时后放弃剩余的消息。"""
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        done, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        dropped = self.depth()
+        logger.info("发送队列已关闭，共发送 %s 条，合并 %s 条，"
+                    "放弃 %s 条。", self.stats['sent'], self.stats['merged'], dropped)
@@ -0,0 +1,132 @@
+# Payouts.py
+# 骰宝赔付表：每种投入类型在点数 3~18 下的倍数在启动时一次算好，结算时直接查表。
+# 直接运行可打印各投入类型的中奖概率、期望返还与庄家优势：python Payouts.py
+
+from fractions import Fraction
+from itertools import product
+
+try:
+    import numpy as np
+except ImportError:  # NumPy 为可选依赖，缺失时批量计算使用纯 Python 实现
+    np = None
+
+MIN_TOTAL = 3
+MAX_TOTAL = 18
+
+
+def _total_distribution():
+    counts = [0] * (MAX_TOTAL + 1)
+    for dice in product(range(1, 7), repeat=3):
+        counts[sum(dice)] += 1
+    return tuple(Fraction(c, 216) for c in counts)
+
+
+# 三颗骰子点数和的精确分布，按点数下标（0~2 为 0）
+TOTAL_PROBABILITIES = _total_distribution()
+
+
+def bet_wins(bet_type, total):
+    if bet_type == '大':
+        return 11 <= total <= 18
+    elif bet_type == '小':
+        return 3 <= total <= 10
+    elif bet_type == '双':
+        return 3 <= total <= 18 and total % 2 == 0
+    elif bet_type == '单':
+        return 3 <= total <= 18 and total % 2 != 0
+    elif bet_type.isdigit():
+        return int(bet_type) == total
+    return False
+
+
+class PayoutTable:
+    # 批量结算时投入数达到该值才使用 NumPy，更小的批次纯 Python 更快
+    VECTORIZE_MIN = 64
+
+    def __init__(self, multipliers):
+        # 投入类型 -> 按点数下标的倍数元组，未中为 0
+        self.matrix = {
+            bet_type: tuple(multiplier if bet_wins(bet_type, total) else 0 for total in range(MAX_TOTAL + 1))
+            for bet_type, multiplier in multipliers.items()
+        }
+        # 批量计算用的行号；最后一行全为 0，对应未知的投入类型
+        self.row_index = {bet_type: index for index, bet_type in enumerate(self.matrix)}
+        self.rows = list(self.matrix.values()) + [(0,) * (MAX_TOTAL + 1)]
+        self.array = np.array(self.rows, dtype=np.float64) if np is not None else None
+
+    def multiplier(self, bet_type, total):
+        row = self.matrix.get(bet_type)
+        if row is None or not MIN_TOTAL <= total <= MAX_TOTAL:
+            return 0
+        return row[total]
+
+    def batch_winnings(self, bet_types, amounts, totals):
+        """
+        一次算出多注投入的奖励：第 i 注为 bet_types[i] 投入 amounts[i]、点数为 totals[i]，未中为 0。
+        取整方式与 int(金额 * 倍数) 相同。
+        """
+        unknown = len(self.rows) - 1
+        rows = [self.row_index.get(bet_type, unknown) for bet_type in bet_types]
+        if self.array is not None and len(rows) >= self.VECTORIZE_MIN:
+            multipliers = self.array[np.asarray(rows), np.asarray(totals)]
+            return np.trunc(multipliers * np.asarray(amounts, dtype=np.float64)).astype(np.int64).tolist()
+        return [int(amount * self.rows[row][total]) for row, amount, total in zip(rows, amounts, totals)]
+
+    def slip_payouts(self, bets):
+        """一张投入单在每个点数下应付给玩家的代币，与结算时逐注取整的方式一致。"""
+        payouts = [0] * (MAX_TOTAL + 1)
+        for bet in bets:
+            row = self.matrix.get(bet['type'])
+            if row is None:
+                continue
+            for total in range(MIN_TOTAL, MAX_TOTAL + 1):
+                if row[total]:
+                    payouts[total] += int(bet['amount'] * row[total])
+        return payouts
+
+    def slip_boss_deltas(self, bets):
+        """
+        一张投入单在每个点数下负责人余额的变化，与 Gambling._settle_game 一致：
+        中奖的注由负责人支付全部奖励，未中的注投入归负责人。
+        """
+        deltas = [0] * (MAX_TOTAL + 1)
+        for bet in bets:
+            row = self.matrix.get(bet['type'])
+            if row is None:
+                continue
+            for total in range(MIN_TOTAL, MAX_TOTAL + 1):
+                winnings = int(bet['amount'] * row[total])
+                deltas[total] += -winnings if winnings > 0 else bet['amount']
+        return deltas
+
+    def worst_case_liability(self, bets):
+        """负责人在最坏点数下需要支付的代币。"""
+        return max(self.slip_payouts(bets))
+
+    def expected_return(self, bets):
+        """玩家的期望返还（精确分数）。"""
+        payouts = self.slip_payouts(bets)
+        return sum(TOTAL_PROBABILITIES[t] * payouts[t] for t in range(MIN_TOTAL, MAX_TOTAL + 1))
+
+    def house_edge(self, bets):
+        """庄家优势 = 1 - 期望返还 / 总投入，负数表示对玩家有利。"""
+        stake = sum(bet['amount'] for bet in bets)
+        if stake <= 0:
+            return 0.0
+        return float(1 - self.expected_return(bets) / stake)
+
+    def win_probability(self, bet_type):
+        row = self.matrix.get(bet_type)
+        if row is None:
+            return Fraction(0)
+        return sum(TOTAL_PROBABILITIES[t] for t in range(MIN_TOTAL, MAX_TOTAL + 1) if row[t])
+
+
+if __name__ == "__main__":
+    from Gambling import BET_MULTIPLIERS
+    table = PayoutTable(BET_MULTIPLIERS)
+    print(f"{'类型':<6}{'倍数':>8}{'中奖概率':>12}{'期望返还':>10}{'庄家优势':>10}")
+    for bet_type, multiplier in BET_MULTIPLIERS.items():
+        probability = table.win_probability(bet_type)
+        edge = table.house_edge([{'type': bet_type, 'amount': 1000}])
+        print(f"{bet_type:<6}{multiplier:>8}{float(probability):>12.4%}{1 - edge:>10.4f}{edge:>10.2%}")
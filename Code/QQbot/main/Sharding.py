@@ -0,0 +1,109 @@
+# Sharding.py
+
+import logging
+import os
+import zlib
+
+from IdService import ALPHABET
+from Storage import create_storage, empty_data, replace_sets
+
+logger = logging.getLogger("Sharding")
+
+
+def shard_of(key, count):
+    """按 CRC32 把 internal_id 或 userid 映射到分片，跨进程、跨重启稳定（不受 hash 随机化影响）。"""
+    return zlib.crc32(str(key).encode('utf-8')) % count
+
+
+def period_shard(period_number, count):
+    """
+    期号最后一位是签发它的节点编号，分片部署时节点编号即分片序号，据此找到红包所在的分片。
+    旧期号的末位无法对应到分片时退回按期号散列。拆分前的旧红包随发送者放置，不一定符合这一规则，
+    由协调进程另行记录路由。
+    """
+    node = ALPHABET.find(period_number[-1:])
+    if 0 <= node < count:
+        return node
+    return shard_of(period_number, count)
+
+
+def shard_file(path, index):
+    """data.json -> data.shard0.json，data.db -> data.shard0.db。"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{index}{ext}"
+
+
+def shard_persistence(persistence, index):
+    """返回第 index 个分片使用的持久化配置，SQLite 后端各分片使用独立的数据库文件。"""
+    persistence = dict(persistence)
+    persistence['sqlite_file'] = shard_file(persistence.get('sqlite_file', 'data.db'), index)
+    return persistence
+
+
+def split_data(data, count):
+    """
+    把一份完整数据拆成 count 份：用户及其历史、进行中游戏按 internal_id 分片，
+    红包放在发送者所在的分片（撤回时在本分片返还），找不到发送者的按期号分片；
+    负责人与期号水位线每个分片各存一份。
+    """
+    shards = [empty_data() for _ in range(count)]
+    for shard in shards:
+        shard["boss_id"] = data["boss_id"]
+        shard["id_watermark"] = data["id_watermark"]
+    for internal_id, user in data["user_data"].items():
+        shard = shards[shard_of(internal_id, count)]
+        shard["user_data"][internal_id] = user
+        userid = data["internal_to_userid"].get(internal_id)
+        if userid:
+            shard["internal_to_userid"][internal_id] = userid
+            shard["userid_to_internal"][userid] = internal_id
+    for internal_id, records in data["game_history"].items():
+        shards[shard_of(internal_id, count)]["game_history"][internal_id] = records
+    for internal_id, state in data["active_games"].items():
+        shards[shard_of(internal_id, count)]["active_games"][internal_id] = state
+    for period_number, envelope in data["red_envelopes"].items():
+        sender_id = envelope.get('sender_id')
+        if sender_id in data["user_data"]:
+            index = shard_of(sender_id, count)
+        else:
+            index = period_shard(period_number, count)
+        shards[index]["red_envelopes"][period_number] = envelope
+    return shards
+
+
+def split_store(persistence, data_file, count):
+    """
+    首次以 count 个分片启动时，把现有的单进程数据拆分写入各分片的存储。
+    任一分片已有数据时不做任何修改，返回 False。
+    """
+    targets = [create_storage(shard_persistence(persistence, index), shard_file(data_file, index))
+               for index in range(count)]
+    try:
+        for target in targets:
+            data, _ = target.load()
+            if data["user_data"] or data["boss_id"]:
+                return False
+
+        source = create_storage(persistence, data_file)
+        try:
+            data, _ = source.load()
+            # 历史记录全部随用户搬到所在分片：合并磁盘归档段，SQLite 后端逐个用户读出
+            for internal_id, segments in data.pop("history_archive", {}).items():
+                archived = source.read_archive(internal_id, segments)
+                data["game_history"][internal_id] = archived + data["game_history"].get(internal_id, [])
+            if not source.history_in_memory:
+                for internal_id in data["user_data"]:
+                    data["game_history"][internal_id] = source.load_history(internal_id)
+        finally:
+            source.close()
+
+        for index, (target, shard) in enumerate(zip(targets, split_data(data, count))):
+            data_copy = replace_sets(shard)
+            data_copy["_journal_seq"] = 0
+            target.write_snapshot(data_copy)
+            logger.info("分片 %s：用户 %s 个，红包 %s 个。",
+                        index, len(shard['user_data']), len(shard['red_envelopes']))
+        return True
+    finally:
+        for target in targets:
+            target.close()
@@ -0,0 +1,158 @@
+# Simulate.py
+# 蒙特卡洛模拟：按投入单组合随机摇骰，用与结算相同的赔付表计算负责人余额变化，
+# 报告各投入类型的返还率（RTP）、负责人破产时间分布与终局余额方差。需要 NumPy。
+# 用法：python Simulate.py [--rounds 1e8] [--paths 1000] [--bankroll 1000000] [--workers N]
+#                          [--seed 种子] [--mix "大100" "s50 dan20:0.5" ...]
+# --mix 的每一项为一张投入单（与聊天中的投入语法相同），可用 ":权重" 指定出现的相对频率。
+
+import argparse
+import logging
+import multiprocessing
+import sys
+import time
+
+from Gambling import BET_MULTIPLIERS, parse_bets
+from Payouts import MAX_TOTAL, MIN_TOTAL, TOTAL_PROBABILITIES, PayoutTable, np
+
+DEFAULT_MIX = ['大100', '双100', '7y100', '大100 7y10']
+# 每块模拟的局数，控制单个进程的内存占用
+BLOCK_ROUNDS = 1 << 20
+WIDTH = MAX_TOTAL + 1
+
+
+def parse_mix(items):
+    """把 "投入单[:权重]" 列表解析为 [(投入单文本, 投入列表, 权重)]。"""
+    slips = []
+    for item in items:
+        text, _, weight = item.rpartition(':')
+        if not text or not weight.replace('.', '', 1).isdigit():
+            text, weight = item, '1'
+        bets = parse_bets(text)
+        if not bets:
+            raise ValueError(f"无法解析投入单：{item}")
+        slips.append((text, bets, float(weight)))
+    return slips
+
+
+def simulate_paths(task):
+    """
+    模拟 n_paths 条独立的负责人余额路径，每条 horizon 局。
+    返回 (点数直方图, 投入单×点数联合直方图, 终局余额数组, 破产时间数组)，未破产的路径破产时间为 0。
+    """
+    deltas, weights, n_paths, horizon, bankroll, seed_seq = task
+    rng = np.random.default_rng(seed_seq)
+    slip_count = deltas.shape[0]
+    flat_deltas = deltas.ravel()
+    joint = np.zeros(slip_count * WIDTH, dtype=np.int64)
+    finals = np.empty(n_paths, dtype=np.int64)
+    ruins = np.zeros(n_paths, dtype=np.int64)
+
+    for path in range(n_paths):
+        balance = bankroll
+        done = 0
+        while done < horizon:
+            size = min(BLOCK_ROUNDS, horizon - done)
+            totals = rng.integers(1, 7, size=(size, 3), dtype=np.int8).sum(axis=1, dtype=np.int64)
+            if slip_count > 1:
+                cells = rng.choice(slip_count, size=size, p=weights) * WIDTH + totals
+            else:
+                cells = totals
+            running = np.cumsum(flat_deltas[cells]) + balance
+            if not ruins[path]:
+                below = np.flatnonzero(running < 0)
+                if below.size:
+                    ruins[path] = done + below[0] + 1
+            joint += np.bincount(cells, minlength=slip_count * WIDTH)
+            balance = int(running[-1])
+            done += size
+        finals[path] = balance
+
+    joint = joint.reshape(slip_count, WIDTH)
+    return joint.sum(axis=0), joint, finals, ruins
+
+
+def split_tasks(paths, horizon, bankroll, deltas, weights, workers, seed):
+    chunks = min(paths, workers * 4)
+    seeds = np.random.SeedSequence(seed).spawn(chunks)
+    sizes = [paths // chunks + (1 if i < paths % chunks else 0) for i in range(chunks)]
+    return [(deltas, weights, size, horizon, bankroll, seeds[i]) for i, size in enumerate(sizes)]
+
+
+def report(table, slips, deltas, totals_hist, joint, finals, ruins, rounds, bankroll, horizon, elapsed):
+    print(f"模拟 {rounds:,} 局（{len(finals)} 条路径 × {horizon:,} 局），耗时 {elapsed:.1f} 秒，"
+          f"{rounds / elapsed / 1e6:.1f} 百万局/秒")
+
+    print(f"\n{'类型':<6}{'理论 RTP':>10}{'模拟 RTP':>10}")
+    frequencies = totals_hist / totals_hist.sum()
+    for bet_type in BET_MULTIPLIERS:
+        exact = 1 - table.house_edge([{'type': bet_type, 'amount': 1000}])
+        row = np.asarray(table.matrix[bet_type], dtype=np.float64)
+        print(f"{bet_type:<6}{exact:>10.4f}{float(frequencies @ row):>10.4f}")
+
+    print(f"\n{'投入单':<20}{'局数':>14}{'理论 RTP':>10}{'模拟 RTP':>10}{'负责人每局期望':>16}{'模拟':>12}")
+    for index, (text, bets, _) in enumerate(slips):
+        stake = sum(bet['amount'] for bet in bets)
+        played = int(joint[index].sum())
+        payouts = np.asarray(table.slip_payouts(bets), dtype=np.float64)
+        simulated = float(joint[index] @ payouts) / (played * stake) if played else 0.0
+        exact = 1 - table.house_edge(bets)
+        # 与 simulate_paths 使用同一份负责人余额变化，并非 投入 - 玩家返还：中奖的注投入不归负责人
+        boss_mean = float(sum(TOTAL_PROBABILITIES[t] * int(deltas[index][t]) for t in range(MIN_TOTAL, MAX_TOTAL + 1)))
+        boss_simulated = float(joint[index] @ deltas[index]) / played if played else 0.0
+        print(f"{text:<20}{played:>14,}{exact:>10.4f}{simulated:>10.4f}{boss_mean:>16.2f}{boss_simulated:>12.2f}")
+
+    profits = finals - bankroll
+    print(f"\n负责人初始余额 {bankroll:,}，每条路径 {horizon:,} 局")
+    print(f"终局盈亏：均值 {profits.mean():,.1f}，标准差 {profits.std():,.1f}，方差 {profits.var():,.1f}")
+    ruined = ruins[ruins > 0]
+    print(f"破产路径：{ruined.size}/{len(ruins)}（{ruined.size / len(ruins):.2%}）")
+    if ruined.size:
+        p10, p50, p90 = np.percentile(ruined, [10, 50, 90])
+        print(f"破产时间（局）：最短 {ruined.min():,}，P10 {p10:,.0f}，中位数 {p50:,.0f}，"
+              f"P90 {p90:,.0f}，最长 {ruined.max():,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="骰宝负责人余额蒙特卡洛模拟")
+    parser.add_argument('--rounds', type=float, default=1e7, help="总局数")
+    parser.add_argument('--paths', type=int, default=1000, help="独立的负责人余额路径数")
+    parser.add_argument('--bankroll', type=int, default=1000000, help="负责人初始余额")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="进程数")
+    parser.add_argument('--seed', type=int, default=None, help="随机种子，指定后结果可复现")
+    parser.add_argument('--mix', nargs='+', default=DEFAULT_MIX, help="投入单[:权重]")
+    args = parser.parse_args()
+
+    if np is None:
+        print("模拟需要 NumPy：pip install numpy")
+        sys.exit(1)
+    # 投入解析会记录日志，模拟时关闭
+    logging.disable(logging.CRITICAL)
+
+    try:
+        slips = parse_mix(args.mix)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    horizon = max(1, int(args.rounds) // args.paths)
+    rounds = horizon * args.paths
+
+    table = PayoutTable(BET_MULTIPLIERS)
+    deltas = np.array([table.slip_boss_deltas(bets) for _, bets, _ in slips], dtype=np.int64)
+    weights = np.array([weight for _, _, weight in slips], dtype=np.float64)
+    weights /= weights.sum()
+
+    tasks = split_tasks(args.paths, horizon, args.bankroll, deltas, weights, args.workers, args.seed)
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.workers) as pool:
+        results = pool.map(simulate_paths, tasks)
+    elapsed = time.perf_counter() - start
+
+    totals_hist = sum(result[0] for result in results)
+    joint = sum(result[1] for result in results)
+    finals = np.concatenate([result[2] for result in results])
+    ruins = np.concatenate([result[3] for result in results])
+    report(table, slips, deltas, totals_hist, joint, finals, ruins, rounds, args.bankroll, horizon, elapsed)
+
+
+if __name__ == "__main__":
+    main()
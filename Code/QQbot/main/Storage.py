@@ -0,0 +1,595 @@
+# Storage.py
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import logging
+import threading
+import time
+
+from History import HistoryRecord, json_default
+
+logger = logging.getLogger("Storage")
+
+
+def replace_sets(obj):
+    if isinstance(obj, set):
+        return list(obj)
+    elif isinstance(obj, dict):
+        return {k: replace_sets(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [replace_sets(item) for item in obj]
+    else:
+        return obj
+
+
+def atomic_write(path, content):
+    """先写临时文件并 fsync，再原子替换目标文件，崩溃时旧文件保持完整。"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        # 同步目录项，保证重命名本身落盘
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def empty_data():
+    return {
+        "boss_id": None,
+        "user_data": {},
+        "game_history": {},
+        "red_envelopes": {},
+        "internal_to_userid": {},
+        "userid_to_internal": {},
+        "history_archive": {},
+        "active_games": {},
+        "id_watermark": None,
+        "shard": {}
+    }
+
+
+def advance_watermark(data, period_number):
+    """期号水位线只记录签发过的最大期号，重启后的期号从它之后开始。"""
+    if period_number and (data.get("id_watermark") is None or period_number > data["id_watermark"]):
+        data["id_watermark"] = period_number
+
+
+def normalize_data(data):
+    data.setdefault("boss_id", None)
+    data.setdefault("user_data", {})
+    data.setdefault("game_history", {})
+    data.setdefault("red_envelopes", {})
+    data.setdefault("internal_to_userid", {})
+    data.setdefault("userid_to_internal", {})
+    # 每个用户已归档的历史段文件名，按时间顺序排列
+    data.setdefault("history_archive", {})
+    # 进行中游戏的检查点：internal_id -> 游戏状态，见 Gambling.checkpoint_game
+    data.setdefault("active_games", {})
+    data.setdefault("id_watermark", None)
+    # 分片部署时本分片的协调状态（如负责人待同步流水），见 Cluster.ShardBoss
+    data.setdefault("shard", {})
+    # 旧版保存全部已签发期号的集合，迁移为只保留最大值的水位线
+    for period_number in data["game_history"].pop("period_numbers", []):
+        advance_watermark(data, period_number)
+    for period_number in data["red_envelopes"]:
+        advance_watermark(data, period_number)
+    for records in data["game_history"].values():
+        # 旧版字典格式的记录在此统一转换
+        records[:] = [HistoryRecord.from_json(r) for r in records]
+    return data
+
+
+def apply_record(data, record):
+    """把一条变更记录应用到内存数据上。记录格式见 DataManager._collect_records。"""
+    op = record['o']
+    value = record.get('v')
+    if op == 'u':
+        internal_id = record['i']
+        data["user_data"][internal_id] = value
+        if value.get('userid'):
+            data["internal_to_userid"][internal_id] = value['userid']
+            data["userid_to_internal"][value['userid']] = internal_id
+    elif op == 'h':
+        data["game_history"].setdefault(record['i'], []).append(HistoryRecord.from_json(value))
+    elif op == 'e':
+        if value is None:
+            data["red_envelopes"].pop(record['i'], None)
+        else:
+            data["red_envelopes"][record['i']] = value
+    elif op == 'b':
+        data["boss_id"] = value
+    elif op == 'p':
+        # 旧版 journal 中每个期号一条，新版为最新的水位线，处理方式相同
+        advance_watermark(data, value)
+    elif op == 'g':
+        if value is None:
+            data["active_games"].pop(record['i'], None)
+        else:
+            data["active_games"][record['i']] = value
+    elif op == 'k':
+        data["shard"][record['i']] = value
+    elif op == 'q':
+        data["shard"].setdefault(record['i'], []).append(value)
+    else:
+        logger.warning("未知的变更记录类型：%s", op)
+
+
+class StorageBackend:
+    """
+    存储后端接口。
+    DataManager 把每次刷新收集到的变更记录交给 append，需要完整落盘时调用
+    begin_compaction / write_snapshot / end_compaction。write_snapshot 在工作线程中执行。
+    """
+    # 为 False 时 game_history 不常驻内存，读取历史需经由 load_history
+    history_in_memory = True
+    # 为 False 时压缩不写快照：每次追加已直接更新全部数据，只调用 end_compaction
+    snapshot_on_compaction = True
+
+    def load(self):
+        """返回 (data, 最后一条记录的序号)。"""
+        raise NotImplementedError
+
+    def append(self, records):
+        raise NotImplementedError
+
+    def load_history(self, internal_id):
+        raise NotImplementedError
+
+    def needs_compaction(self, threshold):
+        return False
+
+    def has_pending(self):
+        return False
+
+    def begin_compaction(self):
+        pass
+
+    def write_snapshot(self, data_copy):
+        raise NotImplementedError
+
+    def end_compaction(self):
+        pass
+
+    def write_archive(self, batches):
+        """把 [(internal_id, 段文件名, 记录列表)] 写成压缩归档段。"""
+        raise NotImplementedError
+
+    def read_archive(self, internal_id, segments):
+        return []
+
+    def close(self):
+        pass
+
+
+class JsonStorage(StorageBackend):
+    """
+    带代号的 JSON 快照 + 追加式 journal。
+    快照文件名形如 data.000012.json，首行是包含代号和 SHA-256 校验和的文件头，其后是数据本体。
+    启动时选用最新且校验通过的一代；每代对应的 journal 段（data.000012.journal）与快照一起按环形保留，
+    因此即使最新快照损坏，也能从上一代快照重放到最新状态。
+    """
+    HEADER_VERSION = 1
+
+    def __init__(self, data_file, keep_generations=5):
+        self.data_file = data_file
+        self.base, self.ext = os.path.splitext(data_file)
+        self.keep_generations = max(1, keep_generations)
+        self.journal_file = self.base + '.journal'
+        self.journal_old_file = self.journal_file + '.old'
+        self.archive_dir = self.base + '.archive'
+        self.journal_size = 0
+        self.generation = 0
+        self._generation_re = re.compile(
+            re.escape(os.path.basename(self.base)) + r'\.(\d{6,})(' + re.escape(self.ext) + r'|\.journal)$'
+        )
+
+    def _generation_path(self, generation):
+        return f"{self.base}.{generation:06d}{self.ext}"
+
+    def _segment_path(self, generation):
+        return f"{self.base}.{generation:06d}.journal"
+
+    def _list_files(self):
+        """返回 ({代号: 快照路径}, {代号: journal 段路径})。"""
+        directory = os.path.dirname(os.path.abspath(self.data_file))
+        snapshots, segments = {}, {}
+        for name in os.listdir(directory):
+            match = self._generation_re.match(name)
+            if not match:
+                continue
+            target = segments if match.group(2) == '.journal' else snapshots
+            target[int(match.group(1))] = os.path.join(directory, name)
+        return snapshots, segments
+
+    def has_data(self):
+        snapshots, _ = self._list_files()
+        return bool(snapshots) or os.path.exists(self.data_file)
+
+    def _read_generation(self, path):
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            payload = f.read()
+        if len(payload) != header['length'] or hashlib.sha256(payload).hexdigest() != header['sha256']:
+            raise ValueError("校验和不匹配")
+        return json.loads(payload)
+
+    def load(self):
+        started = time.perf_counter()
+        snapshots, _ = self._list_files()
+        data = None
+        for generation in sorted(snapshots, reverse=True):
+            path = snapshots[generation]
+            validate_started = time.perf_counter()
+            try:
+                data = self._read_generation(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error("数据文件 %s 校验失败：%s，尝试上一代。", path, e)
+                continue
+            finally:
+                logger.info("校验数据文件 %s 耗时 %.1f ms",
+                            path, (time.perf_counter() - validate_started) * 1000)
+            self.generation = generation
+            break
+        if data is None:
+            if snapshots:
+                raise ValueError(f"全部 {len(snapshots)} 代数据文件均未通过校验，请手动恢复。")
+            if os.path.exists(self.data_file):
+                # 旧版本的单文件格式，格式错误时不再静默清空数据
+                with open(self.data_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                logger.info("已加载旧格式数据文件 %s。", self.data_file)
+            else:
+                data = empty_data()
+                logger.info("未找到数据文件，初始化为空。")
+        seq = data.pop("_journal_seq", 0)
+        normalize_data(data)
+        replayed, seq = self._replay(data, seq)
+        if not self.generation:
+            data_copy = replace_sets(data)
+            data_copy["_journal_seq"] = seq
+            self.write_snapshot(data_copy)
+        logger.info("数据恢复完成：第 %s 代快照，重放 %s 条 journal 记录，"
+                    "耗时 %.1f ms",
+                    self.generation, replayed, (time.perf_counter() - started) * 1000)
+        return data, seq
+
+    def _replay(self, data, base_seq):
+        """在快照之上重放 journal，跳过快照已包含的记录。"""
+        seq = base_seq
+        replayed = 0
+        _, segments = self._list_files()
+        paths = [segments[g] for g in sorted(segments)] + [self.journal_old_file, self.journal_file]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        batch = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时可能只写了半行，这一批及之后的内容全部丢弃
+                        logger.warning("%s 末尾存在不完整记录，已忽略。", path)
+                        break
+                    # 每行是一次刷新的全部记录；旧版 journal 每行一条记录
+                    if isinstance(batch, dict):
+                        batch = [batch]
+                    for record in batch:
+                        if path in (self.journal_old_file, self.journal_file):
+                            self.journal_size += 1
+                        # 跳过快照已包含的记录，以及写入失败后重试时重复写入的记录
+                        if record['s'] <= seq:
+                            continue
+                        apply_record(data, record)
+                        seq = record['s']
+                        replayed += 1
+        return replayed, seq
+
+    def append(self, records):
+        # 一次刷新写成一行：崩溃时要么整批重放，要么整批丢弃，不会只留下半个结算
+        line = json.dumps(records, ensure_ascii=False, separators=(',', ':'), default=json_default) + '\n'
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_size += len(records)
+
+    def load_history(self, internal_id):
+        return []
+
+    def needs_compaction(self, threshold):
+        return self.journal_size >= threshold
+
+    def has_pending(self):
+        return self.journal_size > 0
+
+    def begin_compaction(self):
+        # 轮换 journal：此后的追加写入新文件，旧文件在快照落盘后删除
+        if os.path.exists(self.journal_file):
+            if os.path.exists(self.journal_old_file):
+                # 上一次压缩未完成，旧记录仍需保留
+                with open(self.journal_file, 'r', encoding='utf-8') as src, \
+                        open(self.journal_old_file, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_file)
+            else:
+                os.replace(self.journal_file, self.journal_old_file)
+        self.journal_size = 0
+
+    def write_snapshot(self, data_copy):
+        generation = self.generation + 1
+        payload = json.dumps(data_copy, ensure_ascii=False, indent=4, default=json_default).encode('utf-8')
+        header = {
+            'version': self.HEADER_VERSION,
+            'generation': generation,
+            'journal_seq': data_copy.get('_journal_seq', 0),
+            'length': len(payload),
+            'sha256': hashlib.sha256(payload).hexdigest(),
+        }
+        atomic_write(self._generation_path(generation), json.dumps(header).encode('utf-8') + b'\n' + payload)
+        self.generation = generation
+
+    def end_compaction(self):
+        # 被新快照覆盖的 journal 成为这一代的段文件，随快照一起按环形保留
+        if os.path.exists(self.journal_old_file):
+            os.replace(self.journal_old_file, self._segment_path(self.generation))
+        self._prune()
+
+    def write_archive(self, batches):
+        for internal_id, segment, records in batches:
+            directory = os.path.join(self.archive_dir, internal_id)
+            os.makedirs(directory, exist_ok=True)
+            lines = ''.join(
+                json.dumps(r, ensure_ascii=False, separators=(',', ':'), default=json_default) + '\n' for r in records
+            )
+            atomic_write(os.path.join(directory, segment), gzip.compress(lines.encode('utf-8')))
+
+    def read_archive(self, internal_id, segments):
+        records = []
+        for segment in segments:
+            with gzip.open(os.path.join(self.archive_dir, internal_id, segment), 'rt', encoding='utf-8') as f:
+                records.extend(HistoryRecord.from_json(json.loads(line)) for line in f)
+        return records
+
+    def _prune(self):
+        snapshots, segments = self._list_files()
+        kept = sorted(snapshots)[-self.keep_generations:]
+        if not kept:
+            return
+        oldest = kept[0]
+        for generation, path in snapshots.items():
+            if generation < oldest:
+                os.remove(path)
+        # 从最旧的保留快照恢复时，只需要它之后各代的段
+        for generation, path in segments.items():
+            if generation <= oldest:
+                os.remove(path)
+
+
+class SqliteStorage(StorageBackend):
+    """SQLite（WAL 模式）存储。用户、历史、红包、进行中游戏分表保存，历史记录不常驻内存。"""
+    history_in_memory = False
+    # 追加直接写入数据表，压缩只做 WAL checkpoint。write_snapshot 写的是同一批表，
+    # 与并发提交的追加交错时会用旧副本覆盖新数据，只用于迁移和分片拆分这类离线导入
+    snapshot_on_compaction = False
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            internal_id TEXT PRIMARY KEY,
+            userid TEXT,
+            username TEXT,
+            points INTEGER NOT NULL DEFAULT 0,
+            extra TEXT
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_users_userid ON users(userid);
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            internal_id TEXT NOT NULL,
+            period_number TEXT,
+            role TEXT,
+            payload TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_history_user ON history(internal_id, id);
+        CREATE INDEX IF NOT EXISTS idx_history_period ON history(period_number);
+        CREATE TABLE IF NOT EXISTS red_envelopes (
+            period_number TEXT PRIMARY KEY,
+            sender_id TEXT,
+            payload TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_red_envelopes_sender ON red_envelopes(sender_id);
+        CREATE TABLE IF NOT EXISTS active_games (
+            internal_id TEXT PRIMARY KEY,
+            payload TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS shard_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL,
+            payload TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # 快照在工作线程中写入，连接需跨线程使用，由 self.lock 串行化
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+
+    def load(self):
+        data = empty_data()
+        with self.lock:
+            for internal_id, userid, username, points, extra in self.conn.execute(
+                    'SELECT internal_id, userid, username, points, extra FROM users'):
+                user = json.loads(extra) if extra else {}
+                user.update({'userid': userid, 'username': username, 'points': points})
+                data["user_data"][internal_id] = user
+                if userid:
+                    data["internal_to_userid"][internal_id] = userid
+                    data["userid_to_internal"][userid] = internal_id
+            for period_number, payload in self.conn.execute('SELECT period_number, payload FROM red_envelopes'):
+                data["red_envelopes"][period_number] = json.loads(payload)
+            for internal_id, payload in self.conn.execute('SELECT internal_id, payload FROM active_games'):
+                data["active_games"][internal_id] = json.loads(payload)
+            meta = dict(self.conn.execute('SELECT key, value FROM meta'))
+            data["id_watermark"] = meta.get('id_watermark')
+            # 分片状态：整体值存在 meta 的 shard.<key> 中，之后追加的元素存在 shard_log 中
+            for key, value in meta.items():
+                if key.startswith('shard.'):
+                    data["shard"][key[len('shard.'):]] = json.loads(value)
+            for key, payload in self.conn.execute('SELECT key, payload FROM shard_log ORDER BY id'):
+                data["shard"].setdefault(key, []).append(json.loads(payload))
+            self._migrate_period_numbers(data)
+        data["boss_id"] = meta.get('boss_id')
+        seq = int(meta.get('journal_seq', 0))
+        logger.info("SQLite 数据库 %s 加载成功，用户数：%s",
+                    self.db_file, len(data['user_data']))
+        return data, seq
+
+    def _migrate_period_numbers(self, data):
+        """旧版数据库的期号表只保留最大值作为水位线，之后删除该表。"""
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'period_numbers'").fetchone()
+        if not exists:
+            return
+        with self.conn:
+            latest = self.conn.execute('SELECT MAX(period_number) FROM period_numbers').fetchone()[0]
+            for period_number in [latest, *data["red_envelopes"]]:
+                advance_watermark(data, period_number)
+            self._set_meta('id_watermark', data["id_watermark"])
+            self.conn.execute('DROP TABLE period_numbers')
+        logger.info("已把期号表迁移为水位线：%s", data['id_watermark'])
+
+    def _upsert_user(self, internal_id, user):
+        extra = {k: v for k, v in user.items() if k not in ('userid', 'username', 'points')}
+        self.conn.execute(
+            'INSERT INTO users (internal_id, userid, username, points, extra) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(internal_id) DO UPDATE SET userid=excluded.userid, username=excluded.username, '
+            'points=excluded.points, extra=excluded.extra',
+            (internal_id, user.get('userid'), user.get('username'), user.get('points', 0),
+             json.dumps(extra, ensure_ascii=False) if extra else None)
+        )
+
+    def _insert_history(self, internal_id, record):
+        self.conn.execute(
+            'INSERT INTO history (internal_id, period_number, role, payload) VALUES (?, ?, ?, ?)',
+            (internal_id, record.period_number, record.role,
+             json.dumps(record.to_json(), ensure_ascii=False, separators=(',', ':')))
+        )
+
+    def _upsert_envelope(self, period_number, envelope):
+        if envelope is None:
+            self.conn.execute('DELETE FROM red_envelopes WHERE period_number = ?', (period_number,))
+            return
+        self.conn.execute(
+            'INSERT OR REPLACE INTO red_envelopes (period_number, sender_id, payload) VALUES (?, ?, ?)',
+            (period_number, envelope.get('sender_id'), json.dumps(envelope, ensure_ascii=False))
+        )
+
+    def _upsert_game(self, internal_id, state):
+        if state is None:
+            self.conn.execute('DELETE FROM active_games WHERE internal_id = ?', (internal_id,))
+            return
+        self.conn.execute(
+            'INSERT OR REPLACE INTO active_games (internal_id, payload) VALUES (?, ?)',
+            (internal_id, json.dumps(state, ensure_ascii=False, separators=(',', ':')))
+        )
+
+    def _set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def _set_shard_state(self, key, value):
+        self.conn.execute('DELETE FROM shard_log WHERE key = ?', (key,))
+        self._set_meta(f'shard.{key}', json.dumps(value, ensure_ascii=False, separators=(',', ':')))
+
+    def append(self, records):
+        with self.lock, self.conn:
+            # 写入失败后重试的记录保留原序号，已经提交过的部分跳过
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'journal_seq'").fetchone()
+            committed = int(row[0]) if row and row[0] else 0
+            records = [record for record in records if record['s'] > committed]
+            for record in records:
+                op = record['o']
+                if op == 'u':
+                    self._upsert_user(record['i'], record['v'])
+                elif op == 'h':
+                    self._insert_history(record['i'], HistoryRecord.from_json(record['v']))
+                elif op == 'e':
+                    self._upsert_envelope(record['i'], record['v'])
+                elif op == 'b':
+                    self._set_meta('boss_id', record['v'])
+                elif op == 'p':
+                    self._set_meta('id_watermark', record['v'])
+                elif op == 'g':
+                    self._upsert_game(record['i'], record['v'])
+                elif op == 'k':
+                    self._set_shard_state(record['i'], record['v'])
+                elif op == 'q':
+                    self.conn.execute('INSERT INTO shard_log (key, payload) VALUES (?, ?)',
+                                      (record['i'], json.dumps(record['v'], ensure_ascii=False)))
+            if records:
+                self._set_meta('journal_seq', str(records[-1]['s']))
+
+    def load_history(self, internal_id):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT payload FROM history WHERE internal_id = ? ORDER BY id', (internal_id,)
+            ).fetchall()
+        return [HistoryRecord.from_json(json.loads(row[0])) for row in rows]
+
+    def write_snapshot(self, data_copy):
+        """整体写入一份数据。历史记录只在数据中带有时写入（例如从 data.json 迁移）。"""
+        with self.lock, self.conn:
+            for internal_id, user in data_copy.get("user_data", {}).items():
+                self._upsert_user(internal_id, user)
+            for period_number, envelope in data_copy.get("red_envelopes", {}).items():
+                self._upsert_envelope(period_number, envelope)
+            for internal_id, records in data_copy.get("game_history", {}).items():
+                for record in records:
+                    self._insert_history(internal_id, record)
+            # 快照中不存在的游戏已经结算或取消
+            self.conn.execute('DELETE FROM active_games')
+            for internal_id, state in data_copy.get("active_games", {}).items():
+                self._upsert_game(internal_id, state)
+            self._set_meta('boss_id', data_copy.get("boss_id"))
+            self._set_meta('id_watermark', data_copy.get("id_watermark"))
+            for key, value in data_copy.get("shard", {}).items():
+                self._set_shard_state(key, value)
+            if "_journal_seq" in data_copy:
+                self._set_meta('journal_seq', str(data_copy["_journal_seq"]))
+
+    def end_compaction(self):
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def create_storage(persistence, data_file):
+    backend = persistence.get('backend', 'json')
+    if backend == 'sqlite':
+        return SqliteStorage(persistence.get('sqlite_file', 'data.db'))
+    if backend != 'json':
+        logger.warning("未知的存储后端 %s，改用 json。", backend)
+    return JsonStorage(data_file, keep_generations=int(persistence.get('keep_generations', 5)))
@@ -0,0 +1,78 @@
+# TimerWheel.py
+
+import math
+
+
+class TimerWheel:
+    """
+    分层时间轮：每层 slots 个槽，第 0 层每槽一个 tick，第 n 层每槽 slots**n 个 tick。
+    定时器按到期 tick 与当前 tick 最高的不同位放入对应层，上层槽到点时逐级下放，
+    添加、取消都是 O(1)，推进每个 tick 只处理到期的槽，与定时器总数无关。
+    超出最高层范围的定时器放在最高层，下放时重新计算位置。
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=4, now=0.0):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.origin = now
+        self.current = 0
+        self._wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        # key -> (到期 tick, 层, 槽)
+        self._timers = {}
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, delay, now):
+        """delay 秒后到期；同一 key 已有定时器时替换。"""
+        self.cancel(key)
+        deadline = max(self.current + 1, math.ceil((now + delay - self.origin) / self.tick))
+        self._place(key, deadline)
+
+    def cancel(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            _, level, index = timer
+            self._wheels[level][index].discard(key)
+
+    def _place(self, key, deadline):
+        level = 0
+        span = self.slots
+        while level < self.levels - 1 and deadline // span != self.current // span:
+            level += 1
+            span *= self.slots
+        index = (deadline // self.slots ** level) % self.slots
+        self._wheels[level][index].add(key)
+        self._timers[key] = (deadline, level, index)
+
+    def advance(self, now):
+        """推进到 now，返回这期间到期的 key 列表（按到期顺序）。"""
+        target = math.floor((now - self.origin) / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            # 自上而下下放到达边界的上层槽
+            for level in range(self.levels - 1, 0, -1):
+                if self.current % self.slots ** level:
+                    continue
+                index = (self.current // self.slots ** level) % self.slots
+                bucket = self._wheels[level][index]
+                self._wheels[level][index] = set()
+                for key in bucket:
+                    deadline, _, _ = self._timers.pop(key)
+                    if deadline <= self.current:
+                        expired.append(key)
+                    else:
+                        self._place(key, deadline)
+            index = self.current % self.slots
+            bucket = self._wheels[0][index]
+            if bucket:
+                self._wheels[0][index] = set()
+                for key in bucket:
+                    del self._timers[key]
+                    expired.append(key)
+        return expired
@@ -0,0 +1,123 @@
+# UserStats.py
+# 每个用户的游戏统计（游戏次数、收获次数、总投入、总收获）随写入增量维护，保存在用户数据中。
+# 也可作为工具运行，从完整历史重新计算并核对统计（请在机器人停止时运行）：
+#   python UserStats.py          只核对
+#   python UserStats.py --fix    核对并写回重算结果
+
+import asyncio
+import logging
+import sys
+
+from History import EventKind
+
+logger = logging.getLogger("UserStats")
+
+STAT_KEYS = ('games', 'wins', 'total_bet', 'total_winnings')
+
+
+def has_stats(user):
+    return 'games' in user
+
+
+def init_stats(user):
+    for key in STAT_KEYS:
+        user[key] = 0
+
+
+def get_stats(user):
+    """返回统计字典，附带派生的 profit；用户尚未建立统计时返回 None。"""
+    if not has_stats(user):
+        return None
+    stats = {key: user[key] for key in STAT_KEYS}
+    stats['profit'] = stats['total_winnings'] - stats['total_bet']
+    return stats
+
+
+# 以下更新函数只在统计已建立时生效；尚未建立的旧用户在首次查看时由 rebuild_stats 一次性补齐
+def record_open(user, total_bet):
+    if has_stats(user):
+        user['games'] += 1
+        user['total_bet'] += total_bet
+
+
+def record_settle(user, payout, won):
+    """payout 为本局实际返还给玩家的代币（收获，或负责人不足时返还的投入）。"""
+    if has_stats(user):
+        user['total_winnings'] += payout
+        if won:
+            user['wins'] += 1
+
+
+def record_cancel(user, refund):
+    if has_stats(user):
+        user['games'] -= 1
+        user['total_bet'] -= refund
+
+
+def rebuild_stats(history):
+    """按与增量更新相同的口径，从完整历史重新计算统计。"""
+    bets, winnings, paid, last_win = {}, {}, {}, {}
+    cancelled = set()
+    for record in history:
+        if record.role != 'player':
+            continue
+        period_number = record.period_number
+        if record.kind == EventKind.BET:
+            bets[period_number] = bets.get(period_number, 0) + abs(record.points_change)
+        elif record.kind == EventKind.WIN:
+            winnings[period_number] = winnings.get(period_number, 0) + record.points_change
+            paid[period_number] = paid.get(period_number, 0) + 1
+            last_win[period_number] = record.points_change
+        elif record.kind == EventKind.REFUND:
+            # 负责人余额不足：上一条收获被撤回，改为返还投入
+            winnings[period_number] = (winnings.get(period_number, 0)
+                                       - last_win.get(period_number, 0) + record.points_change)
+            paid[period_number] = paid.get(period_number, 0) - 1
+        elif record.kind == EventKind.CANCEL:
+            cancelled.add(period_number)
+
+    periods = [p for p in bets if p not in cancelled]
+    return {
+        'games': len(periods),
+        'wins': sum(1 for p in periods if paid.get(p, 0) > 0),
+        'total_bet': sum(bets[p] for p in periods),
+        'total_winnings': sum(winnings.get(p, 0) for p in periods),
+    }
+
+
+async def check_all(data_manager, fix=False):
+    """重新计算所有用户的统计并与保存的值比较，返回不一致的用户数。"""
+    mismatched = 0
+    missing = 0
+    for internal_id, user in data_manager.data["user_data"].items():
+        expected = rebuild_stats(await data_manager.get_history(internal_id))
+        if not has_stats(user):
+            # 尚未建立统计的旧用户不算不一致，--fix 时一并补齐
+            missing += 1
+        else:
+            stored = {key: user[key] for key in STAT_KEYS}
+            if stored == expected:
+                continue
+            mismatched += 1
+            logger.warning("用户 %s 统计不一致：保存值 %s，重算值 %s", internal_id, stored, expected)
+        if fix:
+            user.update(expected)
+            data_manager.mark_user(internal_id)
+    logger.info("核对完成：用户 %s 个，不一致 %s 个，"
+                "尚未建立统计 %s 个。", len(data_manager.data['user_data']), mismatched, missing)
+    return mismatched
+
+
+async def main(fix):
+    from DataManager import DataManager
+    data_manager = DataManager()
+    mismatched = await check_all(data_manager, fix=fix)
+    await data_manager.close()
+    return mismatched
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    fix = '--fix' in sys.argv[1:]
+    mismatched = asyncio.run(main(fix))
+    sys.exit(0 if fix or mismatched == 0 else 1)